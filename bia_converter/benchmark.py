@@ -0,0 +1,594 @@
+"""End-to-end benchmark of the conversion pipeline, against local stand-ins.
+
+The real conversion functions are run, from an uploaded image to its interactive
+display, thumbnail and static display representations, against:
+
+* A fake BIA API, an in-memory store of objects serving the GET and private POST
+  endpoints the converter uses.
+* A fake S3 endpoint, an in-memory path-style object store with range requests,
+  which also serves the submitted files.
+* A stub bioformats2raw, which reads its input and writes a synthetic pyramid of
+  the configured size.
+
+Each service can add a fixed latency per request. The settings of the converter
+are read from the environment when its modules are first imported, so the
+stand-ins are started and the environment pointed at them before that, and the
+benchmark needs a process of its own (the bia-benchmark command).
+
+Timings come from the stages timed with utils.timed_stage, collected and
+reported per pass. A second pass over the same images measures the cost of finding that
+the conversions already exist.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import logging
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+import rich
+import typer
+from aiohttp import web
+from rich.table import Table
+from pydantic import BaseModel
+from typing_extensions import Annotated
+
+
+app = typer.Typer()
+
+
+logger = logging.getLogger(__name__)
+
+
+BUCKET_NAME = "bia-benchmark"
+STUB_PARAMS_ENV = "BIA_BENCHMARK_STUB_PARAMS"
+
+
+class ServiceStats:
+    """Request and byte counts for a fake service."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.n_requests = 0
+        self.n_bytes_in = 0
+        self.n_bytes_out = 0
+
+    def record(self, n_bytes_in: int = 0, n_bytes_out: int = 0):
+        with self._lock:
+            self.n_requests += 1
+            self.n_bytes_in += n_bytes_in
+            self.n_bytes_out += n_bytes_out
+
+    def reset(self):
+        with self._lock:
+            self.n_requests = self.n_bytes_in = self.n_bytes_out = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return {"n_requests": self.n_requests, "n_bytes_in": self.n_bytes_in, "n_bytes_out": self.n_bytes_out}
+
+
+def latency_middleware(latency_seconds: float):
+    @web.middleware
+    async def add_latency(request, handler):
+        if latency_seconds:
+            await asyncio.sleep(latency_seconds)
+        return await handler(request)
+
+    return add_latency
+
+
+def decode_aws_chunked(body: bytes) -> bytes:
+    """Payload of an aws-chunked body: hex size[;extensions] CRLF data CRLF, ending
+    with a zero size chunk and optional trailers."""
+
+    data = bytearray()
+    position = 0
+    while True:
+        line_end = body.index(b"\r\n", position)
+        size = int(body[position:line_end].split(b";")[0], 16)
+        if size == 0:
+            return bytes(data)
+        data += body[line_end + 2:line_end + 2 + size]
+        position = line_end + 2 + size + 2
+
+
+class FakeS3:
+    """In-memory, path-style S3 endpoint: PUT, HEAD and (ranged) GET of objects."""
+
+    def __init__(self, latency_seconds: float = 0):
+        self.objects: Dict[str, bytes] = {}
+        self.stats = ServiceStats()
+        self.app = web.Application(
+            middlewares=[latency_middleware(latency_seconds)],
+            client_max_size=1024**3
+        )
+        self.app.router.add_route("*", "/{bucket}/{key:.+}", self.handle)
+
+    async def handle(self, request):
+        path = f"{request.match_info['bucket']}/{request.match_info['key']}"
+
+        if request.method == "PUT":
+            body = await request.read()
+            if "aws-chunked" in request.headers.get("Content-Encoding", "") or \
+                    request.headers.get("x-amz-content-sha256", "").startswith("STREAMING"):
+                body = decode_aws_chunked(body)
+            self.objects[path] = body
+            self.stats.record(n_bytes_in=len(body))
+            return web.Response(headers={"ETag": f'"{hashlib.md5(body).hexdigest()}"'})
+
+        data = self.objects.get(path)
+        if data is None or request.method == "HEAD":
+            self.stats.record()
+        if data is None:
+            return web.Response(status=404, text="<Error><Code>NoSuchKey</Code></Error>")
+
+        headers = {"ETag": f'"{hashlib.md5(data).hexdigest()}"', "Accept-Ranges": "bytes"}
+        if request.method == "HEAD":
+            return web.Response(body=data, headers=headers)
+
+        range_header = request.headers.get("Range")
+        if range_header is None:
+            self.stats.record(n_bytes_out=len(data))
+            return web.Response(body=data, headers=headers)
+
+        start_str, _, stop_str = range_header.removeprefix("bytes=").partition("-")
+        if start_str:
+            start = int(start_str)
+            stop = min(int(stop_str) + 1, len(data)) if stop_str else len(data)
+        else:
+            start, stop = max(len(data) - int(stop_str), 0), len(data)
+        if start >= len(data):
+            self.stats.record()
+            return web.Response(status=416, headers={"Content-Range": f"bytes */{len(data)}"})
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{len(data)}"
+        self.stats.record(n_bytes_out=stop - start)
+
+        return web.Response(status=206, body=data[start:stop], headers=headers)
+
+
+class FakeBIAAPI:
+    """In-memory stand-in for the BIA API: token login, GET of objects by UUID and
+    POST of new objects to the private endpoints."""
+
+    def __init__(self, latency_seconds: float = 0):
+        self.objects: Dict[str, Dict[str, dict]] = {}
+        self.stats = ServiceStats()
+        self.app = web.Application(middlewares=[latency_middleware(latency_seconds)])
+        self.app.router.add_post("/v2/auth/token", self.login)
+        self.app.router.add_get("/v2/{model}/{uuid}", self.get_object)
+        self.app.router.add_post("/v2/private/{model}", self.post_object)
+
+    def add(self, model_name: str, obj: dict):
+        self.objects.setdefault(model_name, {})[str(obj["uuid"])] = obj
+
+    async def login(self, request):
+        self.stats.record()
+        return web.json_response({"access_token": "benchmark", "token_type": "bearer"})
+
+    async def get_object(self, request):
+        self.stats.record()
+        obj = self.objects.get(request.match_info["model"], {}).get(request.match_info["uuid"])
+        if obj is None:
+            return web.json_response({"detail": "Object not found"}, status=404)
+
+        return web.json_response(obj)
+
+    async def post_object(self, request):
+        obj = await request.json()
+        self.stats.record(n_bytes_in=request.content_length or 0)
+        self.add(request.match_info["model"], obj)
+
+        return web.json_response(obj, status=201)
+
+
+class ServiceThread:
+    """Runs aiohttp applications on an event loop in a background thread."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.runners: List[web.AppRunner] = []
+
+    def start_app(self, app: web.Application) -> str:
+        """Serve the app on a free local port, returning its base URL."""
+
+        async def start():
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, "127.0.0.1", 0).start()
+            self.runners.append(runner)
+            return runner.addresses[0][1]
+
+        port = asyncio.run_coroutine_threadsafe(start(), self.loop).result()
+
+        return f"http://127.0.0.1:{port}"
+
+    def stop(self):
+        async def cleanup():
+            for runner in self.runners:
+                await runner.cleanup()
+
+        asyncio.run_coroutine_threadsafe(cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+STUB_BIOFORMATS2RAW = '''#!{python}
+"""Stand-in for bioformats2raw written by the bia-converter benchmark. Reads its
+input, then writes a synthetic pyramid in the bioformats2raw layout."""
+import os
+import sys
+import json
+from pathlib import Path
+
+import numpy as np
+import zarr
+
+params = json.loads(os.environ["{params_env}"])
+input_fpath, output_dirpath = Path(sys.argv[1]), sys.argv[2]
+
+if input_fpath.suffix == ".pattern":
+    input_fpaths = [p for p in input_fpath.parent.iterdir() if p != input_fpath]
+else:
+    input_fpaths = [input_fpath]
+for fpath in input_fpaths:
+    with open(fpath, "rb") as fh:
+        while fh.read(1 << 24):
+            pass
+
+root = zarr.open_group(output_dirpath, mode="w")
+root.attrs["bioformats2raw.layout"] = 3
+root.create_group("OME").attrs["series"] = ["0"]
+image = root.create_group("0")
+
+rng = np.random.default_rng(0)
+shape = (1, params["size_c"], params["size_z"], params["size_xy"], params["size_xy"])
+chunks = (1, 1, 1, params["chunk_size"], params["chunk_size"])
+datasets = []
+level = 0
+while True:
+    array = image.create_dataset(str(level), shape=shape, chunks=chunks, dtype="uint16", dimension_separator="/")
+    for c in range(shape[1]):
+        for z in range(shape[2]):
+            array[0, c, z] = rng.integers(0, 4096, shape[3:], dtype="uint16")
+    datasets.append({
+        "path": str(level),
+        "coordinateTransformations": [{"type": "scale", "scale": [1.0, 1.0, 1.0, 2.0**level, 2.0**level]}]
+    })
+    if max(shape[3:]) <= params["chunk_size"]:
+        break
+    shape = shape[:3] + tuple((size + 1) // 2 for size in shape[3:])
+    level += 1
+
+image.attrs["multiscales"] = [{
+    "version": "0.4",
+    "name": "0",
+    "axes": [
+        {"name": "t", "type": "time"},
+        {"name": "c", "type": "channel"},
+        {"name": "z", "type": "space", "unit": "micrometer"},
+        {"name": "y", "type": "space", "unit": "micrometer"},
+        {"name": "x", "type": "space", "unit": "micrometer"},
+    ],
+    "datasets": datasets,
+}]
+'''
+
+
+def write_stub_bioformats2raw(dirpath: Path) -> Path:
+    fpath = dirpath/"bioformats2raw"
+    fpath.write_text(
+        STUB_BIOFORMATS2RAW.replace("{python}", sys.executable).replace("{params_env}", STUB_PARAMS_ENV)
+    )
+    fpath.chmod(0o755)
+
+    return fpath
+
+
+class BenchmarkConfig(BaseModel):
+    n_images: int = 2
+    files_per_image: int = 1
+    file_size_bytes: int = 8 * 1024 * 1024
+    size_xy: int = 2048
+    size_z: int = 8
+    size_c: int = 1
+    chunk_size: int = 256
+    api_latency_ms: float = 0
+    s3_latency_ms: float = 0
+    max_workers: int = 1
+    n_passes: int = 2
+    pipelined: bool = False
+
+
+def build_fixtures(config: BenchmarkConfig, source_base_uri: str):
+    """Objects for one study with one dataset of images, each with its file
+    references and an uploaded by submitter representation, plus the content of
+    the submitted files by S3 key. Images with several files get a file pattern."""
+
+    accession_id = "S-BIADBENCH"
+    study_uuid, dataset_uuid = str(uuid.uuid4()), str(uuid.uuid4())
+
+    objects: Dict[str, List[dict]] = {
+        "study": [{
+            "uuid": study_uuid,
+            "version": 0,
+            "accession_id": accession_id,
+            "title": "Benchmark study",
+            "description": "Synthetic study for benchmarking conversions",
+            "release_date": "2024-01-01",
+            "licence": "CC0",
+            "author": [{"display_name": "Benchmark Author", "affiliation": [], "contact_email": "benchmark@example.com"}],
+            "keyword": [],
+            "attribute": [],
+        }],
+        "dataset": [{
+            "uuid": dataset_uuid,
+            "version": 0,
+            "title": "Benchmark dataset",
+            "description": "Synthetic dataset",
+            "submitted_in_study_uuid": study_uuid,
+            "analysis_method": [],
+            "correlation_method": [],
+            "example_image_uri": [],
+            "attribute": [],
+        }],
+        "image": [],
+        "file_reference": [],
+        "image_representation": [],
+    }
+    source_files: Dict[str, bytes] = {}
+
+    for n in range(config.n_images):
+        image_uuid = str(uuid.uuid4())
+        fileref_uuids = []
+        for z in range(config.files_per_image):
+            file_path = f"image_{n}/z{z:03d}.tif" if config.files_per_image > 1 else f"image_{n}.tif"
+            key = f"source/{accession_id}/{file_path}"
+            source_files[key] = os.urandom(config.file_size_bytes)
+            fileref_uuid = str(uuid.uuid4())
+            fileref_uuids.append(fileref_uuid)
+            objects["file_reference"].append({
+                "uuid": fileref_uuid,
+                "version": 0,
+                "file_path": file_path,
+                "format": "tif",
+                "size_in_bytes": config.file_size_bytes,
+                "uri": f"{source_base_uri}/{key}",
+                "submission_dataset_uuid": dataset_uuid,
+                "attribute": [],
+            })
+
+        objects["image"].append({
+            "uuid": image_uuid,
+            "version": 0,
+            "submission_dataset_uuid": dataset_uuid,
+            "creation_process_uuid": str(uuid.uuid4()),
+            "original_file_reference_uuid": fileref_uuids,
+            "attribute": [],
+        })
+
+        rep_attributes = []
+        if config.files_per_image > 1:
+            rep_attributes.append({
+                "provenance": "bia_image_assignment",
+                "name": "file_pattern",
+                "value": {"file_pattern": f"image_{n}/z{{z:d}}.tif"},
+            })
+        objects["image_representation"].append({
+            "uuid": str(uuid.uuid4()),
+            "version": 0,
+            "representation_of_uuid": image_uuid,
+            "use_type": "UPLOADED_BY_SUBMITTER",
+            "image_format": ".tif",
+            "file_uri": [],
+            "total_size_in_bytes": config.file_size_bytes * config.files_per_image,
+            "attribute": rep_attributes,
+        })
+
+    return objects, source_files
+
+
+def configure_environment(api_url: str, s3_url: str, workdir: Path, stub_fpath: Path, config: BenchmarkConfig):
+    """Point the converter's settings at the stand-ins. Must happen before any
+    module that reads settings is imported."""
+
+    if "bia_converter.config" in sys.modules:
+        raise RuntimeError("The converter settings were read before the benchmark could set them")
+
+    os.environ.update({
+        "endpoint_url": s3_url,
+        "bucket_name": BUCKET_NAME,
+        "cache_root_dirpath": str(workdir/"cache"),
+        "bioformats2raw_java_home": str(workdir),
+        "bioformats2raw_bin": str(stub_fpath),
+        "pipelined_conversion": str(config.pipelined).lower(),
+        # The stub writes in seconds, so don't wait as long for it to settle
+        "pipeline_poll_interval_seconds": "0.5",
+        "pipeline_settle_seconds": "1",
+        "api_base_url": api_url,
+        "username": "benchmark@example.com",
+        "password": "benchmark",
+        "AWS_ACCESS_KEY_ID": "benchmark",
+        "AWS_SECRET_ACCESS_KEY": "benchmark",
+        STUB_PARAMS_ENV: json.dumps({
+            "size_xy": config.size_xy,
+            "size_z": config.size_z,
+            "size_c": config.size_c,
+            "chunk_size": config.chunk_size,
+        }),
+    })
+
+
+def run_pass(upload_reps: List, max_workers: int) -> float:
+    """Convert each uploaded representation to an interactive display, and that to
+    a thumbnail and static display. Returns the wall clock time."""
+
+    from .convert import (
+        convert_uploaded_by_submitter_to_interactive_display,
+        convert_interactive_display_to_thumbnail,
+        convert_interactive_display_to_static_display
+    )
+
+    def convert_one(upload_rep):
+        interactive_rep = convert_uploaded_by_submitter_to_interactive_display(upload_rep)
+        convert_interactive_display_to_thumbnail(interactive_rep)
+        convert_interactive_display_to_static_display(interactive_rep)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in [executor.submit(convert_one, upload_rep) for upload_rep in upload_reps]:
+            future.result()
+
+    return time.perf_counter() - start
+
+
+def summarise_timings(timings) -> List[dict]:
+    """Per stage count, total, mean and maximum seconds, bytes and throughput."""
+
+    by_stage: Dict[str, List] = {}
+    for timing in timings:
+        by_stage.setdefault(timing.name, []).append(timing)
+
+    summary = []
+    for name, stage_timings in by_stage.items():
+        seconds = [timing.seconds for timing in stage_timings]
+        n_bytes = sum(timing.n_bytes or 0 for timing in stage_timings)
+        total = sum(seconds)
+        summary.append({
+            "stage": name,
+            "count": len(seconds),
+            "total_seconds": total,
+            "mean_seconds": total / len(seconds),
+            "max_seconds": max(seconds),
+            "n_bytes": n_bytes,
+            "mb_per_second": n_bytes / total / 1e6 if n_bytes and total else None,
+        })
+
+    return summary
+
+
+def print_pass_report(n_pass: int, wall_seconds: float, n_images: int, summary: List[dict], services: Dict[str, ServiceStats]):
+    table = Table(title=f"Pass {n_pass}: {n_images} images in {wall_seconds:.2f}s ({n_images / wall_seconds:.2f} images/s)")
+    for column in ("Stage", "Count", "Total s", "Mean s", "Max s", "MB", "MB/s"):
+        table.add_column(column, justify="left" if column == "Stage" else "right")
+    for row in summary:
+        table.add_row(
+            row["stage"],
+            str(row["count"]),
+            f"{row['total_seconds']:.3f}",
+            f"{row['mean_seconds']:.3f}",
+            f"{row['max_seconds']:.3f}",
+            f"{row['n_bytes'] / 1e6:.1f}" if row["n_bytes"] else "",
+            f"{row['mb_per_second']:.1f}" if row["mb_per_second"] else "",
+        )
+    rich.print(table)
+
+    for name, stats in services.items():
+        rich.print(
+            f"{name}: {stats.n_requests} requests, "
+            f"{stats.n_bytes_in / 1e6:.1f} MB in, {stats.n_bytes_out / 1e6:.1f} MB out"
+        )
+
+
+@app.command()
+def run(
+        n_images: Annotated[int, typer.Option(help="Number of images to convert")] = 2,
+        files_per_image: Annotated[int, typer.Option(help="Submitted files per image, more than one uses a file pattern")] = 1,
+        file_size_mb: Annotated[float, typer.Option(help="Size of each submitted file")] = 8,
+        size_xy: Annotated[int, typer.Option(help="XY size of the converted images")] = 2048,
+        size_z: Annotated[int, typer.Option(help="Z size of the converted images")] = 8,
+        size_c: Annotated[int, typer.Option(help="Channels of the converted images")] = 1,
+        api_latency_ms: Annotated[float, typer.Option(help="Latency added to each API request")] = 0,
+        s3_latency_ms: Annotated[float, typer.Option(help="Latency added to each S3 request")] = 0,
+        max_workers: Annotated[int, typer.Option(help="Images converted concurrently")] = 1,
+        passes: Annotated[int, typer.Option(help="Passes over the images, later passes find existing conversions")] = 2,
+        pipelined: Annotated[bool, typer.Option(help="Upload while bioformats2raw is writing")] = False,
+        workdir: Annotated[Optional[Path], typer.Option(help="Directory for the cache and stub, a temporary one by default")] = None,
+        json_output: Annotated[Optional[Path], typer.Option(help="Also write the results to this JSON file")] = None,
+    ):
+    """Run the conversion pipeline end to end against local stand-ins for the API,
+    S3 and bioformats2raw, and report timings per stage."""
+
+    logging.basicConfig(level=logging.WARNING)
+
+    config = BenchmarkConfig(
+        n_images=n_images,
+        files_per_image=files_per_image,
+        file_size_bytes=int(file_size_mb * 1024 * 1024),
+        size_xy=size_xy,
+        size_z=size_z,
+        size_c=size_c,
+        api_latency_ms=api_latency_ms,
+        s3_latency_ms=s3_latency_ms,
+        max_workers=max_workers,
+        n_passes=passes,
+        pipelined=pipelined,
+    )
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        workdir = workdir or Path(tmpdirname)
+        workdir.mkdir(parents=True, exist_ok=True)
+
+        fake_api = FakeBIAAPI(latency_seconds=config.api_latency_ms / 1000)
+        fake_s3 = FakeS3(latency_seconds=config.s3_latency_ms / 1000)
+        services = ServiceThread()
+        try:
+            api_url = services.start_app(fake_api.app)
+            s3_url = services.start_app(fake_s3.app)
+
+            objects, source_files = build_fixtures(config, f"{s3_url}/{BUCKET_NAME}")
+            for model_name, model_objects in objects.items():
+                for obj in model_objects:
+                    fake_api.add(model_name, obj)
+            for key, data in source_files.items():
+                fake_s3.objects[f"{BUCKET_NAME}/{key}"] = data
+
+            configure_environment(api_url, s3_url, workdir, write_stub_bioformats2raw(workdir), config)
+
+            from bia_integrator_api.models import ImageRepresentation # type: ignore
+            from .utils import collect_stage_timings
+
+            upload_reps = [ImageRepresentation.model_validate(obj) for obj in objects["image_representation"]]
+            rich.print(
+                f"Converting {config.n_images} images of {config.files_per_image} x {file_size_mb} MB files "
+                f"to {config.size_c}x{config.size_z}x{config.size_xy}x{config.size_xy}"
+            )
+
+            results = []
+            for n_pass in range(1, config.n_passes + 1):
+                fake_api.stats.reset()
+                fake_s3.stats.reset()
+                with collect_stage_timings() as timings:
+                    wall_seconds = run_pass(upload_reps, config.max_workers)
+                summary = summarise_timings(timings)
+                service_stats = {"API": fake_api.stats, "S3": fake_s3.stats}
+                print_pass_report(n_pass, wall_seconds, config.n_images, summary, service_stats)
+                results.append({
+                    "pass": n_pass,
+                    "wall_seconds": wall_seconds,
+                    "stages": summary,
+                    "services": {name: stats.as_dict() for name, stats in service_stats.items()},
+                })
+        finally:
+            services.stop()
+
+    if json_output:
+        json_output.write_text(json.dumps({"config": config.model_dump(), "passes": results}, indent=2))
+
+
+# We need at least two commands because otherwise Typer makes 'run' the default and arguments get weird
+@app.command()
+def info():
+    pass
+
+
+if __name__ == "__main__":
+    app()
@@ -1,5 +1,11 @@
+import queue
+import asyncio
 import logging
+import threading
+from typing import Callable, Iterable, Iterator, List, Literal, Optional
 
+import aiohttp
+from pydantic import BaseModel
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic.alias_generators import to_snake
 
@@ -9,18 +15,19 @@ from bia_integrator_api.util import get_client_private
 logger = logging.getLogger("objects")
 
 
-api_base_url = "https://wwwdev.ebi.ac.uk/bioimage-archive/api"
-
-
 class APIClientSettings(BaseSettings):
     model_config = SettingsConfigDict(env_file='.env', extra='allow')
 
     username: str = "test@example.com"
     password: str = "test"
+    api_base_url: str = "https://wwwdev.ebi.ac.uk/bioimage-archive/api"
+    api_max_concurrency: int = 16
 
 
 client_settings = APIClientSettings()
 
+api_base_url = client_settings.api_base_url
+
 api_client = get_client_private(
     username=client_settings.username,
     password=client_settings.password,
@@ -44,3 +51,196 @@ def store_object_in_api_idempotent(model_object):
     except api_exceptions.NotFoundException:
         logger.info(f"Storing {model_name} in API")
         post_func(model_object)
+
+
+def get_object_if_exists(model_class, uuid) -> Optional[BaseModel]:
+    """Get the object of the given model class with the given UUID from the API, or
+    None if there is no such object."""
+
+    get_func = getattr(api_client, 'get_' + to_snake(model_class.__name__))
+
+    try:
+        return get_func(str(uuid))
+    except api_exceptions.NotFoundException:
+        return None
+
+
+class StoreOutcome(BaseModel):
+    """Result of idempotently storing one object."""
+
+    uuid: str
+    model_name: str
+    status: Literal["exists", "created", "failed"]
+    error: Optional[str] = None
+
+
+async def _request_with_retries(session, method, url, max_attempts=3, **kwargs):
+    """Make a request, retrying on connection errors and server errors. Returns
+    (status, body text)."""
+
+    for attempt in range(1, max_attempts + 1):
+        try:
+            async with session.request(method, url, **kwargs) as response:
+                body = await response.text()
+                if response.status < 500 or attempt == max_attempts:
+                    return response.status, body
+        except aiohttp.ClientError:
+            if attempt == max_attempts:
+                raise
+        await asyncio.sleep(0.3 * 2 ** (attempt - 1))
+
+
+def _auth_headers(access_token: Optional[str]) -> dict:
+    if access_token is None:
+        access_token = api_client.api_client.configuration.access_token
+
+    return {"Authorization": f"Bearer {access_token}"} if access_token else {}
+
+
+async def _post_checked(session, base_url, model_object, model_name, model_name_snake, uuid, max_attempts=3) -> StoreOutcome:
+    """POST an object, without blindly retrying: a POST that failed may still have
+    been stored, so check with a GET before trying again."""
+
+    for attempt in range(1, max_attempts + 1):
+        try:
+            async with session.post(
+                f"{base_url}/v2/private/{model_name_snake}",
+                json=model_object.model_dump(mode="json", by_alias=True, exclude_none=True)
+            ) as response:
+                status, body = response.status, await response.text()
+            if status in (200, 201):
+                return StoreOutcome(uuid=uuid, model_name=model_name, status="created")
+            error = f"POST {status}: {body}"
+        except aiohttp.ClientError as e:
+            status, error = None, str(e)
+
+        get_status, _ = await _request_with_retries(session, "GET", f"{base_url}/v2/{model_name_snake}/{uuid}")
+        if get_status == 200:
+            return StoreOutcome(uuid=uuid, model_name=model_name, status="created")
+
+        # Only retry what might be transient, once we know the object isn't there
+        if get_status != 404 or (status is not None and status < 500) or attempt == max_attempts:
+            return StoreOutcome(uuid=uuid, model_name=model_name, status="failed", error=error)
+        logger.warning(f"Storing {model_name} {uuid} failed ({error}), retrying")
+        await asyncio.sleep(0.3 * 2 ** (attempt - 1))
+
+
+async def _store_one(session, semaphore, base_url, model_object) -> StoreOutcome:
+    model_name = model_object.__class__.__name__
+    model_name_snake = to_snake(model_name)
+    uuid = str(model_object.uuid)
+
+    async with semaphore:
+        try:
+            status, body = await _request_with_retries(
+                session, "GET", f"{base_url}/v2/{model_name_snake}/{uuid}"
+            )
+            if status == 200:
+                return StoreOutcome(uuid=uuid, model_name=model_name, status="exists")
+            if status != 404:
+                return StoreOutcome(uuid=uuid, model_name=model_name, status="failed", error=f"GET {status}: {body}")
+
+            logger.info(f"Storing {model_name} {uuid} in API")
+            return await _post_checked(session, base_url, model_object, model_name, model_name_snake, uuid)
+        except aiohttp.ClientError as e:
+            return StoreOutcome(uuid=uuid, model_name=model_name, status="failed", error=str(e))
+
+
+async def store_objects_in_api_idempotent_async(
+        model_objects: Iterable,
+        max_concurrency: Optional[int] = None,
+        base_url: Optional[str] = None,
+        access_token: Optional[str] = None
+    ) -> List[StoreOutcome]:
+    """Store many model objects in the API, skipping any that already exist.
+
+    Existence checks and POSTs run concurrently over a single pooled session, with
+    at most max_concurrency requests in flight. Returns one outcome per object, in
+    the order given. By default uses the base URL and access token of the shared
+    api_client."""
+
+    max_concurrency = max_concurrency or client_settings.api_max_concurrency
+    base_url = (base_url or api_base_url).rstrip("/")
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    connector = aiohttp.TCPConnector(limit=max_concurrency)
+
+    async with aiohttp.ClientSession(connector=connector, headers=_auth_headers(access_token)) as session:
+        outcomes = await asyncio.gather(*[
+            _store_one(session, semaphore, base_url, model_object)
+            for model_object in model_objects
+        ])
+
+    return list(outcomes)
+
+
+def store_objects_in_api_idempotent(model_objects: Iterable, **kwargs) -> List[StoreOutcome]:
+    """Blocking wrapper around store_objects_in_api_idempotent_async."""
+
+    outcomes = asyncio.run(store_objects_in_api_idempotent_async(model_objects, **kwargs))
+
+    n_failed = sum(outcome.status == "failed" for outcome in outcomes)
+    if n_failed:
+        logger.warning(f"Failed to store {n_failed} of {len(outcomes)} objects")
+
+    return outcomes
+
+
+async def fetch_objects_async(
+        model_class,
+        uuids: Iterable,
+        on_result: Callable,
+        max_concurrency: Optional[int] = None,
+        base_url: Optional[str] = None,
+        access_token: Optional[str] = None
+    ):
+    """GET many objects of one model type by UUID, with at most max_concurrency
+    requests in flight over a single pooled session. on_result is called with each
+    parsed object as soon as it arrives, so in completion order."""
+
+    max_concurrency = max_concurrency or client_settings.api_max_concurrency
+    base_url = (base_url or api_base_url).rstrip("/")
+    model_name_snake = to_snake(model_class.__name__)
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    connector = aiohttp.TCPConnector(limit=max_concurrency)
+
+    async def fetch_one(session, uuid):
+        async with semaphore:
+            status, body = await _request_with_retries(session, "GET", f"{base_url}/v2/{model_name_snake}/{uuid}")
+        if status != 200:
+            raise RuntimeError(f"GET {model_name_snake} {uuid} returned {status}: {body}")
+        on_result(model_class.model_validate_json(body))
+
+    async with aiohttp.ClientSession(connector=connector, headers=_auth_headers(access_token)) as session:
+        await asyncio.gather(*[fetch_one(session, uuid) for uuid in uuids])
+
+
+_FETCH_DONE = object()
+
+
+def iter_objects_by_uuid(model_class, uuids: Iterable, **kwargs) -> Iterator:
+    """Fetch objects concurrently (see fetch_objects_async) in a background thread,
+    yielding each as it arrives, so callers can start work before all are fetched."""
+
+    results: queue.Queue = queue.Queue()
+
+    def run():
+        try:
+            asyncio.run(fetch_objects_async(model_class, uuids, results.put, **kwargs))
+            results.put(_FETCH_DONE)
+        except Exception as e:
+            results.put(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    while True:
+        result = results.get()
+        if result is _FETCH_DONE:
+            break
+        if isinstance(result, Exception):
+            raise result
+        yield result
+
+    thread.join()
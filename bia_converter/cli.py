@@ -1,4 +1,5 @@
 import sys
+import json
 import logging
 from typing import Optional
 
@@ -9,6 +10,8 @@ from typing_extensions import Annotated
 from bia_integrator_api.models import ImageRepresentationUseType # type: ignore
 
 from .bia_api_client import api_client
+from .rendercache import get_render_cache
+from .planner import PlanState, plan_study_conversions, print_plan, run_plan
 from .convert import (
     convert_interactive_display_to_thumbnail,
     convert_interactive_display_to_static_display,
@@ -42,7 +45,8 @@ def info():
 def convert(
     image_rep_uuid: str,
     target_type: ImageRepresentationUseType,
-    conversion_config: Annotated[Optional[str], typer.Argument()] = "{}"
+    conversion_config: Annotated[Optional[str], typer.Argument()] = "{}",
+    force: Annotated[bool, typer.Option(help="Convert even if the target representation already exists")] = False
     ):
     logging.basicConfig(level=logging.INFO)
 
@@ -55,7 +59,52 @@ def convert(
         logger.error(f"Cannot convert from {image_rep.use_type} to {target_type}")
         sys.exit(2)
 
-    conversion_function(image_rep)
+    conversion_function(image_rep, json.loads(conversion_config or "{}"), force=force)
+
+
+@app.command()
+def plan(
+    accession_id: str,
+    replan: Annotated[bool, typer.Option(help="Add conversions for representations created since the last plan")] = False
+):
+    """Plan the conversions needed for a study, and record them in its state file."""
+    logging.basicConfig(level=logging.INFO)
+
+    state = PlanState.for_accession(accession_id)
+    if replan or not state.load():
+        state.add(plan_study_conversions(accession_id, SUPPORTED_CONVERSIONS))
+
+    print_plan(list(state.load().values()))
+    rich.print(f"State recorded in {state.fpath}")
+
+
+@app.command()
+def run(
+    accession_id: str,
+    max_workers: Annotated[int, typer.Option(help="Number of conversions to run at once")] = 4,
+    force: Annotated[bool, typer.Option(help="Convert even if target representations already exist")] = False
+):
+    """Run the planned conversions for a study, planning them first if needed.
+    Reruns resume from the state file."""
+    logging.basicConfig(level=logging.INFO)
+
+    state = PlanState.for_accession(accession_id)
+    if not state.load():
+        state.add(plan_study_conversions(accession_id, SUPPORTED_CONVERSIONS))
+
+    run_plan(state, SUPPORTED_CONVERSIONS, max_workers=max_workers, force=force)
+
+
+
+@app.command()
+def purge_render_cache():
+    """Remove all cached renders. Needed when chunk data of a source was rewritten
+    in place without changing its metadata, which the cache cannot detect."""
+    logging.basicConfig(level=logging.INFO)
+
+    render_cache = get_render_cache()
+    n_removed = render_cache.purge()
+    rich.print(f"Removed {n_removed} cached renders from {render_cache.dirpath}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,215 @@
+"""Chunk compression settings for the Zarr arrays we write.
+
+Supports fixed codecs (blosc with lz4 or zstd, or zstd alone) and an 'auto'
+mode, which benchmarks a set of candidate codecs on chunks sampled from the
+source array and picks one according to a stated objective.
+"""
+import math
+import time
+import random
+import logging
+from typing import Dict, List, Literal, Optional
+
+import rich
+import numpy as np
+import numcodecs # type: ignore
+from pydantic import BaseModel, Field
+
+
+logger = logging.getLogger(__name__)
+
+
+BLOSC_SHUFFLE_MODES = {
+    "noshuffle": 0,
+    "shuffle": 1,
+    "bitshuffle": 2,
+    # Bit shuffle for 1 byte types, byte shuffle otherwise
+    "autoshuffle": -1
+}
+
+
+class CodecConfig(BaseModel):
+    """Compression settings for output chunks. The defaults are tensorstore's own
+    default for zarr arrays (blosc lz4 level 5, autoshuffle), as written before
+    compression was configurable."""
+
+    id: Literal["blosc", "zstd", "auto"] = Field(
+        default="blosc",
+        description="Codec to use, or 'auto' to benchmark candidates on sampled source chunks"
+    )
+    cname: Literal["lz4", "zstd"] = Field(
+        default="lz4",
+        description="Compressor used inside blosc"
+    )
+    clevel: int = Field(
+        default=5,
+        description="Compression level (blosc: 0-9, zstd: 1-22)"
+    )
+    shuffle: Literal["noshuffle", "shuffle", "bitshuffle", "autoshuffle"] = Field(
+        default="autoshuffle",
+        description="Blosc shuffle mode"
+    )
+    objective: Literal["size", "throughput"] = Field(
+        default="size",
+        description="For 'auto': minimise stored bytes, or maximise encode/decode throughput"
+    )
+    n_sample_chunks: int = Field(
+        default=200,
+        description="For 'auto': number of chunks to sample from the source"
+    )
+    min_encode_mb_per_s: float = Field(
+        default=50.0,
+        description="For 'auto': reject codecs that encode slower than this"
+    )
+    min_decode_mb_per_s: float = Field(
+        default=200.0,
+        description="For 'auto': reject codecs that decode slower than this"
+    )
+
+
+class CodecBenchmark(BaseModel):
+    compressor: Dict
+    ratio: float
+    encode_mb_per_s: float
+    decode_mb_per_s: float
+
+
+def compressor_spec(codec_config: CodecConfig) -> Dict:
+    """Return the Zarr v2 compressor metadata for a fixed codec configuration."""
+
+    if codec_config.id == "blosc":
+        return {
+            "id": "blosc",
+            "cname": codec_config.cname,
+            "clevel": codec_config.clevel,
+            "shuffle": BLOSC_SHUFFLE_MODES[codec_config.shuffle],
+            "blocksize": 0
+        }
+    elif codec_config.id == "zstd":
+        return {
+            "id": "zstd",
+            "level": codec_config.clevel
+        }
+    else:
+        raise ValueError(f"Codec {codec_config.id} does not have a fixed compressor spec")
+
+
+def candidate_compressor_specs() -> List[Dict]:
+    """The codecs tried in 'auto' mode."""
+
+    candidates = []
+    for shuffle in (BLOSC_SHUFFLE_MODES[mode] for mode in ("noshuffle", "shuffle", "bitshuffle")):
+        candidates.append({"id": "blosc", "cname": "lz4", "clevel": 5, "shuffle": shuffle, "blocksize": 0})
+        for clevel in (3, 5, 9):
+            candidates.append({"id": "blosc", "cname": "zstd", "clevel": clevel, "shuffle": shuffle, "blocksize": 0})
+    for level in (3, 9, 19):
+        candidates.append({"id": "zstd", "level": level})
+
+    return candidates
+
+
+def sample_chunks(source_array, chunk_shape: List[int], n_samples: int, seed: int = 0) -> List[np.ndarray]:
+    """Read up to n_samples chunk-aligned regions of chunk_shape from a tensorstore
+    array. All reads are issued together, so remote sources are fetched concurrently."""
+
+    n_chunks = [math.ceil(s / c) for s, c in zip(source_array.shape, chunk_shape)]
+    total_chunks = math.prod(n_chunks)
+
+    rng = random.Random(seed)
+    flat_indices = rng.sample(range(total_chunks), min(n_samples, total_chunks))
+
+    futures = []
+    for flat_index in flat_indices:
+        idx = np.unravel_index(flat_index, n_chunks)
+        slices = tuple(
+            slice(i * c, min((i + 1) * c, s))
+            for i, c, s in zip(idx, chunk_shape, source_array.shape)
+        )
+        futures.append(source_array[slices].read())
+
+    return [future.result() for future in futures]
+
+
+def benchmark_compressor(compressor: Dict, samples: List[np.ndarray]) -> CodecBenchmark:
+    """Measure compression ratio and encode/decode throughput of one codec on the samples."""
+
+    codec = numcodecs.get_codec(compressor)
+    raw_bytes = sum(sample.nbytes for sample in samples)
+
+    start = time.perf_counter()
+    encoded = [codec.encode(np.ascontiguousarray(sample)) for sample in samples]
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for buf in encoded:
+        codec.decode(buf)
+    decode_time = time.perf_counter() - start
+
+    encoded_bytes = sum(len(buf) for buf in encoded)
+    mb = raw_bytes / 1e6
+
+    return CodecBenchmark(
+        compressor=compressor,
+        ratio=raw_bytes / max(encoded_bytes, 1),
+        encode_mb_per_s=mb / max(encode_time, 1e-9),
+        decode_mb_per_s=mb / max(decode_time, 1e-9)
+    )
+
+
+def choose_compressor(benchmarks: List[CodecBenchmark], codec_config: CodecConfig) -> CodecBenchmark:
+    """Pick a codec from benchmark results according to the configured objective.
+
+    Codecs that miss the minimum encode or decode throughput are only considered
+    if no codec meets them."""
+
+    acceptable = [
+        b for b in benchmarks
+        if b.encode_mb_per_s >= codec_config.min_encode_mb_per_s
+        and b.decode_mb_per_s >= codec_config.min_decode_mb_per_s
+    ]
+    if not acceptable:
+        logger.warning("No codec met the throughput limits, choosing from all candidates")
+        acceptable = benchmarks
+
+    if codec_config.objective == "size":
+        return max(acceptable, key=lambda b: b.ratio)
+    else:
+        return max(acceptable, key=lambda b: min(b.encode_mb_per_s, b.decode_mb_per_s))
+
+
+def auto_select_compressor(source_array, chunk_shape: List[int], codec_config: CodecConfig) -> Dict:
+    """Benchmark candidate codecs on chunks sampled from source_array, and return the
+    compressor spec of the one chosen."""
+
+    samples = sample_chunks(source_array, chunk_shape, codec_config.n_sample_chunks)
+    benchmarks = [
+        benchmark_compressor(compressor, samples)
+        for compressor in candidate_compressor_specs()
+    ]
+
+    for b in sorted(benchmarks, key=lambda b: b.ratio, reverse=True):
+        rich.print(
+            f"{b.compressor} | ratio {b.ratio:.2f} | "
+            f"encode {b.encode_mb_per_s:.0f} MB/s | decode {b.decode_mb_per_s:.0f} MB/s"
+        )
+
+    chosen = choose_compressor(benchmarks, codec_config)
+    logger.info(f"Chose compressor {chosen.compressor} for objective '{codec_config.objective}'")
+
+    return chosen.compressor
+
+
+def resolve_compressor(
+        codec_config: CodecConfig,
+        source_array=None,
+        chunk_shape: Optional[List[int]] = None
+    ) -> Dict:
+    """Turn a codec configuration into the compressor spec to write. The 'auto' codec
+    needs the source array and output chunk shape, to sample from."""
+
+    if codec_config.id == "auto":
+        if source_array is None or chunk_shape is None:
+            raise ValueError("Codec 'auto' needs a source array and chunk shape to sample from")
+        return auto_select_compressor(source_array, chunk_shape, codec_config)
+
+    return compressor_spec(codec_config)
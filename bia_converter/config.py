@@ -13,5 +13,11 @@ class Settings(BaseSettings):
     cache_root_dirpath: Path = Path.home()/".cache"/"bia-converter"
     bioformats2raw_java_home: str
     bioformats2raw_bin: str
+    upload_max_workers: int = 32
+    staging_max_workers: int = 8
+    pipelined_conversion: bool = False
+    pipeline_poll_interval_seconds: float = 30.0
+    pipeline_settle_seconds: float = 60.0
+    render_cache_max_bytes: int = 1024 * 1024 * 1024
 
 settings = Settings()
\ No newline at end of file
@@ -1,3 +1,4 @@
+import shutil
 import logging
 import subprocess
 
@@ -6,15 +7,34 @@ from .config import settings
 logger = logging.getLogger(__name__)
 
 
+def zarr_conversion_command(input_fpath, output_dirpath) -> str:
+
+    return f'export JAVA_HOME={settings.bioformats2raw_java_home} && {settings.bioformats2raw_bin} "{input_fpath}" "{output_dirpath}"'
+
+
+def start_zarr_conversion(input_fpath, output_dirpath, log_fh) -> subprocess.Popen:
+    """Start converting the local file at input_fpath to Zarr format without waiting for
+    it to finish. Output from the converter is written to log_fh."""
+
+    zarr_cmd = zarr_conversion_command(input_fpath, output_dirpath)
+
+    logger.info(f"Starting conversion with {zarr_cmd}")
+
+    return subprocess.Popen(zarr_cmd, shell=True, stdout=log_fh, stderr=subprocess.STDOUT)
+
+
 def run_zarr_conversion(input_fpath, output_dirpath):
     """Convert the local file at input_fpath to Zarr format, in a directory specified by
     output_dirpath"""
 
-    zarr_cmd = f'export JAVA_HOME={settings.bioformats2raw_java_home} && {settings.bioformats2raw_bin} "{input_fpath}" "{output_dirpath}"'
+    zarr_cmd = zarr_conversion_command(input_fpath, output_dirpath)
 
     logger.info(f"Converting with {zarr_cmd}")
 
     retval = subprocess.run(zarr_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if retval.returncode != 0:
+        # Don't leave partial output that a rerun would take as finished
+        shutil.rmtree(output_dirpath, ignore_errors=True)
     assert retval.returncode == 0, f"Error converting to zarr: {retval.stderr.decode('utf-8')}"
 
 
@@ -2,10 +2,12 @@ import shutil
 import logging
 import zipfile
 import tempfile
+from uuid import UUID, uuid5
 from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
 
 import rich
-import parse # type: ignore
 from bia_integrator_api.models import ( # type: ignore
     ImageRepresentation, ImageRepresentationUseType, FileReference
 )
@@ -14,13 +16,30 @@ from bia_shared_datamodels.uuid_creation import ( # type: ignore
 )
 
 from .config import settings
-from .io import copy_local_to_s3, stage_fileref_and_get_fpath, sync_dirpath_to_s3
+from .io import (
+    prefetch_zip_members,
+    put_bytes_to_s3,
+    s3_object_exists,
+    stage_fileref_and_get_fpath,
+    upload_dirpath_to_s3
+)
 from .conversion import run_zarr_conversion
-from .bia_api_client import api_client, store_object_in_api_idempotent
+from .pipeline import stage_filerefs_concurrently, run_zarr_conversion_with_incremental_upload
+from .filepattern import index_file_references, check_fileset_index
+from .bia_api_client import (
+    api_client,
+    get_object_if_exists,
+    iter_objects_by_uuid,
+    store_object_in_api_idempotent,
+    store_objects_in_api_idempotent
+)
 from .rendering import generate_padded_thumbnail_from_ngff_uri
+from .encoding import EncodingSettings, CONTENT_TYPES, FORMAT_EXTENSIONS, encode_image
+from .rendercache import get_or_render
 from .utils import (
     create_s3_uri_suffix_for_image_representation,
-    attributes_by_name, get_dir_size
+    attributes_by_name,
+    timed_stage
 )
 
 
@@ -47,97 +66,185 @@ def create_image_representation_object(image, image_format, use_type):
     return image_rep
 
 
-def create_2d_image_and_upload_to_s3(ome_zarr_uri, dims, dst_key):
-    im = generate_padded_thumbnail_from_ngff_uri(ome_zarr_uri, dims)
+def find_existing_conversion(
+        image_rep: ImageRepresentation,
+        conversion_parameters: Optional[dict] = None,
+        compared_fields: Tuple[str, ...] = ()
+    ) -> Optional[ImageRepresentation]:
+    """Pre-flight check, before any data is moved: return the stored representation
+    if one with this (deterministic) UUID is already in the API and its data is at
+    the expected S3 key. For Zarr representations the key checked is the group
+    metadata.
+
+    The UUID only covers the image, format and use type. Fields in compared_fields
+    are checked against the stored representation, and a warning logged if the
+    existing output differs or the conversion parameters could not be checked."""
+
+    existing_rep = get_object_if_exists(ImageRepresentation, image_rep.uuid)
+    if existing_rep is None:
+        return None
+
+    dst_key = create_s3_uri_suffix_for_image_representation(image_rep)
+    if ".zarr" in image_rep.image_format:
+        dst_key = f"{dst_key}/.zattrs"
+    if not s3_object_exists(dst_key):
+        logger.warning(f"Representation {image_rep.uuid} is in the API, but {dst_key} is missing, converting again")
+        return None
+
+    differences = {
+        field: (getattr(existing_rep, field, None), getattr(image_rep, field, None))
+        for field in compared_fields
+        if getattr(existing_rep, field, None) != getattr(image_rep, field, None)
+    }
+    if differences:
+        logger.warning(
+            f"Representation {image_rep.uuid} already exists with different parameters "
+            f"(existing, requested): {differences}. Keeping it, use --force to convert again"
+        )
+    elif conversion_parameters:
+        logger.warning(
+            f"Representation {image_rep.uuid} already exists, conversion parameters {conversion_parameters} "
+            f"were not applied. Use --force to convert again with them"
+        )
+    else:
+        logger.info(f"Representation {image_rep.uuid} already exists, skipping conversion (use force to convert again)")
+
+    return existing_rep
+
+
+def create_2d_image_and_upload_to_s3(ome_zarr_uri, dims, dst_key, encoding_settings=None):
+    encoding_settings = encoding_settings or EncodingSettings()
+
+    def render() -> bytes:
+        im = generate_padded_thumbnail_from_ngff_uri(ome_zarr_uri, dims)
+        encoded = encode_image(im, encoding_settings)
+        logger.info(f"Encoded {encoded.format} image ({len(encoded.data)} bytes, quality {encoded.quality})")
+        return encoded.data
+
+    # Everything that affects the output, so an unchanged image is not rendered again
+    render_params = {
+        "kind": "padded_thumbnail",
+        "dims": list(dims),
+        "t": None,
+        "z": None,
+        "channels": None,
+        "csettings": None,
+        "mode": None,
+        "autocontrast": True,
+        "encoding": encoding_settings.model_dump(),
+    }
+    with timed_stage("render") as timing:
+        data = get_or_render(ome_zarr_uri, render_params, render)
+        timing.n_bytes = len(data)
 
-    with tempfile.NamedTemporaryFile(suffix=".png") as fh:
-        im.save(fh)
-        file_uri = copy_local_to_s3(Path(fh.name), dst_key)
-        logger.info(f"Wrote thumbnail to {file_uri}")
-        size_in_bytes = Path(fh.name).stat().st_size
+    with timed_stage("upload") as timing:
+        file_uri = put_bytes_to_s3(data, dst_key, CONTENT_TYPES[encoding_settings.format])
+        timing.n_bytes = len(data)
+    logger.info(f"Wrote 2D image to {file_uri}")
 
-    return file_uri, size_in_bytes
+    return file_uri, len(data)
 
 
-def convert_interactive_display_to_thumbnail(input_image_rep: ImageRepresentation) -> ImageRepresentation:
-    # Should convert an INTERACTIVE_DISPLAY rep, to a THUMBNAIL rep
+DEFAULT_2D_DIMS = {
+    ImageRepresentationUseType.THUMBNAIL: (256, 256),
+    ImageRepresentationUseType.STATIC_DISPLAY: (512, 512),
+}
+
+
+def convert_interactive_display_to_2d(
+        input_image_rep: ImageRepresentation,
+        use_type: ImageRepresentationUseType,
+        conversion_parameters: dict = {},
+        force: bool = False
+    ) -> ImageRepresentation:
+    """Render an INTERACTIVE_DISPLAY rep to a 2D image rep of the given use type.
+
+    conversion_parameters may set "dims" ([w, h]) and "encoding" (EncodingSettings
+    fields, e.g. {"format": "webp", "lossless": false, "max_bytes": 20000}).
+    Unless force is set, an existing output is returned without converting."""
 
-    dims = (256, 256)
-    # Check the image rep
     assert input_image_rep.use_type == ImageRepresentationUseType.INTERACTIVE_DISPLAY
 
+    dims: Tuple[int, int] = tuple(conversion_parameters.get("dims", DEFAULT_2D_DIMS[use_type])) # type: ignore
+    encoding_settings = EncodingSettings(**conversion_parameters.get("encoding", {}))
+
     # Retrieve model ibjects
     input_image = api_client.get_image(input_image_rep.representation_of_uuid)
 
-    base_image_rep = create_image_representation_object(input_image, ".png", "THUMBNAIL")
+    base_image_rep = create_image_representation_object(
+        input_image, FORMAT_EXTENSIONS[encoding_settings.format], use_type.value
+    )
     w, h = dims
     base_image_rep.size_x = w
     base_image_rep.size_y = h
 
+    if not force:
+        with timed_stage("preflight"):
+            existing_rep = find_existing_conversion(
+                base_image_rep, conversion_parameters, compared_fields=("size_x", "size_y")
+            )
+        if existing_rep is not None:
+            return existing_rep
+
     dst_key = create_s3_uri_suffix_for_image_representation(base_image_rep)
-    file_uri, size_in_bytes = create_2d_image_and_upload_to_s3(input_image_rep.file_uri[0], dims, dst_key)
+    file_uri, size_in_bytes = create_2d_image_and_upload_to_s3(
+        input_image_rep.file_uri[0], dims, dst_key, encoding_settings
+    )
 
     base_image_rep.file_uri = [file_uri]
     base_image_rep.total_size_in_bytes = size_in_bytes
 
-    store_object_in_api_idempotent(base_image_rep)
+    with timed_stage("store"):
+        store_object_in_api_idempotent(base_image_rep)
 
     return base_image_rep
 
 
-# TODO - should be able to merge these
-def convert_interactive_display_to_static_display(input_image_rep: ImageRepresentation) -> ImageRepresentation:
-    # Should convert an INTERACTIVE_DISPLAY rep, to a STATIC_DISPLAY rep
+def convert_interactive_display_to_thumbnail(
+        input_image_rep: ImageRepresentation,
+        conversion_parameters: dict = {},
+        force: bool = False
+    ) -> ImageRepresentation:
+    # Should convert an INTERACTIVE_DISPLAY rep, to a THUMBNAIL rep
 
-    dims = (512, 512)
-    # Check the image rep
-    assert input_image_rep.use_type == ImageRepresentationUseType.INTERACTIVE_DISPLAY
+    return convert_interactive_display_to_2d(input_image_rep, ImageRepresentationUseType.THUMBNAIL, conversion_parameters, force)
 
-    # Retrieve model ibjects
-    input_image = api_client.get_image(input_image_rep.representation_of_uuid)
 
-    base_image_rep = create_image_representation_object(input_image, ".png", "STATIC_DISPLAY")
-    w, h = dims
-    base_image_rep.size_x = w
-    base_image_rep.size_y = h
-
-    dst_key = create_s3_uri_suffix_for_image_representation(base_image_rep)
-    file_uri, size_in_bytes = create_2d_image_and_upload_to_s3(input_image_rep.file_uri[0], dims, dst_key)
+def convert_interactive_display_to_static_display(
+        input_image_rep: ImageRepresentation,
+        conversion_parameters: dict = {},
+        force: bool = False
+    ) -> ImageRepresentation:
+    # Should convert an INTERACTIVE_DISPLAY rep, to a STATIC_DISPLAY rep
 
-    base_image_rep.file_uri = [file_uri]
-    base_image_rep.total_size_in_bytes = size_in_bytes
+    return convert_interactive_display_to_2d(input_image_rep, ImageRepresentationUseType.STATIC_DISPLAY, conversion_parameters, force)
 
-    store_object_in_api_idempotent(base_image_rep)
 
-    return base_image_rep
+def iter_file_references_for_image(image) -> Iterator[FileReference]:
+    """Yield the image's file references as they are fetched (concurrently, in no
+    particular order). Once all have been fetched they are cached locally, and
+    later calls read the cache."""
 
+    cache_fpath = settings.cache_root_dirpath/"filerefs"/f"{image.uuid}.jsonl"
+    if cache_fpath.exists():
+        with open(cache_fpath) as fh:
+            for line in fh:
+                yield FileReference.model_validate_json(line)
+        return
 
-def get_all_file_references_for_image(image):
     file_references = []
-    for fr_uuid in image.original_file_reference_uuid:
-        fr = api_client.get_file_reference(fr_uuid)
-        file_references.append(fr)
-
-    return file_references
-
-
-def fileref_map_to_bfconvert_pattern(fileref_map, ext):
-    """Determine the pattern needed to enable bioformats to load the components
-    of a structured fileset, e.g. for conversion."""
-
-    all_positions = list(fileref_map.values())
-    tvals, cvals, zvals = zip(*all_positions)
+    for fileref in iter_objects_by_uuid(FileReference, image.original_file_reference_uuid):
+        file_references.append(fileref)
+        yield fileref
 
-    zmin = min(zvals)
-    zmax = max(zvals)
-    cmin = min(cvals)
-    cmax = max(cvals)
-    tmin = min(tvals)
-    tmax = max(tvals)
+    cache_fpath.parent.mkdir(exist_ok=True, parents=True)
+    tmp_fpath = cache_fpath.with_suffix(".tmp")
+    tmp_fpath.write_text(''.join(fileref.model_dump_json() + "\n" for fileref in file_references))
+    tmp_fpath.rename(cache_fpath)
 
-    pattern = f"T<{tmin:04d}-{tmax:04d}>_C<{cmin:04d}-{cmax:04d}>_Z<{zmin:04d}-{zmax:04d}>{ext}"
 
-    return pattern
+def get_all_file_references_for_image(image):
+    return list(iter_file_references_for_image(image))
 
 
 def find_file_references_matching_template(file_references, parse_template):
@@ -164,18 +271,9 @@ def find_file_references_matching_template(file_references, parse_template):
         # coord_map[ref.uuid] = (2, 3, 1)  # (t, c, z)
     """
 
-    fileref_map = {}
-    selected_filerefs = []
-    for fileref in file_references:
-        result = parse.parse(parse_template, fileref.file_path)
-        if result:
-            z = result.named.get('z', 0)
-            c = result.named.get('c', 0)
-            t = result.named.get('t', 0)
-            fileref_map[fileref.uuid] = (t, c, z)
-            selected_filerefs.append(fileref)
+    fileset_index = index_file_references(file_references, parse_template)
 
-    return selected_filerefs, fileref_map
+    return fileset_index.file_references, fileset_index.coords_map()
 
 
 def get_shared_extension(filerefs):
@@ -189,25 +287,34 @@ def get_shared_extension(filerefs):
     return extension
 
 
-def stage_and_link_filerefs(tmpdirname, file_references, fileref_coords_map, bfconvert_pattern):
+def stage_and_link_filerefs(tmpdirname, file_references, fileref_coords_map, bfconvert_pattern, concurrent=False):
     """Stage necessary file references to a temporary directory, and symlink them so
-    they can be converted with a single command."""
+    they can be converted with a single command. If concurrent is set, downloads run
+    in parallel and each file is linked as soon as it is staged."""
 
     tmpdir_path = Path(tmpdirname)
 
     file_references_by_uuid = {fr.uuid: fr for fr in file_references}
-    for fileref_id, position in fileref_coords_map.items():
-        t, c, z = position
-        label = "T{t:04d}_C{c:04d}_Z{z:04d}".format(z=z, c=c, t=t)
+    filerefs_to_stage = [file_references_by_uuid[fileref_id] for fileref_id in fileref_coords_map]
+    # Members of remote zips are fetched together, by archive, ahead of staging
+    prefetch_zip_members(filerefs_to_stage)
+    if concurrent:
+        staged = stage_filerefs_concurrently(filerefs_to_stage)
+    else:
+        staged = ((fileref, stage_fileref_and_get_fpath(fileref)) for fileref in filerefs_to_stage)
 
-        fileref = file_references_by_uuid[fileref_id]
-        input_fpath = stage_fileref_and_get_fpath(fileref)
+    with timed_stage("stage_files") as timing:
+        timing.n_bytes = 0
+        for fileref, input_fpath in staged:
+            t, c, z = fileref_coords_map[fileref.uuid]
+            label = "T{t:04d}_C{c:04d}_Z{z:04d}".format(z=z, c=c, t=t)
 
-        suffix = input_fpath.suffix
+            suffix = input_fpath.suffix
 
-        target_path = tmpdir_path/(label+suffix)
-        logger.info(f"Linking {input_fpath} as {target_path}")   
-        target_path.symlink_to(input_fpath)
+            target_path = tmpdir_path/(label+suffix)
+            logger.info(f"Linking {input_fpath} as {target_path}")   
+            target_path.symlink_to(input_fpath)
+            timing.n_bytes += input_fpath.stat().st_size
 
     pattern_fpath = tmpdir_path / "conversion.pattern"
     pattern_fpath.write_text(bfconvert_pattern)
@@ -244,6 +351,44 @@ def get_dimensions_dict_from_zarr(ome_zarr_image_uri):
     return update_dict
 
 
+def get_bioformats2raw_series_keys(zarr_dirpath: Path) -> List[str]:
+    """bioformats2raw writes each series as a numbered image group under the top
+    level group. Take the series from the OME/.zattrs listing if there is one,
+    otherwise from the numbered groups present."""
+    import zarr
+
+    group = zarr.open_group(zarr_dirpath, mode='r')
+    if 'OME' in group and 'series' in group['OME'].attrs:
+        return [str(key) for key in group['OME'].attrs['series']]
+
+    return sorted((key for key in group.group_keys() if key.isdigit()), key=int)
+
+
+def create_series_image_representation(base_image_rep: ImageRepresentation, series_key: str) -> ImageRepresentation:
+    """The representation of one series of a multi-series conversion. The first
+    series keeps the base representation's UUID, so single series images are
+    registered as before."""
+
+    series_image_rep = base_image_rep.model_copy(deep=True)
+    if series_key != '0':
+        series_image_rep.uuid = str(uuid5(UUID(str(base_image_rep.uuid)), f"series/{series_key}"))
+
+    return series_image_rep
+
+
+def describe_series(base_image_rep, zarr_group_uri, series_key, size_in_bytes) -> ImageRepresentation:
+    """Create the representation for one uploaded series, reading its dimensions
+    from the uploaded OME-Zarr (which also checks it is readable)."""
+
+    series_image_rep = create_series_image_representation(base_image_rep, series_key)
+    ome_zarr_uri = f"{zarr_group_uri}/{series_key}"
+    series_image_rep.file_uri = [ome_zarr_uri]
+    series_image_rep.total_size_in_bytes = size_in_bytes
+    series_image_rep.__dict__.update(get_dimensions_dict_from_zarr(ome_zarr_uri))
+
+    return series_image_rep
+
+
 def check_if_path_contains_zarr_group(dirpath: Path) -> bool:
     import zarr
 
@@ -281,7 +426,9 @@ def fetch_ome_zarr_zip_fileref_and_unzip(
         return unpacked_zarr_dirpath
 
     # Get the file path from the file reference
-    zip_path = stage_fileref_and_get_fpath(file_reference)
+    with timed_stage("stage_files") as timing:
+        zip_path = stage_fileref_and_get_fpath(file_reference)
+        timing.n_bytes = zip_path.stat().st_size
     
     # Create a temporary directory to extract to
     temp_dir = Path(tempfile.mkdtemp())
@@ -307,87 +454,146 @@ def fetch_ome_zarr_zip_fileref_and_unzip(
     return unpacked_zarr_dirpath
 
 
-def convert_with_bioformats2raw_single_fileref(fileref, base_image_rep):
+def run_zarr_conversion_maybe_pipelined(conversion_input_fpath, output_zarr_fpath, upload_suffix=None):
+    """Run the conversion. If an upload suffix is given, output is uploaded there
+    as it is written."""
+
+    with timed_stage("bioformats2raw"):
+        if upload_suffix is None:
+            run_zarr_conversion(conversion_input_fpath, output_zarr_fpath)
+        else:
+            run_zarr_conversion_with_incremental_upload(conversion_input_fpath, output_zarr_fpath, upload_suffix)
 
-    conversion_input_fpath = stage_fileref_and_get_fpath(fileref)
+
+def convert_with_bioformats2raw_single_fileref(fileref, base_image_rep, upload_suffix=None):
+
+    with timed_stage("stage_files") as timing:
+        conversion_input_fpath = stage_fileref_and_get_fpath(fileref)
+        timing.n_bytes = conversion_input_fpath.stat().st_size
     output_zarr_fpath = get_conversion_output_path(base_image_rep.uuid)
     logger.info(f"Converting from {conversion_input_fpath} to {output_zarr_fpath}")
     if not output_zarr_fpath.exists():
-        run_zarr_conversion(conversion_input_fpath, output_zarr_fpath)
+        run_zarr_conversion_maybe_pipelined(conversion_input_fpath, output_zarr_fpath, upload_suffix)
 
     return output_zarr_fpath
 
 
-def convert_with_bioformats2raw(input_image_rep, file_references, base_image_rep):
+def convert_with_bioformats2raw(input_image_rep, file_references, base_image_rep, upload_suffix=None, n_file_references=None):
+    """Convert the file references to a Zarr with bioformats2raw. If upload_suffix is
+    given, the conversion runs pipelined: staging is concurrent, and output is
+    uploaded to that suffix while it is being written.
+
+    file_references may be an iterator (e.g. of references still being fetched),
+    in which case n_file_references must be given."""
+
+    if n_file_references is None:
+        n_file_references = len(file_references)
 
-    if len(file_references) == 1:
-        file_reference = file_references[0]
-        output_zarr_fpath = convert_with_bioformats2raw_single_fileref(file_reference, base_image_rep)
-    elif len(file_references > 1):
-        output_zarr_fpath = convert_with_bioformats2raw_pattern(input_image_rep, file_references, base_image_rep)
+    if n_file_references == 1:
+        # Consume the iterator fully, so the file reference cache is written
+        [file_reference] = list(file_references)
+        output_zarr_fpath = convert_with_bioformats2raw_single_fileref(file_reference, base_image_rep, upload_suffix)
+    elif n_file_references > 1:
+        output_zarr_fpath = convert_with_bioformats2raw_pattern(input_image_rep, file_references, base_image_rep, upload_suffix)
     else:
         raise ValueError("Can't convert with 0 file references!")
     
     return output_zarr_fpath
     
 
-def convert_with_bioformats2raw_pattern(input_image_rep, file_references, base_image_rep):
+def convert_with_bioformats2raw_pattern(input_image_rep, file_references, base_image_rep, upload_suffix=None):
     attrs = attributes_by_name(input_image_rep)
     parse_template = attrs['file_pattern']['file_pattern']
-    selected_filerefs, fileref_coords_map = find_file_references_matching_template(file_references, parse_template)
+    fileset_index = index_file_references(file_references, parse_template)
+    check_fileset_index(fileset_index)
+    selected_filerefs = fileset_index.file_references
+    fileref_coords_map = fileset_index.coords_map()
     extension = get_shared_extension(selected_filerefs)
-    bfconvert_pattern = fileref_map_to_bfconvert_pattern(fileref_coords_map, extension)
+    bfconvert_pattern = fileset_index.bfconvert_pattern(extension)
     logger.info(f"Convert with: {bfconvert_pattern}")
 
     # Fetch the file references to local cache, and link them in the correct structure for conversion
     with tempfile.TemporaryDirectory() as tmpdirname:
-        conversion_input_fpath = stage_and_link_filerefs(tmpdirname, selected_filerefs, fileref_coords_map, bfconvert_pattern)
+        conversion_input_fpath = stage_and_link_filerefs(
+            tmpdirname, selected_filerefs, fileref_coords_map, bfconvert_pattern,
+            concurrent=upload_suffix is not None
+        )
 
         # Run the conversion if we need to
         output_zarr_fpath = get_conversion_output_path(base_image_rep.uuid)
         logger.info(f"Converting from {conversion_input_fpath} to {output_zarr_fpath}")
         if not output_zarr_fpath.exists():
-            run_zarr_conversion(conversion_input_fpath, output_zarr_fpath)
+            run_zarr_conversion_maybe_pipelined(conversion_input_fpath, output_zarr_fpath, upload_suffix)
 
     return output_zarr_fpath
 
 
 def convert_uploaded_by_submitter_to_interactive_display(
         input_image_rep: ImageRepresentation,
-        conversion_parameters: dict = {}
+        conversion_parameters: dict = {},
+        force: bool = False
     ) -> ImageRepresentation:
-    # Should convert an UPLOADED_BY_SUBMITTER rep, to an INTERACTIVE_DISPLAY rep
+    # Should convert an UPLOADED_BY_SUBMITTER rep, to an INTERACTIVE_DISPLAY rep.
+    # Every series in the converted output is registered as its own representation,
+    # the one for the first series is returned. Unless force is set, an existing
+    # output is returned without converting
 
     assert input_image_rep.use_type == ImageRepresentationUseType.UPLOADED_BY_SUBMITTER
 
     image = api_client.get_image(input_image_rep.representation_of_uuid)
     base_image_rep = create_image_representation_object(image, ".ome.zarr", "INTERACTIVE_DISPLAY")
 
-    # Get the file references we'll need
-    file_references = get_all_file_references_for_image(image)
+    if not force:
+        with timed_stage("preflight"):
+            existing_rep = find_existing_conversion(base_image_rep)
+        if existing_rep is not None:
+            return existing_rep
+
+    # Get the file references we'll need, these are matched against any file pattern as they arrive
+    file_references = iter_file_references_for_image(image)
+    dst_suffix = create_s3_uri_suffix_for_image_representation(base_image_rep)
+    pipelined = conversion_parameters.get("pipelined", settings.pipelined_conversion)
 
     if input_image_rep.image_format == ".ome.zarr.zip":
+        file_references = list(file_references)
         assert len(file_references) == 1
         output_zarr_fpath = fetch_ome_zarr_zip_fileref_and_unzip(file_references[0], base_image_rep)
     else:
-        output_zarr_fpath = convert_with_bioformats2raw(input_image_rep, file_references, base_image_rep)
+        output_zarr_fpath = convert_with_bioformats2raw(
+            input_image_rep, file_references, base_image_rep,
+            upload_suffix=dst_suffix if pipelined else None,
+            n_file_references=len(image.original_file_reference_uuid)
+        )
 
-    # Upload to S3
-    dst_suffix = create_s3_uri_suffix_for_image_representation(base_image_rep)
-    zarr_group_uri = sync_dirpath_to_s3(output_zarr_fpath, dst_suffix)
-    ome_zarr_uri = zarr_group_uri + '/0'
-    # ome_zarr_uri = zarr_group_uri
-    # rich.print(zarr_group_uri)
-    # import sys; sys.exit(0)
-
-    # Set image_rep properties that we now know
-    # base_image_rep.file_uri = 
-    base_image_rep.total_size_in_bytes = get_dir_size(output_zarr_fpath)
-    base_image_rep.file_uri = [ome_zarr_uri]
-    update_dict = get_dimensions_dict_from_zarr(ome_zarr_uri)
-    base_image_rep.__dict__.update(update_dict)
+    # Upload to S3. In pipelined mode most files are already there, and the upload
+    # manifest means only the remainder is sent
+    with timed_stage("upload") as timing:
+        upload_summary = upload_dirpath_to_s3(output_zarr_fpath, dst_suffix)
+        timing.n_bytes = upload_summary.uploaded.n_bytes
+    zarr_group_uri = upload_summary.uri
+
+    series_keys = get_bioformats2raw_series_keys(output_zarr_fpath) or ['0']
+    if len(series_keys) == 1:
+        sizes_in_bytes = {series_keys[0]: upload_summary.total.n_bytes}
+    else:
+        sizes_in_bytes = {
+            key: upload_summary.per_prefix[key].n_bytes if key in upload_summary.per_prefix else 0
+            for key in series_keys
+        }
+    logger.info(f"Found {len(series_keys)} series in {output_zarr_fpath}")
+
+    # Set image_rep properties that we now know, reading each series back concurrently
+    with timed_stage("describe_series"), ThreadPoolExecutor(max_workers=min(len(series_keys), settings.staging_max_workers)) as executor:
+        series_image_reps = list(executor.map(
+            lambda key: describe_series(base_image_rep, zarr_group_uri, key, sizes_in_bytes[key]),
+            series_keys
+        ))
 
     # Write back to API
-    store_object_in_api_idempotent(base_image_rep)
+    with timed_stage("store"):
+        outcomes = store_objects_in_api_idempotent(series_image_reps)
+    failed = [outcome for outcome in outcomes if outcome.status == "failed"]
+    if failed:
+        raise RuntimeError(f"Failed to store {len(failed)} of {len(outcomes)} representations: {failed[0].error}")
 
-    return base_image_rep
\ No newline at end of file
+    return series_image_reps[0]
\ No newline at end of file
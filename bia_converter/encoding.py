@@ -0,0 +1,134 @@
+"""In-memory encoding of rendered 2D images, optionally to a byte budget.
+
+Supported formats are optimised PNG, lossless and lossy WebP, JPEG, and AVIF
+where Pillow has support for it. With a byte budget, lossy formats search
+quality settings for the highest quality that fits, and lossless WebP falls
+back to lossy WebP if it doesn't fit.
+"""
+import io
+import logging
+from typing import Literal, Optional
+
+from PIL import Image, features
+from pydantic import BaseModel, Field
+
+
+logger = logging.getLogger(__name__)
+
+
+FORMAT_EXTENSIONS = {
+    "png": ".png",
+    "webp": ".webp",
+    "jpeg": ".jpg",
+    "avif": ".avif",
+}
+
+CONTENT_TYPES = {
+    "png": "image/png",
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+    "avif": "image/avif",
+}
+
+LOSSY_FORMATS = {"webp", "jpeg", "avif"}
+
+
+class EncodingSettings(BaseModel):
+    format: Literal["png", "webp", "jpeg", "avif"] = "png"
+    lossless: bool = Field(
+        default=True,
+        description="For WebP, encode losslessly (PNG is always lossless, JPEG and AVIF never)"
+    )
+    quality: int = Field(default=85, ge=1, le=100)
+    min_quality: int = Field(
+        default=30, ge=1, le=100,
+        description="Lowest quality the byte budget search will go to"
+    )
+    max_bytes: Optional[int] = Field(
+        default=None,
+        description="Byte budget. If set, lossy formats search for the highest quality that fits"
+    )
+
+
+class EncodedImage(BaseModel):
+    data: bytes
+    format: str
+    lossless: bool
+    quality: Optional[int] = None
+
+    @property
+    def extension(self) -> str:
+        return FORMAT_EXTENSIONS[self.format]
+
+    @property
+    def content_type(self) -> str:
+        return CONTENT_TYPES[self.format]
+
+
+def check_format_available(image_format: str):
+    if image_format in ("webp", "avif") and not features.check(image_format):
+        raise ValueError(f"This Pillow build has no {image_format} support")
+
+
+def encode(im: Image.Image, image_format: str, lossless: bool, quality: int) -> bytes:
+    buf = io.BytesIO()
+    if image_format == "png":
+        im.save(buf, format="PNG", optimize=True)
+    elif image_format == "webp":
+        if lossless:
+            # For lossless WebP, quality is the compression effort. Maximum effort
+            # takes seconds per image for little gain, so use libwebp's default
+            im.save(buf, format="WEBP", lossless=True, quality=80, method=4)
+        else:
+            im.save(buf, format="WEBP", quality=quality, method=6)
+    elif image_format == "jpeg":
+        im.convert("RGB").save(buf, format="JPEG", quality=quality, optimize=True, progressive=True)
+    elif image_format == "avif":
+        im.save(buf, format="AVIF", quality=quality)
+    else:
+        raise ValueError(f"Unknown image format {image_format}")
+
+    return buf.getvalue()
+
+
+def search_quality(im: Image.Image, image_format: str, max_bytes: int, min_quality: int, max_quality: int) -> EncodedImage:
+    """Binary search for the highest quality that encodes within max_bytes. If even
+    min_quality doesn't fit, that encoding is returned."""
+
+    best = None
+    lo, hi = min_quality, max_quality
+    while lo <= hi:
+        quality = (lo + hi) // 2
+        data = encode(im, image_format, False, quality)
+        if len(data) <= max_bytes:
+            best = EncodedImage(data=data, format=image_format, lossless=False, quality=quality)
+            lo = quality + 1
+        else:
+            hi = quality - 1
+
+    if best is None:
+        data = encode(im, image_format, False, min_quality)
+        logger.warning(f"{image_format} at quality {min_quality} is {len(data)} bytes, over the budget of {max_bytes}")
+        best = EncodedImage(data=data, format=image_format, lossless=False, quality=min_quality)
+
+    return best
+
+
+def encode_image(im: Image.Image, settings: Optional[EncodingSettings] = None) -> EncodedImage:
+    """Encode the image in memory with the given settings."""
+
+    settings = settings or EncodingSettings()
+    check_format_available(settings.format)
+
+    lossless = settings.format == "png" or (settings.format == "webp" and settings.lossless)
+    quality = None if lossless else settings.quality
+    data = encode(im, settings.format, lossless, settings.quality)
+
+    if settings.max_bytes is None or len(data) <= settings.max_bytes:
+        return EncodedImage(data=data, format=settings.format, lossless=lossless, quality=quality)
+
+    if settings.format not in LOSSY_FORMATS:
+        logger.warning(f"PNG is {len(data)} bytes, over the budget of {settings.max_bytes}, and can't be made smaller")
+        return EncodedImage(data=data, format=settings.format, lossless=True)
+
+    return search_quality(im, settings.format, settings.max_bytes, settings.min_quality, settings.quality)
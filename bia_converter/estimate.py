@@ -0,0 +1,223 @@
+"""Dry-run cost estimation for array conversions.
+
+Reads only array metadata plus a handful of sample tiles from the source, and
+uses the measured throughput to project how much work a full conversion will be.
+"""
+import math
+import time
+import random
+import itertools
+from datetime import timedelta
+from typing import Dict, List
+
+import rich
+import numpy as np
+import numcodecs # type: ignore
+from pydantic import BaseModel
+
+from .pyramid import PyramidLevel
+
+
+class LevelEstimate(BaseModel):
+    path: str
+    shape: List[int]
+    n_tiles: int
+    n_output_objects: int
+    n_expected_objects: int
+    bytes_read: int
+    bytes_written: int
+    peak_memory_bytes: int
+    seconds: float
+
+
+class ConversionEstimate(BaseModel):
+    levels: List[LevelEstimate]
+    source_read_mb_per_s: float
+    encode_mb_per_s: float
+    decode_mb_per_s: float
+    compression_ratio: float
+    empty_chunk_fraction: float
+
+    @property
+    def total_bytes_read(self) -> int:
+        return sum(level.bytes_read for level in self.levels)
+
+    @property
+    def total_bytes_written(self) -> int:
+        return sum(level.bytes_written for level in self.levels)
+
+    @property
+    def total_objects(self) -> int:
+        return sum(level.n_expected_objects for level in self.levels)
+
+    @property
+    def peak_memory_bytes(self) -> int:
+        return max(level.peak_memory_bytes for level in self.levels)
+
+    @property
+    def total_seconds(self) -> float:
+        return sum(level.seconds for level in self.levels)
+
+
+def n_blocks(shape: List[int], block_shape: List[int]) -> int:
+    """Number of blocks of block_shape needed to cover an array of shape."""
+
+    return math.prod(math.ceil(s / b) for s, b in zip(shape, block_shape))
+
+
+def split_into_chunks(data: np.ndarray, chunk_shape: List[int]):
+    """Yield the chunk_shape pieces of a tile, as they would be written."""
+
+    ranges = [range(0, s, c) for s, c in zip(data.shape, chunk_shape)]
+    for origin in itertools.product(*ranges):
+        yield data[tuple(slice(o, o + c) for o, c in zip(origin, chunk_shape))]
+
+
+def measure_sample_tiles(
+        source_array,
+        tile_shape: List[int],
+        chunk_shape: List[int],
+        compressor: Dict,
+        n_sample_tiles: int,
+        seed: int = 0
+    ) -> Dict[str, float]:
+    """Read a few tiles of tile_shape from the source, then split them into output
+    chunks and encode them, timing each step."""
+
+    n_tiles_per_dim = [math.ceil(s / t) for s, t in zip(source_array.shape, tile_shape)]
+    total_tiles = math.prod(n_tiles_per_dim)
+    rng = random.Random(seed)
+    flat_indices = rng.sample(range(total_tiles), min(n_sample_tiles, total_tiles))
+
+    codec = numcodecs.get_codec(compressor)
+    raw_bytes = encoded_bytes = 0
+    read_time = encode_time = decode_time = 0.0
+    n_chunks = n_empty_chunks = 0
+
+    for flat_index in flat_indices:
+        idx = np.unravel_index(flat_index, n_tiles_per_dim)
+        slices = tuple(
+            slice(i * t, min((i + 1) * t, s))
+            for i, t, s in zip(idx, tile_shape, source_array.shape)
+        )
+
+        start = time.perf_counter()
+        data = source_array[slices].read().result()
+        read_time += time.perf_counter() - start
+        raw_bytes += data.nbytes
+
+        for chunk in split_into_chunks(data, chunk_shape):
+            n_chunks += 1
+            if not chunk.any():
+                n_empty_chunks += 1
+            start = time.perf_counter()
+            buf = codec.encode(np.ascontiguousarray(chunk))
+            encode_time += time.perf_counter() - start
+            start = time.perf_counter()
+            codec.decode(buf)
+            decode_time += time.perf_counter() - start
+            encoded_bytes += len(buf)
+
+    mb = raw_bytes / 1e6
+
+    return {
+        'source_read_mb_per_s': mb / max(read_time, 1e-9),
+        'encode_mb_per_s': mb / max(encode_time, 1e-9),
+        'decode_mb_per_s': mb / max(decode_time, 1e-9),
+        'compression_ratio': raw_bytes / max(encoded_bytes, 1),
+        'empty_chunk_fraction': n_empty_chunks / max(n_chunks, 1)
+    }
+
+
+def estimate_conversion(
+        source_array,
+        pyramid_levels: List[PyramidLevel],
+        target_chunks: List[int],
+        processing_chunk_size: List[int],
+        compressor: Dict,
+        n_sample_tiles: int = 3
+    ) -> ConversionEstimate:
+    """Estimate the cost of writing source_array as the base of the given pyramid,
+    and then generating each downsampled level from the one before it.
+
+    Level 0 time is projected from the measured source read rate, downsampled
+    levels from the measured local decode rate. All levels use the measured encode
+    rate and compression ratio, and assume the sampled fraction of empty chunks is
+    skipped. Byte counts for reads are decoded bytes."""
+
+    measured = measure_sample_tiles(
+        source_array, processing_chunk_size, target_chunks, compressor, n_sample_tiles
+    )
+    itemsize = np.dtype(source_array.dtype.numpy_dtype).itemsize
+
+    level_estimates = []
+    for n, level in enumerate(pyramid_levels):
+        level_bytes = math.prod(level.shape) * itemsize
+        # Tiles never extend past the edges of the array
+        tile_bytes = math.prod(min(p, s) for p, s in zip(processing_chunk_size, level.shape)) * itemsize
+        n_output_objects = n_blocks(level.shape, target_chunks)
+        n_expected_objects = math.ceil(n_output_objects * (1 - measured['empty_chunk_fraction']))
+        bytes_written = int(level_bytes * (1 - measured['empty_chunk_fraction']) / measured['compression_ratio'])
+
+        if n == 0:
+            bytes_read = math.prod(source_array.shape) * itemsize
+            read_rate = measured['source_read_mb_per_s']
+            # Read buffer plus the chunk being encoded
+            peak_memory_bytes = tile_bytes * 2
+        else:
+            bytes_read = math.prod(pyramid_levels[n-1].shape) * itemsize
+            read_rate = measured['decode_mb_per_s']
+            # The downsampler reads a region factors times larger than the output tile
+            source_tile_bytes = math.prod(
+                min(p * f, s) for p, f, s in zip(processing_chunk_size, level.factors, pyramid_levels[n-1].shape)
+            ) * itemsize
+            peak_memory_bytes = source_tile_bytes + tile_bytes
+
+        seconds = bytes_read / 1e6 / read_rate + level_bytes / 1e6 / measured['encode_mb_per_s']
+
+        level_estimates.append(
+            LevelEstimate(
+                path=level.path,
+                shape=level.shape,
+                n_tiles=n_blocks(level.shape, processing_chunk_size),
+                n_output_objects=n_output_objects,
+                n_expected_objects=n_expected_objects,
+                bytes_read=bytes_read,
+                bytes_written=bytes_written,
+                peak_memory_bytes=peak_memory_bytes,
+                seconds=seconds
+            )
+        )
+
+    return ConversionEstimate(levels=level_estimates, **measured)
+
+
+def format_bytes(n_bytes: float) -> str:
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if abs(n_bytes) < 1024:
+            return f"{n_bytes:.1f} {unit}"
+        n_bytes /= 1024
+    return f"{n_bytes:.1f} TiB"
+
+
+def print_estimate(estimate: ConversionEstimate):
+    rich.print(
+        f"Measured: source read {estimate.source_read_mb_per_s:.1f} MB/s | "
+        f"encode {estimate.encode_mb_per_s:.1f} MB/s | decode {estimate.decode_mb_per_s:.1f} MB/s | "
+        f"compression ratio {estimate.compression_ratio:.2f} | "
+        f"empty chunks {100 * estimate.empty_chunk_fraction:.0f}%"
+    )
+    for level in estimate.levels:
+        rich.print(
+            f"Level {level.path} {level.shape}: {level.n_tiles} tiles | "
+            f"{level.n_expected_objects}/{level.n_output_objects} objects | "
+            f"read {format_bytes(level.bytes_read)} | write {format_bytes(level.bytes_written)} | "
+            f"peak memory {format_bytes(level.peak_memory_bytes)} | "
+            f"time {timedelta(seconds=int(level.seconds))}"
+        )
+    rich.print(
+        f"Total: {estimate.total_objects} objects | read {format_bytes(estimate.total_bytes_read)} | "
+        f"write/scratch {format_bytes(estimate.total_bytes_written)} | "
+        f"peak memory {format_bytes(estimate.peak_memory_bytes)} | "
+        f"projected wall time {timedelta(seconds=int(estimate.total_seconds))}"
+    )
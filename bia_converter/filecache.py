@@ -0,0 +1,293 @@
+"""Verified local cache of downloaded files.
+
+Files are hashed while they download, and the hashes stored in a sidecar index
+next to each cached file: a digest of the whole file (checked against the
+checksum from the API when there is one) and a digest of each fixed-size block.
+
+* A cached file whose size and mtime match its index entry was verified when it
+  was written, and is used without reading it again.
+* A cached file that has been touched is re-hashed block by block, and only the
+  blocks that differ from the index are fetched again.
+* An interrupted download resumes from its last complete block.
+"""
+import os
+import hashlib
+import logging
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Literal, Optional, Tuple
+
+import requests
+from pydantic import BaseModel
+
+
+logger = logging.getLogger(__name__)
+
+
+BLOCK_SIZE = 8 * 1024 * 1024
+BLOCK_ALGORITHM = "md5"
+DEFAULT_ALGORITHM = "sha256"
+SIDECAR_SUFFIX = ".index.json"
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+class CacheIndexEntry(BaseModel):
+    size: int
+    mtime_ns: int
+    checksums: Dict[str, str]
+    """Whole file digests, by hashlib algorithm name."""
+    block_size: int
+    block_hashes: List[str]
+    verified_against_source: bool = False
+    """Whether a checksum from the API matched."""
+
+
+class CacheCheck(BaseModel):
+    status: Literal["verified", "missing", "mismatch", "bad_blocks"]
+    bad_blocks: List[int] = []
+
+
+class StreamingHasher:
+    """Whole file digests and per-block digests of data fed to it in order. The
+    state at the last block boundary is kept, so hashing can resume from there."""
+
+    def __init__(self, algorithms: Iterable[str] = (DEFAULT_ALGORITHM,), block_size: int = BLOCK_SIZE):
+        self.block_size = block_size
+        self.hashers = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+        self.block_hashes: List[str] = []
+        self.size = 0
+        self._block_hasher = hashlib.new(BLOCK_ALGORITHM)
+        self._block_fill = 0
+        self._boundary = self._snapshot()
+
+    def _snapshot(self):
+        return self.size, len(self.block_hashes), {a: h.copy() for a, h in self.hashers.items()}
+
+    def update(self, data):
+        data = memoryview(data)
+        while len(data):
+            n = min(len(data), self.block_size - self._block_fill)
+            for hasher in self.hashers.values():
+                hasher.update(data[:n])
+            self.size += n
+            self._block_hasher.update(data[:n])
+            self._block_fill += n
+            data = data[n:]
+            if self._block_fill == self.block_size:
+                self.block_hashes.append(self._block_hasher.hexdigest())
+                self._block_hasher = hashlib.new(BLOCK_ALGORITHM)
+                self._block_fill = 0
+                self._boundary = self._snapshot()
+
+    def rewind_to_block_boundary(self) -> int:
+        """Discard data after the last complete block, returning the offset to
+        resume from."""
+
+        self.size, n_blocks, hashers = self._boundary
+        del self.block_hashes[n_blocks:]
+        self.hashers = {a: h.copy() for a, h in hashers.items()}
+        self._block_hasher = hashlib.new(BLOCK_ALGORITHM)
+        self._block_fill = 0
+
+        return self.size
+
+    def entry(self, stat: os.stat_result) -> CacheIndexEntry:
+        block_hashes = list(self.block_hashes)
+        if self._block_fill:
+            block_hashes.append(self._block_hasher.hexdigest())
+
+        return CacheIndexEntry(
+            size=self.size,
+            mtime_ns=stat.st_mtime_ns,
+            checksums={a: h.hexdigest() for a, h in self.hashers.items()},
+            block_size=self.block_size,
+            block_hashes=block_hashes
+        )
+
+
+def sidecar_fpath(fpath: Path) -> Path:
+    return fpath.with_name(fpath.name + SIDECAR_SUFFIX)
+
+
+def read_entry(fpath: Path) -> Optional[CacheIndexEntry]:
+    index_fpath = sidecar_fpath(fpath)
+    if not index_fpath.exists():
+        return None
+    try:
+        return CacheIndexEntry.model_validate_json(index_fpath.read_text())
+    except ValueError:
+        return None
+
+
+def write_entry(fpath: Path, entry: CacheIndexEntry):
+    index_fpath = sidecar_fpath(fpath)
+    tmp_fpath = index_fpath.with_suffix(".tmp")
+    tmp_fpath.write_text(entry.model_dump_json())
+    tmp_fpath.rename(index_fpath)
+
+
+def remove_entry(fpath: Path):
+    sidecar_fpath(fpath).unlink(missing_ok=True)
+
+
+def source_checksum(fileref) -> Optional[Tuple[str, str]]:
+    """(algorithm, hex digest) from a 'checksum' attribute of the file reference,
+    with value {"algorithm": ..., "value": ...}, if present and an algorithm we
+    can compute."""
+
+    for attribute in getattr(fileref, "attribute", None) or []:
+        if attribute.name != "checksum":
+            continue
+        algorithm = str(attribute.value.get("algorithm", "")).lower().replace("-", "")
+        value = attribute.value.get("value")
+        if value and algorithm in hashlib.algorithms_available:
+            return algorithm, str(value).lower()
+
+    return None
+
+
+def hasher_for(checksum: Optional[Tuple[str, str]]) -> StreamingHasher:
+    algorithms = {DEFAULT_ALGORITHM}
+    if checksum is not None:
+        algorithms.add(checksum[0])
+
+    return StreamingHasher(sorted(algorithms))
+
+
+def record_verified(fpath: Path, hasher: StreamingHasher, checksum: Optional[Tuple[str, str]]) -> CacheIndexEntry:
+    """Check the hashed data against the source checksum (if any), and record the
+    index entry for the file."""
+
+    entry = hasher.entry(fpath.stat())
+    if checksum is not None:
+        algorithm, expected = checksum
+        if entry.checksums[algorithm] != expected:
+            raise IOError(f"{fpath} has {algorithm} {entry.checksums[algorithm]}, expected {expected}")
+        entry.verified_against_source = True
+    write_entry(fpath, entry)
+
+    return entry
+
+
+def hash_file(fpath: Path, algorithms: Iterable[str] = (DEFAULT_ALGORITHM,)) -> StreamingHasher:
+    hasher = StreamingHasher(algorithms)
+    with open(fpath, "rb") as fh:
+        for chunk in iter(lambda: fh.read(STREAM_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+
+    return hasher
+
+
+def check_cached_file(fpath: Path, expected_size: int, checksum: Optional[Tuple[str, str]] = None) -> CacheCheck:
+    """Decide whether a cached file can be used as is, reading it only if it has
+    changed since it was indexed (or was never indexed)."""
+
+    if not fpath.exists():
+        return CacheCheck(status="missing")
+    stat = fpath.stat()
+    if stat.st_size != expected_size:
+        return CacheCheck(status="mismatch")
+
+    entry = read_entry(fpath)
+    if entry is not None and checksum is not None and checksum[0] not in entry.checksums:
+        # Indexed without the source's algorithm, so check it as if never indexed
+        entry = None
+
+    if entry is not None and entry.size == stat.st_size and entry.mtime_ns == stat.st_mtime_ns:
+        if checksum is None or entry.checksums[checksum[0]] == checksum[1]:
+            return CacheCheck(status="verified")
+        return CacheCheck(status="mismatch")
+
+    if entry is not None and entry.size == stat.st_size:
+        # Touched since indexed, find any blocks that changed
+        hasher = hash_file(fpath, entry.checksums.keys())
+        bad_blocks = [
+            i for i, (new, old) in enumerate(zip(hasher.entry(stat).block_hashes, entry.block_hashes))
+            if new != old
+        ]
+        if bad_blocks:
+            return CacheCheck(status="bad_blocks", bad_blocks=bad_blocks)
+        entry.mtime_ns = stat.st_mtime_ns
+        write_entry(fpath, entry)
+        return CacheCheck(status="verified")
+
+    # Never indexed (e.g. cached before indexing existed), so we only have the
+    # size and any source checksum to go on
+    hasher = hasher_for(checksum)
+    with open(fpath, "rb") as fh:
+        for chunk in iter(lambda: fh.read(STREAM_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    try:
+        record_verified(fpath, hasher, checksum)
+    except IOError:
+        return CacheCheck(status="mismatch")
+
+    return CacheCheck(status="verified")
+
+
+def repair_blocks(fpath: Path, bad_blocks: List[int], fetch_range: Callable[[int, int], bytes]):
+    """Fetch the given blocks again (with fetch_range(start, stop)) and write them
+    in place, checking each against the index."""
+
+    entry = read_entry(fpath)
+    assert entry is not None
+    logger.info(f"Refetching {len(bad_blocks)} of {len(entry.block_hashes)} blocks of {fpath}")
+
+    with open(fpath, "r+b") as fh:
+        for block in bad_blocks:
+            start = block * entry.block_size
+            data = fetch_range(start, min(start + entry.block_size, entry.size))
+            if hashlib.new(BLOCK_ALGORITHM, data).hexdigest() != entry.block_hashes[block]:
+                raise IOError(f"Block {block} of {fpath} refetched with different content")
+            fh.seek(start)
+            fh.write(data)
+
+    entry.mtime_ns = fpath.stat().st_mtime_ns
+    write_entry(fpath, entry)
+
+
+def download_to_cache(
+        session: requests.Session,
+        uri: str,
+        dst_fpath: Path,
+        checksum: Optional[Tuple[str, str]] = None,
+        max_resumes: int = 3
+    ) -> CacheIndexEntry:
+    """Stream uri to dst_fpath, hashing as it arrives. If the connection drops, the
+    download resumes from the last complete block with a range request. The file
+    only appears at dst_fpath once complete and checked."""
+
+    dst_fpath.parent.mkdir(parents=True, exist_ok=True)
+    remove_entry(dst_fpath)
+    tmp_fpath = dst_fpath.with_suffix(dst_fpath.suffix + ".tmp")
+    hasher = hasher_for(checksum)
+
+    try:
+        with open(tmp_fpath, "wb") as fh:
+            for attempt in range(max_resumes + 1):
+                headers = {"Range": f"bytes={hasher.size}-"} if hasher.size else {}
+                try:
+                    with session.get(uri, stream=True, headers=headers) as response:
+                        response.raise_for_status()
+                        if hasher.size and response.status_code != 206:
+                            raise IOError(f"{uri} does not support resuming downloads")
+                        for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                            hasher.update(chunk)
+                            fh.write(chunk)
+                    break
+                except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError) as error:
+                    if attempt >= max_resumes:
+                        raise
+                    offset = hasher.rewind_to_block_boundary()
+                    logger.warning(f"Download of {uri} interrupted ({error}), resuming from byte {offset}")
+                    fh.seek(offset)
+                    fh.truncate()
+
+        tmp_fpath.rename(dst_fpath)
+    finally:
+        tmp_fpath.unlink(missing_ok=True)
+
+    try:
+        return record_verified(dst_fpath, hasher, checksum)
+    except IOError:
+        dst_fpath.unlink()
+        raise
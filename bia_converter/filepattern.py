@@ -0,0 +1,261 @@
+"""Matching of file references against a fileset template, for pattern-based images.
+
+Templates use the parse module's format syntax, e.g. "image_t{t:d}_z{z:d}.tif".
+Common templates (literal text plus anonymous or named fields, with integer 'd'
+fields for the t, c and z positions) are compiled once into a single regular
+expression which is run over many paths at once. Anything else falls back to
+parse itself, compiled once. Either way, the results are the same as calling
+parse.parse on each path.
+
+The result is a FilesetIndex holding the positions as NumPy arrays, which can
+check the grid of positions for gaps and duplicates.
+"""
+import re
+import math
+import itertools
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import parse # type: ignore
+import numpy as np
+from pydantic import BaseModel, ConfigDict
+
+
+logger = logging.getLogger(__name__)
+
+
+POSITION_FIELDS = ("t", "c", "z")
+
+# Gaps are found with a dense grid of positions unless it would be this many times
+# larger than the number of files
+DENSE_GRID_MAX_FACTOR = 16
+
+# Paths are matched in batches, so matching overlaps with fetching file references
+MATCH_BATCH_SIZE = 4096
+
+# Same as parse's pattern for 'd' fields, so matches are identical
+INT_PATTERN = r"[-+ ]?[-+ ]?[0-9]+|[-+ ]?0[xX][0-9a-fA-F]+|[-+ ]?0[bB][01]+|[-+ ]?0[oO][0-7]+"
+
+TEMPLATE_TOKEN = re.compile(r"\{\{|\}\}|\{([^{}]*)\}")
+SIMPLE_FIELD = re.compile(r"(?P<name>[A-Za-z_][A-Za-z0-9_]*)?(?::(?P<type>d?))?")
+
+
+def compile_template(parse_template: str) -> Optional[re.Pattern]:
+    """Translate a parse template to a regex matching whole lines, or return None
+    if it uses features we don't translate (format specs other than 'd', repeated
+    or dotted names, or non-integer position fields)."""
+
+    regex_parts = ["^"]
+    names = set()
+    position = 0
+    for token in TEMPLATE_TOKEN.finditer(parse_template):
+        regex_parts.append(re.escape(parse_template[position:token.start()]))
+        position = token.end()
+
+        if token.group(0) == "{{":
+            regex_parts.append(re.escape("{"))
+            continue
+        if token.group(0) == "}}":
+            regex_parts.append(re.escape("}"))
+            continue
+
+        field = SIMPLE_FIELD.fullmatch(token.group(1))
+        if field is None:
+            return None
+        name, field_type = field.group("name"), field.group("type")
+        if name in names:
+            return None
+        if name in POSITION_FIELDS and field_type != "d":
+            return None
+
+        # Paths never contain newlines, so excluding them keeps matches to one path
+        pattern = INT_PATTERN if field_type == "d" else r"[^\n]+?"
+        if name:
+            names.add(name)
+            regex_parts.append(f"(?P<{name}>{pattern})")
+        else:
+            regex_parts.append(f"(?:{pattern})")
+
+    if "}" in parse_template[position:] or "{" in parse_template[position:]:
+        return None
+    regex_parts.append(re.escape(parse_template[position:]))
+    regex_parts.append("$")
+
+    # parse matches case insensitively by default
+    return re.compile("".join(regex_parts), re.IGNORECASE | re.MULTILINE)
+
+
+def first_missing_values(present: np.ndarray, n_values: int, max_reported: int) -> List[int]:
+    """The first max_reported values of range(n_values) not in present, which must
+    be sorted and unique."""
+
+    missing: List[int] = []
+    expected = 0
+    for value in present.tolist() + [n_values]:
+        missing.extend(range(expected, min(value, expected + max_reported - len(missing))))
+        if len(missing) >= max_reported:
+            break
+        expected = value + 1
+
+    return missing
+
+
+class FilesetIndex(BaseModel):
+    """File references matched by a template, with their (t, c, z) positions."""
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    file_references: List
+    t: np.ndarray
+    c: np.ndarray
+    z: np.ndarray
+
+    def __len__(self):
+        return len(self.file_references)
+
+    def coords_map(self) -> Dict:
+        """Mapping from file reference UUID to (t, c, z)."""
+
+        return {
+            fileref.uuid: (int(t), int(c), int(z))
+            for fileref, t, c, z in zip(self.file_references, self.t, self.c, self.z)
+        }
+
+    def ranges(self) -> Tuple[Tuple[int, int], ...]:
+        """(min, max) of t, c and z."""
+
+        return tuple((int(a.min()), int(a.max())) for a in (self.t, self.c, self.z))
+
+    def _linear_positions(self):
+        (tmin, tmax), (cmin, cmax), (zmin, zmax) = self.ranges()
+        grid_shape = (tmax - tmin + 1, cmax - cmin + 1, zmax - zmin + 1)
+        linear = np.ravel_multi_index((self.t - tmin, self.c - cmin, self.z - zmin), grid_shape)
+
+        return linear, grid_shape, (tmin, cmin, zmin)
+
+    def find_duplicates(self) -> List[Tuple[int, int, int]]:
+        """Positions matched by more than one file."""
+
+        if not len(self):
+            return []
+        linear, grid_shape, origin = self._linear_positions()
+        values, counts = np.unique(linear, return_counts=True)
+
+        return [
+            tuple(int(i + o) for i, o in zip(np.unravel_index(v, grid_shape), origin))
+            for v in values[counts > 1]
+        ]
+
+    def find_gaps(self, max_reported: int = 100) -> Tuple[int, List[Tuple[int, int, int]]]:
+        """Number of positions in the (t, c, z) bounding grid with no file, and up to
+        max_reported of them."""
+
+        if not len(self):
+            return 0, []
+        linear, grid_shape, origin = self._linear_positions()
+        n_positions = math.prod(grid_shape)
+
+        if n_positions <= DENSE_GRID_MAX_FACTOR * len(self):
+            present = np.zeros(n_positions, dtype=bool)
+            present[linear] = True
+            missing = np.flatnonzero(~present)
+            n_missing = len(missing)
+        else:
+            # Sparse positions (e.g. timestamps as t), work from the positions present
+            # rather than allocating the whole grid
+            present = np.unique(linear)
+            n_missing = n_positions - len(present)
+            missing = first_missing_values(present, n_positions, max_reported)
+
+        return n_missing, [
+            tuple(int(i + o) for i, o in zip(np.unravel_index(v, grid_shape), origin))
+            for v in missing[:max_reported]
+        ]
+
+    def bfconvert_pattern(self, ext: str) -> str:
+        """The pattern bioformats needs to load the files once linked by position."""
+
+        (tmin, tmax), (cmin, cmax), (zmin, zmax) = self.ranges()
+
+        return f"T<{tmin:04d}-{tmax:04d}>_C<{cmin:04d}-{cmax:04d}>_Z<{zmin:04d}-{zmax:04d}>{ext}"
+
+
+def _match_batch_regex(batch, regex, parser, matched, positions):
+    """Match a batch of paths in one pass over the joined paths, converting the
+    positions to integers with NumPy."""
+
+    text = "\n".join(fileref.file_path for fileref in batch)
+    line_starts = np.cumsum([0] + [len(fileref.file_path) + 1 for fileref in batch[:-1]])
+    matches = list(regex.finditer(text))
+    if not matches:
+        return
+
+    rows = np.searchsorted(line_starts, [match.start() for match in matches], side="right") - 1
+    batch_positions = np.zeros((len(matches), 3), dtype=np.int64)
+    try:
+        for axis, name in enumerate(POSITION_FIELDS):
+            if name in regex.groupindex:
+                batch_positions[:, axis] = np.array([match.group(name) for match in matches]).astype(np.int64)
+    except ValueError:
+        # Rare number forms (e.g. hex), take them exactly as parse does
+        for n, row in enumerate(rows):
+            result = parser.parse(batch[row].file_path)
+            batch_positions[n] = [result.named.get(name, 0) for name in POSITION_FIELDS]
+
+    matched.extend(batch[row] for row in rows)
+    positions.extend(batch_positions.tolist())
+
+
+def _match_batch_parse(batch, parser, matched, positions):
+    for fileref in batch:
+        result = parser.parse(fileref.file_path)
+        if result:
+            matched.append(fileref)
+            positions.append([result.named.get(name, 0) for name in POSITION_FIELDS])
+
+
+def index_file_references(file_references: Iterable, parse_template: str) -> FilesetIndex:
+    """Match file references (any iterable, consumed in batches as it yields) against
+    the template, and index the (t, c, z) positions of those that match. Fields
+    missing from the template are 0."""
+
+    regex = compile_template(parse_template)
+    parser = parse.compile(parse_template)
+    if regex is None:
+        logger.info(f"Template {parse_template} can't be compiled to a single regex, matching with parse")
+
+    matched: List = []
+    positions: List = []
+    file_references = iter(file_references)
+    while True:
+        batch = list(itertools.islice(file_references, MATCH_BATCH_SIZE))
+        if not batch:
+            break
+        if regex is not None:
+            _match_batch_regex(batch, regex, parser, matched, positions)
+        else:
+            _match_batch_parse(batch, parser, matched, positions)
+
+    position_array = np.array(positions, dtype=np.int64).reshape(-1, 3)
+
+    return FilesetIndex(
+        file_references=matched,
+        t=position_array[:, 0],
+        c=position_array[:, 1],
+        z=position_array[:, 2]
+    )
+
+
+def check_fileset_index(fileset_index: FilesetIndex):
+    """Fail if several files claim the same position, and warn about gaps in the grid."""
+
+    if not len(fileset_index):
+        raise ValueError("No file references matched the file pattern")
+
+    duplicates = fileset_index.find_duplicates()
+    if duplicates:
+        raise ValueError(f"{len(duplicates)} (t, c, z) positions match more than one file, e.g. {duplicates[:5]}")
+
+    n_missing, missing = fileset_index.find_gaps()
+    if n_missing:
+        logger.warning(f"{n_missing} (t, c, z) positions have no file, e.g. {missing[:5]}")
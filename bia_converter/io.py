@@ -1,54 +1,350 @@
 from pathlib import Path
+import os
+import json
+import time
+import base64
+import hashlib
 import logging
 import shutil
+import mimetypes
+import threading
 import subprocess
+from typing import Dict, Iterator, List, Optional, Tuple
 from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
+import boto3 # type: ignore
 import requests
+from pydantic import BaseModel, Field
+from botocore.config import Config as BotoConfig # type: ignore
+from botocore.exceptions import ClientError # type: ignore
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
 from .config import settings 
+from .remotezip import fetch_range, fetch_zip_member, fetch_zip_members, get_zip_directory, split_zip_member_uri
+from .filecache import check_cached_file, download_to_cache, repair_blocks, source_checksum
 
 
 logger = logging.getLogger(__name__)
 
 
-def sync_dirpath_to_s3(src_dirpath, dst_suffix):
+def get_s3_client():
+    """Create an S3 client for the configured endpoint, with enough pooled
+    connections for our upload concurrency."""
+
+    return boto3.client(
+        "s3",
+        region_name="us-east-1",
+        endpoint_url=settings.endpoint_url,
+        config=BotoConfig(
+            max_pool_connections=settings.upload_max_workers,
+            retries={"max_attempts": 5, "mode": "standard"}
+        )
+    )
+
+
+def md5_of_file(fpath: Path) -> str:
+    md5 = hashlib.md5()
+    with open(fpath, "rb") as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class UploadManifest:
+    """Local record of the objects uploaded under one destination prefix.
+
+    Stored as JSON lines, one per object, appended as each upload completes, so
+    an interrupted upload can be resumed without listing the remote prefix. Later
+    lines for the same key supersede earlier ones. The manifest also serves as an
+    audit record of what was published."""
+
+    # Appended lines are flushed to disk this often, and when the manifest is closed
+    FLUSH_EVERY_RECORDS = 1000
+    FLUSH_EVERY_SECONDS = 5.0
+
+    def __init__(self, fpath: Path):
+        self.fpath = fpath
+        self.entries: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._fh = None
+        self._n_unflushed = 0
+        self._last_flush = time.monotonic()
+
+        if fpath.exists():
+            with open(fpath) as fh:
+                for line in fh:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A partially written final line from an interrupted run
+                        continue
+                    if entry.get("deleted"):
+                        self.entries.pop(entry["key"], None)
+                    else:
+                        self.entries[entry["key"]] = entry
+
+    @classmethod
+    def for_suffix(cls, dst_suffix: str) -> "UploadManifest":
+        manifest_dirpath = settings.cache_root_dirpath/"manifests"/settings.bucket_name
+        manifest_dirpath.mkdir(exist_ok=True, parents=True)
+        return cls(manifest_dirpath/(dst_suffix.replace("/", "__") + ".jsonl"))
+
+    def needs_upload(self, key: str, fpath: Path, stat: os.stat_result) -> Tuple[bool, Optional[str]]:
+        """Determine whether the local file must be uploaded to key. Files with the
+        recorded size and mtime are trusted without reading them. Returns the file
+        md5 if it had to be computed."""
+
+        entry = self.entries.get(key)
+        if entry is None or entry["size"] != stat.st_size:
+            return True, None
+        if entry["mtime_ns"] == stat.st_mtime_ns:
+            return False, None
+
+        # Touched but possibly unchanged, compare content
+        md5 = md5_of_file(fpath)
+        if md5 == entry["md5"]:
+            self.record(key, stat.st_size, stat.st_mtime_ns, md5)
+            return False, md5
+        return True, md5
+
+    def record(self, key: str, size: int, mtime_ns: int, md5: str):
+        entry = {"key": key, "size": size, "mtime_ns": mtime_ns, "md5": md5}
+        with self._lock:
+            self.entries[key] = entry
+            self._append(entry)
+
+    def record_deleted(self, key: str):
+        """Record that the object at key was removed from the bucket."""
+
+        with self._lock:
+            self.entries.pop(key, None)
+            self._append({"key": key, "deleted": True})
+
+    def _append(self, entry: dict):
+        """Called with the lock held."""
+
+        line = json.dumps(entry) + "\n"
+        if self._fh is None:
+            self._fh = open(self.fpath, "a")
+        self._fh.write(line)
+        self._n_unflushed += 1
+        if self._n_unflushed >= self.FLUSH_EVERY_RECORDS or \
+                time.monotonic() - self._last_flush >= self.FLUSH_EVERY_SECONDS:
+            self._flush()
+
+    def _flush(self):
+        self._fh.flush()
+        self._n_unflushed = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+                self._n_unflushed = 0
+
+    def __enter__(self) -> "UploadManifest":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_files(dirpath: Path) -> Iterator[Tuple[Path, os.stat_result]]:
+    """Recursively yield (path, stat) for all files under dirpath, using scandir
+    so that file types and sizes come from the directory listing where possible."""
+
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(Path(entry.path))
+            elif entry.is_file():
+                yield Path(entry.path), entry.stat()
+
+
+def upload_file_to_s3(s3_client, fpath: Path, dst_key: str, md5: str):
+    """Upload a single file with a public-read ACL, letting S3 check the content md5."""
+
+    extra_args = {"ACL": "public-read"}
+    content_type, _ = mimetypes.guess_type(fpath.name)
+    if content_type:
+        extra_args["ContentType"] = content_type
+
+    with open(fpath, "rb") as fh:
+        s3_client.put_object(
+            Bucket=settings.bucket_name,
+            Key=dst_key,
+            Body=fh,
+            ContentMD5=base64.b64encode(bytes.fromhex(md5)).decode("ascii"),
+            **extra_args
+        )
+
+
+def s3_object_exists(key: str) -> bool:
+    """Check with a HEAD request whether key exists in the configured bucket."""
+
+    try:
+        get_s3_client().head_object(Bucket=settings.bucket_name, Key=key)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+    return True
+
+
+def put_bytes_to_s3(data: bytes, dst_key: str, content_type: Optional[str] = None) -> str:
+    """Upload in-memory data to dst_key in the configured bucket, with a public-read
+    ACL, letting S3 check the content md5.
+
+    Returns: URI of uploaded object."""
+
+    extra_args = {"ACL": "public-read"}
+    if content_type:
+        extra_args["ContentType"] = content_type
+
+    logger.info(f"Uploading {len(data)} bytes to {dst_key}")
+    get_s3_client().put_object(
+        Bucket=settings.bucket_name,
+        Key=dst_key,
+        Body=data,
+        ContentMD5=base64.b64encode(hashlib.md5(data).digest()).decode("ascii"),
+        **extra_args
+    )
+
+    return f"{settings.endpoint_url}/{settings.bucket_name}/{dst_key}"
+
+
+class ObjectTotals(BaseModel):
+    n_objects: int = 0
+    n_bytes: int = 0
+
+    def add(self, n_bytes: int):
+        self.n_objects += 1
+        self.n_bytes += n_bytes
+
+
+class UploadSummary(BaseModel):
+    """Totals for a directory upload. All objects under the prefix are counted,
+    including those already uploaded by an earlier run."""
+
+    uri: str
+    total: ObjectTotals = Field(default_factory=ObjectTotals)
+    uploaded: ObjectTotals = Field(default_factory=ObjectTotals)
+    per_prefix: Dict[str, ObjectTotals] = Field(default_factory=dict)
+    """Totals by first path component, e.g. per pyramid level or per series."""
+    new_keys: List[str] = Field(default_factory=list)
+    """Keys uploaded that the manifest had no record of, so that no earlier run
+    published."""
+
+
+def upload_dirpath_to_s3(src_dirpath, dst_suffix, min_age_seconds: Optional[float] = None) -> UploadSummary:
+    """Upload the contents of src_dirpath under dst_suffix in the configured bucket.
+
+    Only files missing from, or changed since, the local upload manifest for the
+    suffix are sent. The remote prefix is never listed.
+
+    If min_age_seconds is given, files modified more recently than that are left
+    for a later call, so that files still being written are not uploaded."""
 
     bucket_name = settings.bucket_name
     logger.info(f"Uploading to bucket {bucket_name} with suffix {dst_suffix}")
 
-    dst_key = f"{bucket_name}/{dst_suffix}"
+    src_dirpath = Path(src_dirpath)
+    s3_client = get_s3_client()
+    summary = UploadSummary(uri=f"{settings.endpoint_url}/{bucket_name}/{dst_suffix}")
+    # Enough queued to keep the workers busy, without holding a future per file
+    max_in_flight = 4 * settings.upload_max_workers
+
+    def upload_if_needed(fpath: Path, stat: os.stat_result) -> bool:
+        dst_key = f"{dst_suffix}/{fpath.relative_to(src_dirpath).as_posix()}"
+        needs_upload, md5 = manifest.needs_upload(dst_key, fpath, stat)
+        if not needs_upload:
+            return False
+        md5 = md5 or md5_of_file(fpath)
+        is_new = dst_key not in manifest.entries
+        upload_file_to_s3(s3_client, fpath, dst_key, md5)
+        manifest.record(dst_key, stat.st_size, stat.st_mtime_ns, md5)
+        if is_new:
+            summary.new_keys.append(dst_key)
+        return True
+
+    def collect(done):
+        for future in done:
+            if future.result():
+                summary.uploaded.add(pending.pop(future))
+            else:
+                pending.pop(future)
+
+    with UploadManifest.for_suffix(dst_suffix) as manifest, \
+            ThreadPoolExecutor(max_workers=settings.upload_max_workers) as executor:
+        pending: Dict = {}
+        newest_mtime = time.time() - (min_age_seconds or 0)
+        for fpath, stat in iter_files(src_dirpath):
+            if min_age_seconds is not None and stat.st_mtime > newest_mtime:
+                continue
+            if len(pending) >= max_in_flight:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending[executor.submit(upload_if_needed, fpath, stat)] = stat.st_size
+            prefix = fpath.relative_to(src_dirpath).parts[0]
+            summary.per_prefix.setdefault(prefix, ObjectTotals()).add(stat.st_size)
+            summary.total.add(stat.st_size)
+
+        collect(wait(pending).done)
+
+    logger.info(
+        f"Uploaded {summary.uploaded.n_objects} of {summary.total.n_objects} files "
+        f"({summary.uploaded.n_bytes} of {summary.total.n_bytes} bytes), manifest at {manifest.fpath}"
+    )
 
-    cmd = f'aws --region us-east-1 --endpoint-url {settings.endpoint_url} s3 sync "{src_dirpath}/" s3://{dst_key} --acl public-read'
-    logger.info(f"Uploading using command {cmd}")
+    return summary
 
-    subprocess.run(cmd, shell=True)
 
-    uri = f"{settings.endpoint_url}/{dst_key}"
+def delete_uploaded_objects(dst_suffix: str, keys: List[str]) -> int:
+    """Delete the given objects under dst_suffix, e.g. to withdraw a partial upload,
+    and record their removal in the upload manifest. Returns the number of objects
+    deleted."""
 
-    return uri
+    s3_client = get_s3_client()
 
+    with UploadManifest.for_suffix(dst_suffix) as manifest:
+        # delete_objects takes at most 1000 keys per request
+        for start in range(0, len(keys), 1000):
+            batch = keys[start:start + 1000]
+            response = s3_client.delete_objects(
+                Bucket=settings.bucket_name,
+                Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True}
+            )
+            errors = response.get("Errors", [])
+            failed = {error["Key"] for error in errors}
+            for key in batch:
+                if key not in failed:
+                    manifest.record_deleted(key)
+            if errors:
+                raise IOError(f"Failed to delete {len(errors)} objects under {dst_suffix}, e.g. {errors[0]}")
 
-def upload_dirpath_as_zarr_image_rep(src_dirpath, accession_id, image_id, image_rep_id):
+    logger.info(f"Deleted {len(keys)} objects under {dst_suffix}")
 
-    dst_prefix = f"{settings.bucket_name}/{accession_id}/{image_id}/{image_rep_id}.ome.zarr"
-    logger.info(f"Uploading with prefix {dst_prefix}")
-    cmd = f'aws --region us-east-1 --endpoint-url {settings.endpoint_url} s3 sync "{src_dirpath}/" s3://{dst_prefix} --acl public-read'
-    logger.info(f"Uploading using command {cmd}")
-    subprocess.run(cmd, shell=True)
+    return len(keys)
 
-    uri = f"{settings.endpoint_url}/{dst_prefix}"
 
-    return uri
+def sync_dirpath_to_s3(src_dirpath, dst_suffix):
 
+    return upload_dirpath_to_s3(src_dirpath, dst_suffix).uri
 
-def copy_uri_to_local(src_uri: str, dst_fpath: Path):
-    """Copy the object at the given source URI to the local path specified by dst_fpath."""
-    
-    logger.info(f"Fetching {src_uri} to {dst_fpath}")
-    
+
+def upload_dirpath_as_zarr_image_rep(src_dirpath, accession_id, image_id, image_rep_id):
+
+    dst_suffix = f"{accession_id}/{image_id}/{image_rep_id}.ome.zarr"
+
+    return sync_dirpath_to_s3(src_dirpath, dst_suffix)
+
+
+def create_download_session() -> requests.Session:
     # Create session with retry strategy
     session = requests.Session()
     retries = Retry(
@@ -59,6 +355,16 @@ def copy_uri_to_local(src_uri: str, dst_fpath: Path):
     )
     session.mount('http://', HTTPAdapter(max_retries=retries))
     session.mount('https://', HTTPAdapter(max_retries=retries))
+
+    return session
+
+
+def copy_uri_to_local(src_uri: str, dst_fpath: Path):
+    """Copy the object at the given source URI to the local path specified by dst_fpath."""
+    
+    logger.info(f"Fetching {src_uri} to {dst_fpath}")
+    
+    session = create_download_session()
     
     # Ensure parent directory exists
     dst_fpath.parent.mkdir(parents=True, exist_ok=True)
@@ -106,61 +412,136 @@ def copy_local_to_s3(src_fpath: Path, dst_key: str) -> str:
 def encode_url(url):
     # Split into base and path components to preserve the :// 
     if '://' in url:
-        base, path = url.split('://', 1)
-        # Encode the path portion, preserving forward slashes
-        encoded_path = quote(path, safe='/') 
-        return f"{base}://{encoded_path}"
+        base, rest = url.split('://', 1)
+        # Encode the path portion, preserving forward slashes. The host is left
+        # as is, so a port survives
+        netloc, sep, path = rest.partition('/')
+        encoded_path = quote(path, safe='/')
+        return f"{base}://{netloc}{sep}{encoded_path}"
     else:
         # If no protocol specified, encode the whole string
         return quote(url)
 
 
-def fetch_fileref_to_local(fileref, dst_fpath, max_retries=3):
-    # if fileref.type == "file_in_zip":
-    #     raise NotImplementedError
-    # else:
-        # Check size after download and retry if necessary
+def zip_member_location(fileref) -> Optional[Tuple[str, str]]:
+    """(archive URI, member name) for file references inside a zip, either typed
+    file_in_zip (with the member path as file_path) or with a URI pointing inside
+    the archive. None for plain files."""
 
-    encoded_uri = encode_url(fileref.uri)
-    expected_size = requests.header(encoded_uri)["content-length"] if fileref.size_in_bytes == 0 else fileref.size_in_bytes # type: ignore
-    for attempt in range(1, max_retries+1):
-        try:
-            copy_uri_to_local(encoded_uri, dst_fpath)
-            download_size = dst_fpath.stat().st_size
-            if download_size == expected_size:
-                break
+    location = split_zip_member_uri(fileref.uri)
+    if location is None and getattr(fileref, "type", None) == "file_in_zip":
+        location = (fileref.uri, fileref.file_path)
+    if location is None:
+        return None
 
-            logger.warning(f"Download attempt {attempt} did not give expected size. Got {download_size} expected {expected_size}")
-            if attempt >= max_retries:
-                raise Exception(f"{attempt} download attempt(s) did not give expected size. Got {download_size} expected {expected_size}. Maximum retries reached")
-        except requests.exceptions.HTTPError as download_error:
-            if attempt >= max_retries:
-                logger.error(f"Download attempt {attempt} resulted in error: {download_error} - exiting")
-                raise download_error
+    archive_uri, member_name = location
+    return encode_url(archive_uri), member_name
 
 
-# ToDo add max_retries as parameter to function definition
-def stage_fileref_and_get_fpath(fileref) -> Path:
+def expected_fileref_size(fileref) -> int:
+    """Size of the file, from the reference if set, otherwise from the zip central
+    directory or the server."""
+
+    if fileref.size_in_bytes:
+        return fileref.size_in_bytes
+
+    location = zip_member_location(fileref)
+    if location is not None:
+        archive_uri, member_name = location
+        return get_zip_directory(archive_uri).members[member_name].file_size
+
+    response = requests.head(encode_url(fileref.uri), allow_redirects=True)
+    response.raise_for_status()
+    return int(response.headers["Content-Length"])
+
+
+def fetch_fileref_to_local(fileref, dst_fpath, max_retries=3):
+    location = zip_member_location(fileref)
+    if location is not None:
+        # Sizes and CRCs are checked against the zip central directory
+        archive_uri, member_name = location
+        fetch_zip_member(archive_uri, member_name, dst_fpath)
+        return
+
+    # Check size and checksum (if the API has one) after download, and retry if necessary
+    encoded_uri = encode_url(fileref.uri)
+    expected_size = expected_fileref_size(fileref)
+    checksum = source_checksum(fileref)
+    logger.info(f"Fetching {encoded_uri} to {dst_fpath}")
+    session = create_download_session()
+    try:
+        for attempt in range(1, max_retries+1):
+            try:
+                entry = download_to_cache(session, encoded_uri, dst_fpath, checksum)
+                if entry.size == expected_size:
+                    break
+
+                logger.warning(f"Download attempt {attempt} did not give expected size. Got {entry.size} expected {expected_size}")
+                if attempt >= max_retries:
+                    raise Exception(f"{attempt} download attempt(s) did not give expected size. Got {entry.size} expected {expected_size}. Maximum retries reached")
+            except (requests.exceptions.HTTPError, IOError) as download_error:
+                if attempt >= max_retries:
+                    logger.error(f"Download attempt {attempt} resulted in error: {download_error} - exiting")
+                    raise download_error
+                logger.warning(f"Download attempt {attempt} failed: {download_error}")
+    finally:
+        session.close()
 
+
+def fileref_cache_fpath(fileref) -> Path:
     cache_dirpath = settings.cache_root_dirpath/"files"
     cache_dirpath.mkdir(exist_ok=True, parents=True)
 
     suffix = Path(fileref.file_path).suffix
-    dst_fname = fileref.uuid+suffix
-    dst_fpath = cache_dirpath/dst_fname
+    return cache_dirpath/(fileref.uuid+suffix)
+
+
+def prefetch_zip_members(file_references):
+    """Fetch all file references inside zips that are not yet in the cache, with
+    one batch per archive, so that small neighbouring members share requests.
+    Other file references are left for stage_fileref_and_get_fpath."""
+
+    by_archive: Dict[str, Dict[str, Path]] = {}
+    for fileref in file_references:
+        location = zip_member_location(fileref)
+        if location is None:
+            continue
+        archive_uri, member_name = location
+        dst_fpath = fileref_cache_fpath(fileref)
+        if check_cached_file(dst_fpath, expected_fileref_size(fileref)).status == "verified":
+            continue
+        by_archive.setdefault(archive_uri, {})[member_name] = dst_fpath
+
+    for archive_uri, dst_fpaths in by_archive.items():
+        fetch_zip_members(archive_uri, dst_fpaths)
+
+
+# ToDo add max_retries as parameter to function definition
+def stage_fileref_and_get_fpath(fileref) -> Path:
+    """Return the path of the file in the local cache, fetching it if it is missing
+    or fails verification. Cached files verified when they were written are used
+    without reading them."""
+
+    dst_fpath = fileref_cache_fpath(fileref)
     logger.info(f"Checking cache for {fileref.file_path}")
 
-    if not dst_fpath.exists():
-        logger.info(f"File not in cache. Downloading file to {dst_fpath}")
-        fetch_fileref_to_local(fileref, dst_fpath)
-    elif dst_fpath.stat().st_size != fileref.size_in_bytes:
-        # ToDo: As of 04/12/2023 filerefs for type file_in_zip have size_in_bytes=0
-        # Need to modify index_from_zips to get filesize info
-        logger.info(f"File in cache with size {dst_fpath.stat().st_size}. Expected size={fileref.size_in_bytes}. Downloading again to {dst_fpath}")
-        fetch_fileref_to_local(fileref, dst_fpath)
-    else:
+    check = check_cached_file(dst_fpath, expected_fileref_size(fileref), source_checksum(fileref))
+    if check.status == "verified":
         logger.info(f"File exists at {dst_fpath}")
+        return dst_fpath
 
-    return dst_fpath
+    if check.status == "bad_blocks" and zip_member_location(fileref) is None:
+        encoded_uri = encode_url(fileref.uri)
+        session = create_download_session()
+        try:
+            repair_blocks(dst_fpath, check.bad_blocks, lambda start, stop: fetch_range(session, encoded_uri, start, stop))
+            return dst_fpath
+        except (requests.exceptions.RequestException, IOError) as repair_error:
+            logger.warning(f"Could not repair {dst_fpath} ({repair_error}), downloading again")
+        finally:
+            session.close()
 
- # type: ignore
\ No newline at end of file
+    logger.info(f"File in cache is {check.status}. Downloading file to {dst_fpath}")
+    fetch_fileref_to_local(fileref, dst_fpath)
+
+    return dst_fpath
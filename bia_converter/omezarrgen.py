@@ -6,16 +6,24 @@ This includes:
 * Generating downsampled representations (creating the resolution pyramid)
 * Creating the OME-Zarr metadata
 """
+import os
+import math
 import time
-from datetime import timedelta
+import shutil
 import itertools
+import multiprocessing
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional, Set, Tuple
 from urllib.parse import urlparse
 
 import rich
 import zarr
+import numcodecs # type: ignore
+import numpy as np
 import tensorstore as ts # type: ignore
+from pydantic import BaseModel, Field
 
 from .omezarrmeta import (
     Axis, ZMeta, DataSet, CoordinateTransformation, MSMetadata,
@@ -24,6 +32,152 @@ from .omezarrmeta import (
 )
 
 from .proxyimage import OMEZarrImage
+from .pyramid import PyramidLevel
+from .rechunk import RechunkPlan, plan_rechunk
+from .tscontext import (
+    TensorstoreContextConfig,
+    configure_context,
+    get_context,
+    get_context_config,
+    get_readahead_tiles,
+    read_tiles_ahead
+)
+
+
+# Shape of the tiles we read and write at once when copying/downsampling arrays
+DEFAULT_PROCESSING_CHUNKS = [512, 512, 512, 512, 512]
+
+# Value of chunks we never write, readers fill missing chunks with this
+FILL_VALUE = 0
+
+# Axes (t, c) along which arrays are split into independently converted sub-volumes
+NON_SPATIAL_AXES = (0, 1)
+
+# Memory available for tiles in each worker when rechunking, unless configured
+DEFAULT_RECHUNK_MEMORY_LIMIT_BYTES = 2 * 1024 ** 3
+
+# Chunks are encoded on these threads before writing (the codecs release the GIL)
+chunk_encode_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# The intermediate array of a two-pass rechunk is read back once, so favour speed
+INTERMEDIATE_COMPRESSOR = {"id": "blosc", "cname": "lz4", "clevel": 1, "shuffle": 1, "blocksize": 0}
+
+
+class LevelWriteSummary(BaseModel):
+    """Record of what was written for one array (pyramid level). Tiles and chunks
+    consisting entirely of the fill value are not written."""
+
+    n_tiles: int = 0
+    n_tiles_skipped: int = 0
+    n_chunks: int = 0
+    n_chunks_written: int = 0
+    n_objects_written: int = 0
+    n_bytes_written: int = 0
+    nonempty_chunks: Set[Tuple[int, ...]] = Field(default_factory=set, exclude=True)
+    """Grid indices of chunks containing data, used to skip empty regions of the next level."""
+
+
+def check_processing_chunks_aligned(processing_chunk_size, chunks):
+    """Tiles must be whole multiples of the output chunks, so that each chunk is
+    written by exactly one tile."""
+
+    if any(p % c != 0 for p, c in zip(processing_chunk_size, chunks)):
+        raise ValueError(f"Processing chunks {processing_chunk_size} must be a multiple of array chunks {chunks}")
+
+
+def find_nonempty_chunks(tile_data, tile_slices, chunks, fill_value=FILL_VALUE) -> List[Tuple[int, ...]]:
+    """Return the grid indices of the array chunks within a tile that contain
+    anything other than the fill value. The tile must be aligned to chunk boundaries."""
+
+    nonempty = []
+    ranges = [range(0, s, c) for s, c in zip(tile_data.shape, chunks)]
+    for offset in itertools.product(*ranges):
+        block = tile_data[tuple(slice(o, o + c) for o, c in zip(offset, chunks))]
+        if np.any(block != fill_value):
+            nonempty.append(
+                tuple((sl.start + o) // c for sl, o, c in zip(tile_slices, offset, chunks))
+            )
+
+    return nonempty
+
+
+def count_tile_chunks(tile_slices, chunks) -> int:
+    return int(np.prod([
+        (sl.stop - sl.start + c - 1) // c for sl, c in zip(tile_slices, chunks)
+    ]))
+
+
+def record_tile(summary: LevelWriteSummary, tile_data, tile_slices, chunks) -> List[Tuple[int, ...]]:
+    """Update the summary with a tile, and return the indices of the chunks in it
+    that need writing."""
+
+    nonempty = find_nonempty_chunks(tile_data, tile_slices, chunks)
+
+    summary.n_tiles += 1
+    summary.n_chunks += count_tile_chunks(tile_slices, chunks)
+    summary.n_chunks_written += len(nonempty)
+    summary.nonempty_chunks.update(nonempty)
+    if not nonempty:
+        summary.n_tiles_skipped += 1
+
+    return nonempty
+
+
+class ChunkWriter:
+    """Writes chunks of a tile straight to the output array's store, encoded with
+    the array's own codec. The stored size of each chunk is then known as it is
+    written, without looking at the store afterwards."""
+
+    def __init__(self, output_array, output_dirpath):
+        metadata = output_array.spec().to_json()["metadata"]
+        if metadata.get("filters"):
+            raise ValueError("Writing chunks of arrays with filters is not supported")
+
+        self.chunks = tuple(metadata["chunks"])
+        self.dtype = np.dtype(metadata["dtype"])
+        self.order = metadata.get("order", "C")
+        self.separator = metadata.get("dimension_separator", ".")
+        self.codec = numcodecs.get_codec(metadata["compressor"]) if metadata.get("compressor") else None
+        self.kvstore = ts.KvStore.open(
+            {"driver": "file", "path": str(output_dirpath).rstrip("/") + "/"}, context=get_context()
+        ).result()
+
+    def encode(self, block: np.ndarray) -> bytes:
+        if block.shape != self.chunks:
+            # Chunks at the far edges of the array are stored padded to full size
+            padded = np.full(self.chunks, FILL_VALUE, dtype=self.dtype)
+            padded[tuple(slice(0, s) for s in block.shape)] = block
+            block = padded
+        data = np.asarray(block, dtype=self.dtype, order=self.order)
+        if self.codec is None:
+            return data.tobytes(order=self.order)
+
+        return bytes(self.codec.encode(data))
+
+    def write(self, summary: LevelWriteSummary, tile_data, tile_slices, chunk_indices):
+        """Encode and write the given chunks of an aligned tile, adding their stored
+        sizes to the summary."""
+
+        blocks = []
+        for idx in chunk_indices:
+            offset = [i * c - sl.start for i, c, sl in zip(idx, self.chunks, tile_slices)]
+            blocks.append(tile_data[tuple(slice(o, o + c) for o, c in zip(offset, self.chunks))])
+        encoded = list(chunk_encode_executor.map(self.encode, blocks))
+
+        writes = [
+            self.kvstore.write(self.separator.join(str(i) for i in idx), data)
+            for idx, data in zip(chunk_indices, encoded)
+        ]
+        for write in writes:
+            write.result()
+
+        summary.n_objects_written += len(encoded)
+        summary.n_bytes_written += sum(len(data) for data in encoded)
+
+
+def record_array_metadata(summary: LevelWriteSummary, output_dirpath):
+    summary.n_objects_written += 1
+    summary.n_bytes_written += (Path(output_dirpath)/".zarray").stat().st_size
 
 
 def create_omero_metadata_object(zarr_group_uri: str):
@@ -70,12 +224,14 @@ def create_ome_zarr_metadata(
         zarr_group_uri: str,
         name: str,
         coordinate_scales: List[float],
-        downsample_factors: List[int] = None
+        downsample_factors: List[int] = None,
+        pyramid_levels: Optional[List[PyramidLevel]] = None
     ) -> ZMeta:
     """Read a Zarr group and generate the OME-Zarr metadata for that group,
     effectively turning a group of Zarr arrays into an OME-Zarr.
     
-    If downsample factors are provided, use those to calculate scale transforms,
+    If a pyramid plan is provided, use the scales from each of its levels. If
+    downsample factors are provided, use those to calculate scale transforms,
     otherwise calculate them from the sizes of the"""
 
     # Open the group and find the arrays in it
@@ -83,7 +239,16 @@ def create_ome_zarr_metadata(
     array_keys = list(group.array_keys())
     n_pyramid_levels = len(array_keys)
 
-    if downsample_factors == None:
+    if pyramid_levels is not None:
+        # The plan already carries per-level scales, express them as ratios to the base.
+        # Take the array order from the plan, since group keys sort lexically ('10' < '2')
+        planned_levels = [level for level in pyramid_levels if level.path in array_keys]
+        array_keys = [level.path for level in planned_levels]
+        dim_ratios = [
+            [base / level_scale for base, level_scale in zip(pyramid_levels[0].scale, level.scale)]
+            for level in planned_levels
+        ]
+    elif downsample_factors == None:
         # From arrays, get their dimensions and use these to calculate the scaling factors
         # between them
         array_dims = get_array_dims(group)
@@ -110,10 +275,9 @@ def create_ome_zarr_metadata(
     return ome_zarr_metadata
 
 
-def write_array_to_disk_chunked(source_array, output_dirpath, target_chunks):
-    """Write the input array to the output path with the target array chunk size.
-    The actual read/write from source to output is also chunked, so should handle
-    large arrays without memory issues."""
+def create_output_spec(output_dirpath, dtype_name, shape, chunks, compressor=None):
+    """Create the tensorstore spec for a local Zarr array we will write. If no
+    compressor is given, the driver default is used."""
 
     output_spec = {
         'driver': 'zarr',
@@ -121,45 +285,91 @@ def write_array_to_disk_chunked(source_array, output_dirpath, target_chunks):
             'driver': 'file',
             'path': str(output_dirpath)
         },
-        'dtype': source_array.dtype.name,
+        'dtype': dtype_name,
         'metadata': {
-            'shape': source_array.shape,
-            'chunks': target_chunks,
+            'shape': shape,
+            'chunks': chunks,
             'dimension_separator': '/',
+            'dtype': np.dtype(dtype_name).str,
+            'fill_value': FILL_VALUE,
         },
+        # Chunks that are entirely fill value are not stored
+        'store_data_equal_to_fill_value': False,
     }
+    if compressor is not None:
+        output_spec['metadata']['compressor'] = compressor
 
+    return output_spec
 
-    output_array = ts.open(output_spec, create=True, delete_existing=True).result()
 
-    # TODO - should probably make this configurable
-    processing_chunk_size = [512, 512, 512, 512, 512]
-    
-    # Calculate number of chunks needed in each dimension
-    num_chunks = tuple(
-        (shape + chunk - 1) // chunk 
-        for shape, chunk in zip(source_array.shape, processing_chunk_size)
-    )
+def open_output_array(output_dirpath, dtype_name, shape, chunks, compressor=None, region=None):
+    """Create the output array. When writing only a region of it (e.g. as one of
+    several workers), an existing array is opened rather than replaced."""
+
+    output_spec = create_output_spec(output_dirpath, dtype_name, shape, chunks, compressor)
+    if region is None:
+        return ts.open(output_spec, create=True, delete_existing=True, context=get_context()).result()
+
+    return ts.open(output_spec, create=True, open=True, context=get_context()).result()
+
+
+def full_region(shape) -> Tuple[slice, ...]:
+    return tuple(slice(0, s) for s in shape)
+
+
+def tile_slices_in_region(region, tile_shape) -> List[Tuple[slice, ...]]:
+    """The tiles of tile_shape covering a region (a tuple of slices), starting at
+    its origin. Tiles at the far edges are clipped to the region."""
+
+    ranges = [range(r.start, r.stop, t) for r, t in zip(region, tile_shape)]
+    return [
+        tuple(slice(o, min(o + t, r.stop)) for o, t, r in zip(origin, tile_shape, region))
+        for origin in itertools.product(*ranges)
+    ]
+
+
+def merge_write_summaries(summary: LevelWriteSummary, other: LevelWriteSummary):
+    """Add the counts from other (e.g. another region of the same array) to summary."""
+
+    summary.n_tiles += other.n_tiles
+    summary.n_tiles_skipped += other.n_tiles_skipped
+    summary.n_chunks += other.n_chunks
+    summary.n_chunks_written += other.n_chunks_written
+    summary.n_objects_written += other.n_objects_written
+    summary.n_bytes_written += other.n_bytes_written
+    summary.nonempty_chunks.update(other.nonempty_chunks)
+
+
+def copy_region_chunked(
+        source_array,
+        output_array,
+        output_dirpath,
+        target_chunks,
+        processing_chunk_size,
+        region
+    ) -> LevelWriteSummary:
+    """Copy a region of the source array into the same region of the output array,
+    in tiles of processing_chunk_size. The region must start on output chunk
+    boundaries. Tiles that are entirely fill value are not written."""
+
+    check_processing_chunks_aligned(processing_chunk_size, target_chunks)
+    slices_list = tile_slices_in_region(region, processing_chunk_size)
 
-    # Process array in chunks
-    idx_list = list(itertools.product(*[range(n) for n in num_chunks]))
     start_time = time.time()
+    summary = LevelWriteSummary()
+    chunk_writer = ChunkWriter(output_array, output_dirpath)
     
-    for n, idx in enumerate(idx_list):
-        
-        # Calculate slice for this chunk
-        slices = tuple(
-            slice(i * c, min((i + 1) * c, s))
-            for i, c, s in zip(idx, processing_chunk_size, source_array.shape)
-        )
+    # Reads of the next tiles are in flight while we write this one
+    for n, (slices, chunk_data) in enumerate(read_tiles_ahead(source_array, slices_list)):
         
-        # Read and write this chunk
-        chunk_data = source_array[slices].read().result()
-        output_array[slices].write(chunk_data).result()
+        # Write this chunk, unless there is nothing in it
+        nonempty = record_tile(summary, chunk_data, slices, target_chunks)
+        if nonempty:
+            chunk_writer.write(summary, chunk_data, slices, nonempty)
         
         # Calculate progress and timing
         elapsed_time = time.time() - start_time
-        chunks_remaining = len(idx_list) - (n + 1)
+        chunks_remaining = len(slices_list) - (n + 1)
         
         if n > 0:  # Only calculate average after first chunk
             avg_chunk_time = elapsed_time / (n + 1)
@@ -170,31 +380,215 @@ def write_array_to_disk_chunked(source_array, output_dirpath, target_chunks):
             
         # Progress indication with timing
         rich.print(
-            f"Processed chunk [{n + 1}/{len(idx_list)}]{idx} of {tuple(n-1 for n in num_chunks)} | "
+            f"Processed chunk [{n + 1}/{len(slices_list)}] at {tuple(sl.start for sl in slices)} | "
             f"Elapsed: {str(timedelta(seconds=int(elapsed_time)))} | "
             f"ETA: {eta}"
         )
-    
+
+    return summary
+
+
+def write_array_to_disk_chunked(
+        source_array,
+        output_dirpath,
+        target_chunks,
+        compressor=None,
+        processing_chunk_size=None,
+        region=None
+    ):
+    """Write the input array to the output path with the target array chunk size.
+    The actual read/write from source to output is also chunked (by default in
+    512^5 tiles), so should handle large arrays without memory issues.
+
+    If a region (tuple of slices aligned to the processing tiles) is given, only
+    that region is written, into the existing output array if there is one.
+
+    Tiles that are entirely fill value are not written. Returns a LevelWriteSummary,
+    which only counts the array metadata when writing the whole array."""
+
+    output_array = open_output_array(
+        output_dirpath, source_array.dtype.name, source_array.shape, target_chunks, compressor, region
+    )
+
+    if processing_chunk_size is None:
+        processing_chunk_size = DEFAULT_PROCESSING_CHUNKS
+
+    summary = copy_region_chunked(
+        source_array, output_array, output_dirpath, target_chunks,
+        processing_chunk_size, region or full_region(source_array.shape)
+    )
+    if region is None:
+        record_array_metadata(summary, output_dirpath)
+
+    return summary
+
+
+def copy_region_two_pass(
+        source_array,
+        output_array,
+        output_dirpath,
+        target_chunks,
+        plan: RechunkPlan,
+        region
+    ) -> LevelWriteSummary:
+    """Copy a region of the source array into the output in two passes, via an
+    intermediate array next to the output, so that each source chunk is read once
+    and each output chunk written once."""
+
+    output_dirpath = Path(output_dirpath)
+    origin = tuple(r.start for r in region)
+    region_shape = tuple(r.stop - r.start for r in region)
+    intermediate_dirpath = output_dirpath.parent / f".{output_dirpath.name}.rechunk-{'-'.join(map(str, origin))}"
+    intermediate_spec = create_output_spec(
+        intermediate_dirpath, source_array.dtype.name, region_shape,
+        plan.intermediate_chunks, INTERMEDIATE_COMPRESSOR
+    )
+    intermediate = ts.open(intermediate_spec, create=True, delete_existing=True, context=get_context()).result()
+
+    try:
+        # Pass 1: source chunk aligned reads into the intermediate array
+        region_source = source_array[region].translate_to[0]
+        slices_list = tile_slices_in_region(full_region(region_shape), plan.read_tile)
+        start_time = time.time()
+        for n, (slices, tile_data) in enumerate(read_tiles_ahead(region_source, slices_list)):
+            intermediate[slices].write(tile_data).result()
+            rich.print(
+                f"Staged tile [{n + 1}/{len(slices_list)}] to intermediate | "
+                f"Elapsed: {str(timedelta(seconds=int(time.time() - start_time)))}"
+            )
+
+        # Pass 2: target chunk aligned reads from the intermediate array into the output
+        return copy_region_chunked(
+            intermediate.translate_to[origin], output_array, output_dirpath,
+            target_chunks, plan.write_tile, region
+        )
+    finally:
+        shutil.rmtree(intermediate_dirpath, ignore_errors=True)
+
+
+def open_transposed_source(input_array_uri: str, transpose_axes: List[int]):
+    source = ts.open({
+        'driver': 'zarr',
+        'kvstore': ensure_uri(input_array_uri),
+    }, context=get_context()).result()
+
+    return source.transpose(transpose_axes)
+
+
+def rechunk_region(
+        input_array_uri: str,
+        transpose_axes: List[int],
+        output_dirpath: Path,
+        target_chunks: List[int],
+        compressor: Optional[dict],
+        plan: RechunkPlan,
+        region: Tuple[slice, ...],
+        context_config: Optional[TensorstoreContextConfig] = None
+    ) -> LevelWriteSummary:
+    """Copy one region of the transposed source into the existing output array.
+    Runs in a worker process, so opens both arrays itself."""
+
+    if context_config is not None:
+        configure_context(context_config)
+
+    transposed = open_transposed_source(input_array_uri, transpose_axes)
+    output_spec = create_output_spec(
+        output_dirpath, transposed.dtype.name, transposed.shape, target_chunks, compressor
+    )
+    output_array = ts.open(output_spec, open=True, context=get_context()).result()
+
+    if plan.mode == "two_pass":
+        return copy_region_two_pass(transposed, output_array, output_dirpath, target_chunks, plan, region)
+
+    return copy_region_chunked(transposed, output_array, output_dirpath, target_chunks, plan.write_tile, region)
 
 
 def rechunk_and_save_array(
         input_array_uri: str,
         output_dirpath: Path,
         target_chunks: List[int],
-        transpose_axes: List[int]
+        transpose_axes: List[int],
+        compressor: Optional[dict] = None,
+        processing_chunk_size: Optional[List[int]] = None,
+        memory_limit_bytes: Optional[int] = None,
+        read_amplification_threshold: float = 2.0,
+        n_workers: Optional[int] = None
 ):
+    """Copy the input (t, c, z, y, x) array to the output with the target chunks,
+    after transposing.
+
+    The array is split into independent sub-volumes along T and C (single
+    timepoints and channels, unless the chunks span several), which are converted
+    by a pool of n_workers processes writing to disjoint regions of the output.
+
+    Tiles within each sub-volume are sized to fit memory_limit_bytes per worker.
+    If copying in processing_chunk_size tiles would decode each source chunk more
+    than read_amplification_threshold times, tiles aligned to the source chunks are
+    used instead, staging through an intermediate array if they don't fit.
+
+    Returns the LevelWriteSummary of the output."""
 
     input_array_uri = ensure_uri(input_array_uri)
+    transposed = open_transposed_source(input_array_uri, transpose_axes)
+    shape = list(transposed.shape)
+    source_chunks = list(transposed.chunk_layout.read_chunk.shape)
+
+    # Sub-volumes cover whole source and target chunks along T and C, so that no
+    # chunk is read by more than one worker or written by more than one
+    subvolume_shape = [
+        min(math.lcm(source_chunks[axis], target_chunks[axis]), shape[axis])
+        for axis in NON_SPATIAL_AXES
+    ] + shape[len(NON_SPATIAL_AXES):]
+
+    plan = plan_rechunk(
+        subvolume_shape,
+        source_chunks,
+        target_chunks,
+        processing_chunk_size or DEFAULT_PROCESSING_CHUNKS,
+        np.dtype(transposed.dtype.numpy_dtype).itemsize,
+        memory_limit_bytes or DEFAULT_RECHUNK_MEMORY_LIMIT_BYTES,
+        read_amplification_threshold,
+        n_tiles_in_memory=1 + get_readahead_tiles()
+    )
+    rich.print(plan)
 
-    source = ts.open({
-        'driver': 'zarr',
-        'kvstore': input_array_uri,
-    }).result()
+    output_spec = create_output_spec(
+        output_dirpath, transposed.dtype.name, shape, target_chunks, compressor
+    )
+    ts.open(output_spec, create=True, delete_existing=True, context=get_context()).result()
+
+    regions = tile_slices_in_region(full_region(shape), subvolume_shape)
+    n_workers = min(n_workers or os.cpu_count() or 1, len(regions))
+
+    summary = LevelWriteSummary()
+    record_array_metadata(summary, output_dirpath)
+    start_time = time.time()
+
+    def report_progress(n_done, region):
+        rich.print(
+            f"Finished sub-volume t={region[0].start} c={region[1].start} [{n_done}/{len(regions)}] | "
+            f"Elapsed: {str(timedelta(seconds=int(time.time() - start_time)))}"
+        )
+
+    args = (input_array_uri, transpose_axes, output_dirpath, target_chunks, compressor, plan)
+    if n_workers == 1:
+        for n, region in enumerate(regions):
+            merge_write_summaries(summary, rechunk_region(*args, region))
+            report_progress(n + 1, region)
+        return summary
+
+    # Spawn rather than fork, since tensorstore runs its own thread pools
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {
+            executor.submit(rechunk_region, *args, region, get_context_config()): region
+            for region in regions
+        }
+        for n, future in enumerate(as_completed(futures)):
+            merge_write_summaries(summary, future.result())
+            report_progress(n + 1, futures[future])
+
+    return summary
 
-    transposed = source.transpose(transpose_axes)
-    transposed = transposed[0,:,:,:,:]
-    write_array_to_disk_chunked(transposed, output_dirpath, target_chunks)
-    
 
 def ensure_uri(path_or_uri):
     """Convert a path or string to a proper URI if needed."""
@@ -211,14 +605,18 @@ def downsample_array_and_write_to_dirpath(
         output_dirpath: Path,
         downsample_factors: List[int],
         output_chunks: List[int],
-        downsample_method='mean'
-    ):
+        downsample_method='mean',
+        compressor: Optional[dict] = None,
+        processing_chunk_size: Optional[List[int]] = None,
+        source_summary: Optional[LevelWriteSummary] = None,
+        region: Optional[Tuple[slice, ...]] = None
+    ) -> LevelWriteSummary:
     """
     Downsample a zarr array and save the result to a new location with specified chunking.
 
     This function opens a source array, downsamples it using the specified method, and writes
     the result to a new zarr array with specified chunk sizes. The dimension separator
-    in the output is set to '/'.
+    in the output is set to '/'. Output tiles that are entirely fill value are not written.
 
     Args:
         array_uri: URI or path to source zarr array. If a local path is provided,
@@ -230,9 +628,19 @@ def downsample_array_and_write_to_dirpath(
             of the output array.
         downsample_method: string description of the downsampling method, must be one of those
             supported by tensorstore's downsampling driver
+        compressor: Zarr compressor metadata for the output chunks, if None the driver
+            default is used
+        processing_chunk_size: Shape of the tiles read and written in one go, defaults
+            to 512 in each dimension
+        source_summary: The LevelWriteSummary from writing the source array, with the
+            same chunks as output_chunks. If given, output tiles whose source region
+            contains no written chunks are skipped without reading.
+        region: If given, only this region of the output (a tuple of slices aligned
+            to the processing tiles) is written, into the existing output array if
+            there is one. The array metadata is then not counted in the summary.
 
     Returns:
-        None
+        LevelWriteSummary for the output array
 
     Example:
         >>> downsample_array_and_write_to_dirpath(
@@ -254,25 +662,24 @@ def downsample_array_and_write_to_dirpath(
                 'path': array_uri
             }
         }
-    }).result()
-
-    output_spec = {
-        'driver': 'zarr',
-        'kvstore': {
-            'driver': 'file',
-            'path': str(output_dirpath) 
-        },
-        'dtype': source.dtype.name,
-        'metadata': {
-            'shape': source.shape,
-            'chunks': output_chunks,
-            'dimension_separator': '/'
-        }
-    }
+    }, context=get_context()).result()
 
-    output_array = ts.open(output_spec, create=True, delete_existing=True).result()
+    output_array = open_output_array(
+        output_dirpath, source.dtype.name, source.shape, output_chunks, compressor, region
+    )
 
-    processing_chunk_size = [512, 512, 512, 512, 512]
+    if processing_chunk_size is None:
+        processing_chunk_size = DEFAULT_PROCESSING_CHUNKS
+    check_processing_chunks_aligned(processing_chunk_size, output_chunks)
+
+    # Each source chunk lies within the source region of exactly one output tile, so we
+    # can work out up front which output tiles have any data to downsample
+    nonempty_tiles = None
+    if source_summary is not None:
+        nonempty_tiles = {
+            tuple((i * c) // (f * p) for i, c, f, p in zip(idx, output_chunks, downsample_factors, processing_chunk_size))
+            for idx in source_summary.nonempty_chunks
+        }
     
     # Calculate number of chunks needed in each dimension
     num_chunks = tuple(
@@ -281,20 +688,48 @@ def downsample_array_and_write_to_dirpath(
     )
     
     # Process array in chunks
-    for idx in itertools.product(*[range(n) for n in num_chunks]):
-        # Calculate slice for this chunk
-        slices = tuple(
-            slice(i * c, min((i + 1) * c, s))
-            for i, c, s in zip(idx, processing_chunk_size, source.shape)
-        )
-        
-        # Read and write this chunk
-        chunk_data = source[slices].read().result()
-        output_array[slices].write(chunk_data).result()
+    summary = LevelWriteSummary()
+    chunk_writer = ChunkWriter(output_array, output_dirpath)
+    if region is None:
+        record_array_metadata(summary, output_dirpath)
+    tiles_to_read = []
+    for slices in tile_slices_in_region(region or full_region(source.shape), processing_chunk_size):
+        idx = tuple(sl.start // p for sl, p in zip(slices, processing_chunk_size))
+
+        if nonempty_tiles is not None and idx not in nonempty_tiles:
+            summary.n_tiles += 1
+            summary.n_tiles_skipped += 1
+            summary.n_chunks += count_tile_chunks(slices, output_chunks)
+            rich.print(f"Skipped empty chunk {idx} of {tuple(n-1 for n in num_chunks)}")
+            continue
+
+        tiles_to_read.append((idx, slices))
+
+    # Reads of the next tiles are in flight while we write this one
+    tile_reads = read_tiles_ahead(source, [slices for _, slices in tiles_to_read])
+    for (idx, _), (slices, chunk_data) in zip(tiles_to_read, tile_reads):
+        # Write this chunk, unless there is nothing in it
+        nonempty = record_tile(summary, chunk_data, slices, output_chunks)
+        if nonempty:
+            chunk_writer.write(summary, chunk_data, slices, nonempty)
         
         # Optional progress indication
         rich.print(f"Processed chunk {idx} of {tuple(n-1 for n in num_chunks)}")
-    
+
+    return summary
+
+
+def update_sparsity_attributes(zarr_group_uri, summaries: Dict[str, LevelWriteSummary]):
+    """Record how many chunks of each pyramid level were skipped as empty in the group
+    attributes, keeping entries for levels written by earlier runs."""
+
+    group = zarr.open_group(zarr_group_uri)
+    sparsity = dict(group.attrs.get("sparsity", {}))
+    for path, summary in summaries.items():
+        sparsity[path] = summary.model_dump() | {
+            "fraction_empty": 1 - summary.n_chunks_written / summary.n_chunks if summary.n_chunks else 0.0
+        }
+    group.attrs["sparsity"] = sparsity
 
 
 def get_array_dims(group):
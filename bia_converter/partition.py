@@ -0,0 +1,168 @@
+"""Partitioning of a pyramid conversion across independent workers (processes or hosts).
+
+Level 0 is split into blocks that stay aligned to whole processing tiles (and so
+whole chunks or shards) at every level down to a partition level. Each worker
+writes its blocks of every level down to the partition level, reading only data
+it wrote itself, so workers need no coordination and never write the same
+object. Blocks are assigned round-robin, so the assignment depends only on the
+number of workers.
+
+Each worker records a marker when it has finished. The finalize step checks all
+markers are present, builds the levels below the partition level (which are
+small) from the partition level, and writes the OME-Zarr metadata.
+"""
+import math
+import itertools
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from .pyramid import PyramidLevel
+from .omezarrgen import LevelWriteSummary
+
+
+PARTITIONS_DIRNAME = ".partitions"
+
+
+class PartitionManifest(BaseModel):
+    """Everything finalize needs to know about a partitioned conversion. Written
+    (identically) by every worker."""
+
+    num_workers: int
+    partition_level: int
+    pyramid_levels: List[PyramidLevel]
+    target_chunks: List[int]
+    processing_chunks: List[int]
+    compressor: Optional[Dict] = None
+    coordinate_scales: List[float]
+
+
+class WorkerMarker(BaseModel):
+    """Written by a worker once all of its blocks are written."""
+
+    worker_index: int
+    num_workers: int
+    n_blocks: int
+    summaries: Dict[str, LevelWriteSummary]
+
+
+def cumulative_factors(pyramid_levels: List[PyramidLevel], level_index: int) -> List[int]:
+    """Downsample factors from level 0 to the given level."""
+
+    factors = [1] * len(pyramid_levels[0].shape)
+    for level in pyramid_levels[1:level_index + 1]:
+        factors = [f * lf for f, lf in zip(factors, level.factors)]
+
+    return factors
+
+
+def block_shape(pyramid_levels: List[PyramidLevel], processing_chunks: List[int], partition_level: int) -> List[int]:
+    """Shape at level 0 of a block that is one processing tile at the partition
+    level, and so a whole number of processing tiles at every level above it."""
+
+    return [p * f for p, f in zip(processing_chunks, cumulative_factors(pyramid_levels, partition_level))]
+
+
+def count_blocks(shape: List[int], block: List[int]) -> int:
+    return math.prod(math.ceil(s / b) for s, b in zip(shape, block))
+
+
+def choose_partition_level(pyramid_levels: List[PyramidLevel], processing_chunks: List[int], num_workers: int) -> int:
+    """The coarsest level at which there are still at least num_workers blocks to
+    share out. Falls back to level 0 if even that has fewer."""
+
+    base_shape = pyramid_levels[0].shape
+    for level_index in reversed(range(len(pyramid_levels))):
+        if count_blocks(base_shape, block_shape(pyramid_levels, processing_chunks, level_index)) >= num_workers:
+            return level_index
+
+    return 0
+
+
+def partition_blocks(pyramid_levels: List[PyramidLevel], processing_chunks: List[int], partition_level: int) -> List[Tuple[slice, ...]]:
+    """All blocks covering level 0, in a fixed order."""
+
+    base_shape = pyramid_levels[0].shape
+    block = block_shape(pyramid_levels, processing_chunks, partition_level)
+    ranges = [range(0, s, b) for s, b in zip(base_shape, block)]
+
+    return [
+        tuple(slice(o, min(o + b, s)) for o, b, s in zip(origin, block, base_shape))
+        for origin in itertools.product(*ranges)
+    ]
+
+
+def blocks_for_worker(blocks: List[Tuple[slice, ...]], num_workers: int, worker_index: int) -> List[Tuple[slice, ...]]:
+    if not 0 <= worker_index < num_workers:
+        raise ValueError(f"Worker index must be between 0 and {num_workers - 1}")
+
+    return blocks[worker_index::num_workers]
+
+
+def region_at_level(block: Tuple[slice, ...], pyramid_levels: List[PyramidLevel], level_index: int) -> Tuple[slice, ...]:
+    """The region of a level covered by a level 0 block."""
+
+    factors = cumulative_factors(pyramid_levels, level_index)
+    shape = pyramid_levels[level_index].shape
+
+    return tuple(
+        slice(sl.start // f, min(math.ceil(sl.stop / f), s))
+        for sl, f, s in zip(block, factors, shape)
+    )
+
+
+def check_alignment(processing_chunks: List[int], alignment: List[int]):
+    """Workers may only share an object if a tile straddles it, so tiles must be
+    whole multiples of the chunks (or shards, which are the stored objects for
+    sharded arrays)."""
+
+    if any(p % a != 0 for p, a in zip(processing_chunks, alignment)):
+        raise ValueError(f"Processing chunks {processing_chunks} must be a multiple of {alignment} to partition writes")
+
+
+def partitions_dirpath(output_base_dirpath: Path) -> Path:
+    return Path(output_base_dirpath) / PARTITIONS_DIRNAME
+
+
+def marker_fpath(output_base_dirpath: Path, worker_index: int, num_workers: int) -> Path:
+    return partitions_dirpath(output_base_dirpath) / f"worker-{worker_index}-of-{num_workers}.json"
+
+
+def write_manifest(output_base_dirpath: Path, manifest: PartitionManifest):
+    fpath = partitions_dirpath(output_base_dirpath) / "manifest.json"
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    fpath.write_text(manifest.model_dump_json(indent=2))
+
+
+def read_manifest(output_base_dirpath: Path) -> PartitionManifest:
+    fpath = partitions_dirpath(output_base_dirpath) / "manifest.json"
+
+    return PartitionManifest.model_validate_json(fpath.read_text())
+
+
+def write_marker(output_base_dirpath: Path, marker: WorkerMarker):
+    fpath = marker_fpath(output_base_dirpath, marker.worker_index, marker.num_workers)
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    # Write then rename, so a marker is never seen half written
+    tmp_fpath = fpath.with_suffix(".tmp")
+    tmp_fpath.write_text(marker.model_dump_json(indent=2))
+    tmp_fpath.rename(fpath)
+
+
+def read_markers(output_base_dirpath: Path, manifest: PartitionManifest) -> Dict[int, WorkerMarker]:
+    """Read the markers of all workers, raising if any have not finished."""
+
+    markers = {}
+    missing = []
+    for worker_index in range(manifest.num_workers):
+        fpath = marker_fpath(output_base_dirpath, worker_index, manifest.num_workers)
+        if fpath.exists():
+            markers[worker_index] = WorkerMarker.model_validate_json(fpath.read_text())
+        else:
+            missing.append(worker_index)
+
+    if missing:
+        raise RuntimeError(f"Workers {missing} of {manifest.num_workers} have not finished")
+
+    return markers
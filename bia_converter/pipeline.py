@@ -0,0 +1,108 @@
+"""Overlapping the download, conversion and upload stages of a conversion.
+
+Staging runs file reference downloads concurrently, handing each file on as soon
+as it is available, with a bound on how many are in flight. Conversion uploads
+output files as they settle, while the converter is still writing later ones.
+"""
+import time
+import shutil
+import logging
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from .config import settings
+from .io import stage_fileref_and_get_fpath, upload_dirpath_to_s3, delete_uploaded_objects
+from .conversion import start_zarr_conversion
+
+
+logger = logging.getLogger(__name__)
+
+
+def stage_filerefs_concurrently(
+        file_references: Iterable,
+        max_workers: Optional[int] = None,
+        max_pending: Optional[int] = None
+    ) -> Iterator[Tuple[object, Path]]:
+    """Stage file references to the local cache in parallel, yielding (fileref, path)
+    pairs in completion order.
+
+    At most max_pending downloads are queued or running at once, so a slow consumer
+    holds back further staging rather than filling the cache far ahead of it."""
+
+    max_workers = max_workers or settings.staging_max_workers
+    max_pending = max_pending or 2 * max_workers
+
+    fileref_iter = iter(file_references)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+
+        def submit_next() -> bool:
+            fileref = next(fileref_iter, None)
+            if fileref is None:
+                return False
+            pending[executor.submit(stage_fileref_and_get_fpath, fileref)] = fileref
+            return True
+
+        while len(pending) < max_pending and submit_next():
+            pass
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                fileref = pending.pop(future)
+                yield fileref, future.result()
+                submit_next()
+
+
+def discard_partial_conversion(output_dirpath, dst_suffix, new_keys: List[str]):
+    """Remove the output of a failed conversion locally, and the objects this run
+    uploaded to keys not published before, so nothing partial stays public and a
+    rerun converts again. Objects from earlier runs under the suffix are kept."""
+
+    shutil.rmtree(output_dirpath, ignore_errors=True)
+    try:
+        n_deleted = delete_uploaded_objects(dst_suffix, new_keys)
+    except Exception as e:
+        logger.error(f"Could not remove the files uploaded under {dst_suffix} by the failed conversion: {e}")
+        return
+    logger.warning(f"Conversion to {output_dirpath} failed, removed it and the {n_deleted} files it uploaded")
+
+
+def run_zarr_conversion_with_incremental_upload(input_fpath, output_dirpath, dst_suffix):
+    """Run bioformats2raw, uploading output files that have not changed for
+    settings.pipeline_settle_seconds while the conversion is still running.
+
+    Files rewritten after they were uploaded (e.g. group metadata) differ from the
+    upload manifest, so the final upload of output_dirpath picks them up again. If
+    the conversion fails, the partial output is removed locally, as are the objects
+    this run added to S3."""
+
+    poll_interval = settings.pipeline_poll_interval_seconds
+    new_keys: List[str] = []
+
+    with tempfile.TemporaryFile() as log_fh:
+        process = start_zarr_conversion(input_fpath, output_dirpath, log_fh)
+
+        try:
+            while process.poll() is None:
+                time.sleep(poll_interval)
+                if Path(output_dirpath).exists() and process.poll() is None:
+                    summary = upload_dirpath_to_s3(
+                        output_dirpath, dst_suffix, min_age_seconds=settings.pipeline_settle_seconds
+                    )
+                    new_keys.extend(summary.new_keys)
+                    logger.info(f"Uploaded {summary.uploaded.n_objects} settled files while converting")
+        except BaseException:
+            process.kill()
+            process.wait()
+            discard_partial_conversion(output_dirpath, dst_suffix, new_keys)
+            raise
+
+        log_fh.seek(0)
+        output = log_fh.read().decode("utf-8", errors="replace")
+
+    if process.returncode != 0:
+        discard_partial_conversion(output_dirpath, dst_suffix, new_keys)
+    assert process.returncode == 0, f"Error converting to zarr: {output}"
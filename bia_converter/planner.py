@@ -0,0 +1,239 @@
+"""Study-level conversion planning and execution.
+
+For a study, we build a DAG of the conversions needed to produce every supported
+representation of every image that does not already exist, then run it with
+bounded parallelism. Progress is recorded in a SQLite state file so a rerun
+after a crash picks up where it left off.
+"""
+import time
+import sqlite3
+import logging
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import rich
+from pydantic import BaseModel
+from bia_integrator_api.models import ImageRepresentationUseType # type: ignore
+
+from .config import settings
+from .bia_api_client import api_client
+
+
+logger = logging.getLogger(__name__)
+
+
+PAGE_SIZE = 100
+
+
+class ConversionNode(BaseModel):
+    """A single conversion in the plan, producing target_type for one image."""
+
+    node_id: str
+    image_uuid: str
+    source_type: str
+    target_type: str
+    input_rep_uuid: Optional[str] = None
+    """Set if the input representation exists, otherwise it is the output of depends_on."""
+    depends_on: Optional[str] = None
+    size_in_bytes: int = 0
+    status: str = "pending"
+    output_rep_uuid: Optional[str] = None
+    error: Optional[str] = None
+
+
+def get_all_linked(list_func: Callable, uuid: str) -> List:
+    """Page through one of the API's 'linking' listings."""
+
+    results = []
+    start_from_uuid = None
+    while True:
+        kwargs = {"page_size": PAGE_SIZE}
+        if start_from_uuid:
+            kwargs["start_from_uuid"] = start_from_uuid
+        page = list_func(uuid, **kwargs)
+        results.extend(page)
+        if len(page) < PAGE_SIZE:
+            return results
+        start_from_uuid = page[-1].uuid
+
+
+def get_images_and_representations_for_study(accession_id: str) -> Dict:
+    """Return a mapping from image UUID to a list of that image's representations."""
+
+    study = api_client.search_study_by_accession(accession_id)
+    representations_by_image = {}
+    for dataset in get_all_linked(api_client.get_dataset_linking_study, study.uuid):
+        for image in get_all_linked(api_client.get_image_linking_dataset, dataset.uuid):
+            representations_by_image[image.uuid] = get_all_linked(
+                api_client.get_image_representation_linking_image, image.uuid
+            )
+
+    return representations_by_image
+
+
+def plan_image_conversions(image_uuid: str, representations: List, conversions: Dict) -> List[ConversionNode]:
+    """Plan the conversions for one image, by following the supported conversions
+    outwards from the representations that exist. Conversions whose output type
+    already exists are skipped."""
+
+    existing = {}
+    for rep in representations:
+        existing.setdefault(ImageRepresentationUseType(rep.use_type), rep)
+
+    nodes = {}
+    frontier = list(existing.keys())
+    while frontier:
+        source_type = frontier.pop(0)
+        for target_type in conversions.get(source_type, {}):
+            if target_type in existing or target_type in nodes:
+                continue
+
+            source_rep = existing.get(source_type)
+            upstream = nodes.get(source_type)
+            nodes[target_type] = ConversionNode(
+                node_id=f"{image_uuid}:{target_type.value}",
+                image_uuid=str(image_uuid),
+                source_type=source_type.value,
+                target_type=target_type.value,
+                input_rep_uuid=str(source_rep.uuid) if source_rep else None,
+                depends_on=upstream.node_id if upstream else None,
+                size_in_bytes=(source_rep.total_size_in_bytes or 0) if source_rep else upstream.size_in_bytes
+            )
+            frontier.append(target_type)
+
+    return list(nodes.values())
+
+
+def plan_study_conversions(accession_id: str, conversions: Dict) -> List[ConversionNode]:
+    nodes = []
+    for image_uuid, representations in get_images_and_representations_for_study(accession_id).items():
+        nodes.extend(plan_image_conversions(image_uuid, representations, conversions))
+
+    return nodes
+
+
+class PlanState:
+    """Persistent record of a plan and the progress of each node, in SQLite."""
+
+    def __init__(self, fpath: Path):
+        fpath.parent.mkdir(exist_ok=True, parents=True)
+        self.fpath = fpath
+        self.conn = sqlite3.connect(fpath)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS nodes (
+                node_id TEXT PRIMARY KEY,
+                image_uuid TEXT,
+                source_type TEXT,
+                target_type TEXT,
+                input_rep_uuid TEXT,
+                depends_on TEXT,
+                size_in_bytes INTEGER,
+                status TEXT,
+                output_rep_uuid TEXT,
+                error TEXT,
+                updated_at REAL
+            )
+        """)
+        self.conn.commit()
+
+    @classmethod
+    def for_accession(cls, accession_id: str) -> "PlanState":
+        return cls(settings.cache_root_dirpath/"plans"/f"{accession_id}.sqlite")
+
+    def load(self) -> Dict[str, ConversionNode]:
+        cursor = self.conn.execute("SELECT * FROM nodes")
+        columns = [d[0] for d in cursor.description]
+        return {
+            row[0]: ConversionNode(**{k: v for k, v in zip(columns, row) if k != "updated_at"})
+            for row in cursor.fetchall()
+        }
+
+    def add(self, nodes: List[ConversionNode]):
+        """Add nodes to the plan, leaving any already recorded untouched."""
+
+        self.conn.executemany(
+            """INSERT OR IGNORE INTO nodes VALUES
+               (:node_id, :image_uuid, :source_type, :target_type, :input_rep_uuid, :depends_on,
+                :size_in_bytes, :status, :output_rep_uuid, :error, :updated_at)""",
+            [node.model_dump() | {"updated_at": time.time()} for node in nodes]
+        )
+        self.conn.commit()
+
+    def update(self, node: ConversionNode):
+        self.conn.execute(
+            "UPDATE nodes SET status = ?, output_rep_uuid = ?, error = ?, updated_at = ? WHERE node_id = ?",
+            (node.status, node.output_rep_uuid, node.error, time.time(), node.node_id)
+        )
+        self.conn.commit()
+
+
+def print_plan(nodes: List[ConversionNode]):
+    for node in sorted(nodes, key=lambda n: n.size_in_bytes, reverse=True):
+        dependency = f" after {node.depends_on}" if node.depends_on else ""
+        rich.print(
+            f"{node.status}: {node.image_uuid}: {node.source_type} -> {node.target_type} "
+            f"({node.size_in_bytes} bytes){dependency}"
+        )
+
+
+def run_node(node: ConversionNode, input_rep_uuid: str, conversions: Dict, force: bool = False):
+    input_rep = api_client.get_image_representation(input_rep_uuid)
+    conversion_function = conversions[ImageRepresentationUseType(node.source_type)][ImageRepresentationUseType(node.target_type)]
+
+    return conversion_function(input_rep, force=force)
+
+
+def run_plan(state: PlanState, conversions: Dict, max_workers: int = 4, force: bool = False):
+    """Run all unfinished nodes in the plan, largest first, with at most max_workers
+    at once. A node runs once the node it depends on is done. Nodes that were
+    running when an earlier run stopped, or that failed, are run again.
+
+    Conversions whose output already exists return it without converting, unless
+    force is set."""
+
+    nodes = state.load()
+    for node in nodes.values():
+        if node.status in ("running", "failed"):
+            node.status = "pending"
+            node.error = None
+            state.update(node)
+
+    def ready_nodes():
+        ready = [
+            node for node in nodes.values()
+            if node.status == "pending"
+            and (node.depends_on is None or nodes[node.depends_on].status == "done")
+        ]
+        return sorted(ready, key=lambda n: n.size_in_bytes, reverse=True)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while True:
+            for node in ready_nodes()[:max_workers - len(running)]:
+                input_rep_uuid = node.input_rep_uuid or nodes[node.depends_on].output_rep_uuid
+                node.status = "running"
+                state.update(node)
+                logger.info(f"Running {node.node_id} from {input_rep_uuid}")
+                running[executor.submit(run_node, node, input_rep_uuid, conversions, force)] = node
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                try:
+                    output_rep = future.result()
+                    node.status = "done"
+                    node.output_rep_uuid = str(output_rep.uuid)
+                except Exception as e:
+                    logger.exception(f"Conversion {node.node_id} failed")
+                    node.status = "failed"
+                    node.error = str(e)
+                state.update(node)
+
+    n_done = sum(node.status == "done" for node in nodes.values())
+    n_failed = sum(node.status == "failed" for node in nodes.values())
+    n_blocked = sum(node.status == "pending" for node in nodes.values())
+    rich.print(f"{n_done} done, {n_failed} failed, {n_blocked} blocked by failures, of {len(nodes)} conversions")
@@ -1,13 +1,235 @@
 """BIA Proxy image classes + functionality to enable determination of
 image properties."""
 
-from typing import Optional, List
+import logging
+import functools
+import threading
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional, List, Tuple
 
 import zarr
+import numpy as np
 import dask.array as da
+import tensorstore as ts # type: ignore
 from pydantic import BaseModel
 
 from .omezarrmeta import ZMeta, DataSet, CoordinateTransformation
+from .tscontext import get_context
+
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkCache:
+    """Process-wide LRU cache of decoded zarr chunks, bounded by total bytes.
+
+    Keys are (array URI, cache token, chunk grid index), so every OMEZarrImage
+    opened on the same version of an array shares entries."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            chunk = self._entries.get(key)
+            if chunk is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return chunk
+
+    def put(self, key, chunk: np.ndarray):
+        if chunk.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = chunk
+            self.n_bytes += chunk.nbytes
+            while self.n_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.n_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.n_bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "n_chunks": len(self._entries),
+            "n_bytes": self.n_bytes,
+            "max_bytes": self.max_bytes
+        }
+
+
+# Shared by all images in this process
+chunk_cache = ChunkCache(max_bytes=512 * 1024 * 1024)
+
+# For arrays without a tensorstore handle, chunks are read with zarr on these threads
+zarr_chunk_executor = ThreadPoolExecutor(max_workers=16)
+
+
+@functools.lru_cache(maxsize=64)
+def open_tensorstore_array(array_uri: str, cache_token: str = ""):
+    """Open a zarr array for reading with tensorstore, which issues chunk reads
+    concurrently and decodes them in parallel. Handles are reused, so the
+    metadata is only read once per array (and cache token, so a rewritten array
+    can be opened again under a new token)."""
+
+    # Imported here, omezarrgen imports this module
+    from .omezarrgen import ensure_uri
+
+    return ts.open({
+        'driver': 'zarr',
+        'kvstore': ensure_uri(array_uri),
+    }, read=True, context=get_context()).result()
+
+
+class CachedZarrArray:
+    """Array-like wrapper around a zarr array that reads whole chunks through the
+    shared chunk cache, so it can be used with da.from_array or read directly.
+
+    All chunks missing from the cache for a read are requested at once, through
+    tensorstore if the array has a URI, otherwise with zarr on a thread pool."""
+
+    def __init__(
+            self,
+            zarr_array: zarr.Array,
+            array_uri: Optional[str],
+            cache: Optional[ChunkCache] = chunk_cache,
+            use_tensorstore: bool = True,
+            cache_token: str = ""
+        ):
+        self.zarr_array = zarr_array
+        self.array_uri = array_uri
+        self.cache_token = cache_token
+        # Without a URI there is no key to share cache entries under
+        self.cache = cache if array_uri is not None else None
+        self.shape = zarr_array.shape
+        self.dtype = zarr_array.dtype
+        self.ndim = zarr_array.ndim
+        self.chunks = zarr_array.chunks
+        self.ts_array = None
+        if use_tensorstore and array_uri is not None:
+            try:
+                self.ts_array = open_tensorstore_array(array_uri, cache_token)
+            except ValueError as e:
+                logger.warning(f"Can't open {array_uri} with tensorstore, reading with zarr: {e}")
+
+    def chunk_slices(self, idx) -> Tuple[slice, ...]:
+        return tuple(
+            slice(i * c, min((i + 1) * c, s))
+            for i, c, s in zip(idx, self.chunks, self.shape)
+        )
+
+    def get_chunks(self, idxs: Iterable[tuple]) -> Dict[tuple, np.ndarray]:
+        """Get the given chunks, from the cache where possible, fetching the rest
+        concurrently."""
+
+        chunks = {}
+        missing = []
+        for idx in idxs:
+            chunk = self.cache.get((self.array_uri, self.cache_token, idx)) if self.cache else None
+            if chunk is None:
+                missing.append(idx)
+            else:
+                chunks[idx] = chunk
+
+        if self.ts_array is not None:
+            futures = [self.ts_array[self.chunk_slices(idx)].read() for idx in missing]
+            fetched = [future.result() for future in futures]
+        else:
+            fetched = list(zarr_chunk_executor.map(lambda idx: self.zarr_array.blocks[idx], missing))
+
+        for idx, chunk in zip(missing, fetched):
+            if self.cache:
+                self.cache.put((self.array_uri, self.cache_token, idx), chunk)
+            chunks[idx] = chunk
+
+        return chunks
+
+    def get_chunk(self, idx) -> np.ndarray:
+        return self.get_chunks([idx])[idx]
+
+    def normalise_selection(self, selection) -> Tuple[List[slice], List[int]]:
+        """Normalise a selection to slices, and the axes that were integer-indexed."""
+
+        if not isinstance(selection, tuple):
+            selection = (selection,)
+        selection = selection + (slice(None),) * (self.ndim - len(selection))
+
+        slices = []
+        int_axes = []
+        for axis, (sel, size) in enumerate(zip(selection, self.shape)):
+            if isinstance(sel, slice):
+                start, stop, step = sel.indices(size)
+                if step != 1:
+                    raise IndexError("Only unit step slices are supported")
+                slices.append(slice(start, max(start, stop)))
+            else:
+                index = int(sel)
+                if not -size <= index < size:
+                    raise IndexError(f"Index {index} is out of bounds for axis {axis} with size {size}")
+                index %= size
+                slices.append(slice(index, index + 1))
+                int_axes.append(axis)
+
+        return slices, int_axes
+
+    def chunk_indices(self, slices: List[slice]) -> Iterable[tuple]:
+        chunk_ranges = [
+            range(s.start // c, (s.stop - 1) // c + 1) if s.stop > s.start else range(0)
+            for s, c in zip(slices, self.chunks)
+        ]
+        return itertools.product(*chunk_ranges)
+
+    def read_regions(self, selections: List) -> List[np.ndarray]:
+        """Read several regions (e.g. the same plane of each channel), fetching all
+        the chunks they need at once."""
+
+        normalised = [self.normalise_selection(selection) for selection in selections]
+        idxs = set()
+        for slices, _ in normalised:
+            idxs.update(self.chunk_indices(slices))
+        chunks = self.get_chunks(sorted(idxs))
+
+        return [self.assemble(slices, int_axes, chunks) for slices, int_axes in normalised]
+
+    def __getitem__(self, selection):
+        return self.read_regions([selection])[0]
+
+    def assemble(self, slices: List[slice], int_axes: List[int], chunks: Dict[tuple, np.ndarray]) -> np.ndarray:
+        out = np.empty(tuple(s.stop - s.start for s in slices), dtype=self.dtype)
+        for idx in self.chunk_indices(slices):
+            chunk = chunks[idx]
+            src = []
+            dst = []
+            for i, s, c in zip(idx, slices, self.chunks):
+                chunk_start = i * c
+                lo = max(s.start, chunk_start)
+                hi = min(s.stop, chunk_start + c)
+                src.append(slice(lo - chunk_start, hi - chunk_start))
+                dst.append(slice(lo - s.start, hi - s.start))
+            out[tuple(dst)] = chunk[tuple(src)]
+
+        if int_axes:
+            out = out.squeeze(axis=tuple(int_axes))
+
+        return out
 
 
 class OMEZarrImage(BaseModel):
@@ -32,6 +254,10 @@ class OMEZarrImage(BaseModel):
     PhysicalSizeZ: Optional[float] = None
 
     ngff_metadata: ZMeta | None = None
+    uri: Optional[str] = None
+    # Distinguishes versions of the image (e.g. by a metadata fingerprint) in the
+    # process-wide tensorstore handle and chunk caches
+    cache_token: str = ""
 
     class Config:
         arbitrary_types_allowed=True
@@ -53,7 +279,7 @@ AXIS_NAME_LOOKUP = {
     "z": "PhysicalSizeZ"
 }
 
-def calculate_voxel_to_physical_factors(ngff_metadata, ignore_unit_errors=False):
+def calculate_voxel_to_physical_factors(ngff_metadata, ignore_unit_errors=False, multiscale_index=0):
     """Given ngff_metadata, calculate the voxel to physical space scale factors
     in m for each spatial dimension.
     
@@ -61,13 +287,13 @@ def calculate_voxel_to_physical_factors(ngff_metadata, ignore_unit_errors=False)
     
     scale_transformations = [
         ct
-        for ct in ngff_metadata.multiscales[0].datasets[0].coordinateTransformations
+        for ct in ngff_metadata.multiscales[multiscale_index].datasets[0].coordinateTransformations
         if ct.type == 'scale'
     ]
 
     factors = {}
     
-    for scale, axis in zip(scale_transformations[0].scale, ngff_metadata.multiscales[0].axes):
+    for scale, axis in zip(scale_transformations[0].scale, ngff_metadata.multiscales[multiscale_index].axes):
         if axis.type == 'space':
             attribute_name = AXIS_NAME_LOOKUP[axis.name]
             unit_multiplier = UNIT_LOOKUP.get(axis.unit, None)
@@ -218,16 +444,22 @@ def validate_scale_ratios_and_extract_xyz(scale_ratios: dict[str, list[float]])
     }     
 
 
-def ome_zarr_image_from_ome_zarr_uri(uri, ignore_unit_errors=False):
+def ome_zarr_image_from_ome_zarr_uri(uri, ignore_unit_errors=False, multiscale_index=None):
     """Generate a OME Zarr image object by reading an OME Zarr and
-    parsing the NGFF metadata for properties."""
+    parsing the NGFF metadata for properties.
+    
+    If the group has more than one multiscale image, multiscale_index selects
+    which to use."""
     
     zgroup = zarr.open(uri)
     ngff_metadata = ZMeta.parse_obj(zgroup.attrs.asdict())
 
-    assert len(ngff_metadata.multiscales) == 1
+    if multiscale_index is None:
+        assert len(ngff_metadata.multiscales) == 1, \
+            f"{uri} has {len(ngff_metadata.multiscales)} multiscale images, choose one with multiscale_index"
+        multiscale_index = 0
     
-    multiscale = ngff_metadata.multiscales[0]
+    multiscale = ngff_metadata.multiscales[multiscale_index]
 
     dimension_str = ''.join(a.name for a in multiscale.axes).lower() # type: ignore
     base_path_key = multiscale.datasets[0].path
@@ -243,10 +475,11 @@ def ome_zarr_image_from_ome_zarr_uri(uri, ignore_unit_errors=False):
     init_dict.update(scale_dict)
 
     init_dict['zgroup'] = zgroup
+    init_dict['uri'] = str(uri).rstrip('/')
 
     ome_zarr_image = OMEZarrImage(**init_dict)
     
-    factors = calculate_voxel_to_physical_factors(ngff_metadata, ignore_unit_errors)
+    factors = calculate_voxel_to_physical_factors(ngff_metadata, ignore_unit_errors, multiscale_index)
     ome_zarr_image.__dict__.update(factors)
 
     ome_zarr_image.ngff_metadata = ngff_metadata
@@ -254,7 +487,9 @@ def ome_zarr_image_from_ome_zarr_uri(uri, ignore_unit_errors=False):
     return ome_zarr_image
 
 
-def get_array_with_min_dimensions(ome_zarr_image: OMEZarrImage, dims: tuple):
+def select_path_key_with_min_dimensions(ome_zarr_image: OMEZarrImage, dims: tuple) -> str:
+    """The smallest pyramid level at least dims in size, or the largest level."""
+
     ydim, xdim = dims
 
     for path_key in reversed(ome_zarr_image.path_keys):
@@ -264,8 +499,35 @@ def get_array_with_min_dimensions(ome_zarr_image: OMEZarrImage, dims: tuple):
 
         if (size_y >= ydim) and (size_x >= xdim):
             break
-    
-    return da.from_zarr(zarr_array)
+
+    return path_key
+
+
+def get_region_reader_with_min_dimensions(ome_zarr_image: OMEZarrImage, dims: tuple) -> CachedZarrArray:
+    """Array for reading small regions (e.g. planes for rendering) directly, without
+    building a dask graph."""
+
+    path_key = select_path_key_with_min_dimensions(ome_zarr_image, dims)
+    array_uri = f"{ome_zarr_image.uri}/{path_key}" if ome_zarr_image.uri is not None else None
+
+    return CachedZarrArray(ome_zarr_image.zgroup[path_key], array_uri, cache_token=ome_zarr_image.cache_token)
+
+
+def get_array_with_min_dimensions(ome_zarr_image: OMEZarrImage, dims: tuple):
+    """Dask array of the smallest pyramid level at least dims in size, for
+    computations over whole arrays. Use get_region_reader_with_min_dimensions to
+    read small regions."""
+
+    path_key = select_path_key_with_min_dimensions(ome_zarr_image, dims)
+    zarr_array = ome_zarr_image.zgroup[path_key]
+
+    if ome_zarr_image.uri is None:
+        return da.from_zarr(zarr_array)
+
+    # Read through the shared chunk cache, so repeated renders of the same image
+    # don't fetch and decode the same chunks again
+    cached_array = CachedZarrArray(zarr_array, f"{ome_zarr_image.uri}/{path_key}", cache_token=ome_zarr_image.cache_token)
+    return da.from_array(cached_array, chunks=zarr_array.chunks, asarray=False)
     
 
 def generate_datasets(ome_zarr_image: OMEZarrImage):
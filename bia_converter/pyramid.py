@@ -0,0 +1,128 @@
+"""Planning of OME-Zarr resolution pyramids.
+
+Rather than applying the same downsample factors at every level, the planner
+picks per-level, per-axis factors from the array shape, the physical voxel
+sizes and the output chunk shape:
+
+* An axis stops being downsampled once it fits within a single chunk.
+* Axes that are much coarser than the finest axis are held back until the
+  others catch up, so voxels stay close to isotropic.
+* Planning stops as soon as no axis can usefully be downsampled, so we never
+  produce levels that are identical to the one before.
+"""
+import math
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+
+# Our arrays are always (t, c, z, y, x), only the last three are ever downsampled
+SPATIAL_AXES = (2, 3, 4)
+
+
+class PyramidLevel(BaseModel):
+    """A single level of a planned resolution pyramid."""
+
+    path: str
+    shape: List[int]
+    factors: List[int]
+    """Downsample factors relative to the previous level."""
+    scale: List[float]
+    """Voxel to physical space coordinate scales for this level."""
+
+
+def choose_level_factors(
+        shape: List[int],
+        scale: List[float],
+        chunk_shape: List[int],
+        max_anisotropy: float = 2.0
+    ) -> List[int]:
+    """Choose the downsample factors to go from a level with the given shape and
+    scales to the next level.
+
+    Only spatial axes that are still larger than their chunk size are candidates.
+    Of these, we downsample those whose voxel size is within max_anisotropy of the
+    finest candidate axis. All factors are 1 if nothing should be downsampled."""
+
+    factors = [1] * len(shape)
+
+    candidates = [
+        axis for axis in SPATIAL_AXES
+        if shape[axis] > chunk_shape[axis]
+    ]
+    if not candidates:
+        return factors
+
+    # Treat unset or nonsensical scales as unit scales
+    voxel_sizes = {
+        axis: scale[axis] if scale[axis] > 0 else 1.0
+        for axis in candidates
+    }
+    finest = min(voxel_sizes.values())
+
+    for axis in candidates:
+        if voxel_sizes[axis] < max_anisotropy * finest:
+            factors[axis] = 2
+
+    return factors
+
+
+def plan_pyramid(
+        shape: List[int],
+        coordinate_scales: List[float],
+        chunk_shape: List[int],
+        max_levels: Optional[int] = None,
+        max_anisotropy: float = 2.0
+    ) -> List[PyramidLevel]:
+    """Plan a resolution pyramid for a (t, c, z, y, x) array.
+
+    Args:
+        shape: Shape of the base (full resolution) array.
+        coordinate_scales: Voxel to physical space scales of the base array.
+        chunk_shape: Chunk shape used for every level of the output.
+        max_levels: If set, the maximum number of levels (including the base).
+        max_anisotropy: Axes coarser than this multiple of the finest axis are
+            not downsampled at a given level.
+
+    Returns:
+        List of PyramidLevel objects, starting with the base level.
+
+    Example:
+        A 20 x 2048 x 2048 stack with 64^3 chunks never downsamples Z, and
+        stops once Y and X reach 64:
+
+        >>> [l.shape for l in plan_pyramid([1, 1, 20, 2048, 2048], [1.0] * 5, [1, 1, 64, 64, 64])]
+        [[1, 1, 20, 2048, 2048], [1, 1, 20, 1024, 1024], ..., [1, 1, 20, 64, 64]]
+    """
+
+    if not (len(shape) == len(coordinate_scales) == len(chunk_shape)):
+        raise ValueError("Shape, coordinate scales and chunk shape must have the same rank")
+
+    level_shape = list(shape)
+    level_scale = list(coordinate_scales)
+    levels = [
+        PyramidLevel(
+            path="0",
+            shape=level_shape,
+            factors=[1] * len(shape),
+            scale=level_scale
+        )
+    ]
+
+    while max_levels is None or len(levels) < max_levels:
+        factors = choose_level_factors(level_shape, level_scale, chunk_shape, max_anisotropy)
+        if all(f == 1 for f in factors):
+            break
+
+        level_shape = [math.ceil(s / f) for s, f in zip(level_shape, factors)]
+        level_scale = [s * f for s, f in zip(level_scale, factors)]
+        levels.append(
+            PyramidLevel(
+                path=str(len(levels)),
+                shape=level_shape,
+                factors=factors,
+                scale=level_scale
+            )
+        )
+
+    return levels
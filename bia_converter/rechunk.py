@@ -0,0 +1,156 @@
+"""Planning of rechunking copies between arrays with different chunk layouts.
+
+Copying in fixed tiles that ignore the source chunking (e.g. thin z-slab chunks
+read as cubes after a transpose) decodes each source chunk many times. The plan
+either picks copy tiles aligned to both layouts, or, if those don't fit in the
+memory limit, stages through an intermediate array on disk (as rechunker does):
+
+1. Read tiles that are whole multiples of the source chunks, and write them to an
+   intermediate array whose chunks divide both the read and the write tiles.
+2. Read tiles that are whole multiples of the target chunks from the intermediate
+   array, and write them to the target.
+
+Each source chunk is then read once, and each target chunk written once.
+"""
+import math
+from typing import List, Literal, Optional
+
+from pydantic import BaseModel
+
+
+class RechunkPlan(BaseModel):
+    mode: Literal["direct", "two_pass"]
+    read_tile: List[int]
+    """Tile shape read from the source (the copy tile for a direct copy)."""
+    write_tile: List[int]
+    """Tile shape written to the target."""
+    intermediate_chunks: Optional[List[int]] = None
+    predicted_read_amplification: float
+    """Source chunk decodes per source chunk, with the (memory limited) processing tiles."""
+
+
+def axis_read_amplification(size: int, tile: int, chunk: int) -> float:
+    """Average number of tiles each chunk along one axis is read by."""
+
+    n_chunks = math.ceil(size / chunk)
+    n_reads = 0
+    for start in range(0, size, tile):
+        stop = min(start + tile, size)
+        n_reads += (stop - 1) // chunk - start // chunk + 1
+
+    return n_reads / n_chunks
+
+
+def predict_read_amplification(shape: List[int], tile_shape: List[int], source_chunks: List[int]) -> float:
+    """Number of times, on average, each source chunk is decoded when copying in
+    tiles of tile_shape."""
+
+    return math.prod(
+        axis_read_amplification(s, t, c)
+        for s, t, c in zip(shape, tile_shape, source_chunks)
+    )
+
+
+def tile_bytes(tile_shape: List[int], shape: List[int], itemsize: int) -> int:
+    return math.prod(min(t, s) for t, s in zip(tile_shape, shape)) * itemsize
+
+
+def grow_tile(base: List[int], limit: List[int], shape: List[int], itemsize: int, max_bytes: int) -> List[int]:
+    """Grow a tile from base by doubling axes (the one furthest from its limit first),
+    keeping each axis a multiple of base, capped at limit, and the tile within max_bytes."""
+
+    tile = list(base)
+    while True:
+        candidates = [
+            a for a in range(len(tile))
+            if tile[a] < limit[a] and tile[a] < shape[a]
+        ]
+        candidates.sort(key=lambda a: tile[a] / min(limit[a], shape[a]))
+        for a in candidates:
+            grown = list(tile)
+            grown[a] = min(tile[a] * 2, limit[a])
+            if tile_bytes(grown, shape, itemsize) <= max_bytes:
+                tile = grown
+                break
+        else:
+            return tile
+
+
+def shrink_tile(tile: List[int], chunks: List[int], shape: List[int], itemsize: int, max_bytes: int) -> List[int]:
+    """Shrink a tile to fit max_bytes by halving its longest axes, keeping each a
+    multiple of chunks. Axes longer than the array are first cut to the array
+    (rounded up to whole chunks). May still exceed max_bytes at a single chunk."""
+
+    tile = [min(t, math.ceil(s / c) * c) for t, c, s in zip(tile, chunks, shape)]
+    while tile_bytes(tile, shape, itemsize) > max_bytes:
+        candidates = [
+            a for a in range(len(tile))
+            if tile[a] % 2 == 0 and (tile[a] // 2) % chunks[a] == 0
+        ]
+        if not candidates:
+            break
+        a = max(candidates, key=lambda a: min(tile[a], shape[a]))
+        tile[a] //= 2
+
+    return tile
+
+
+def plan_rechunk(
+        shape: List[int],
+        source_chunks: List[int],
+        target_chunks: List[int],
+        processing_chunks: List[int],
+        itemsize: int,
+        memory_limit_bytes: int,
+        read_amplification_threshold: float = 2.0,
+        n_tiles_in_memory: int = 1
+    ) -> RechunkPlan:
+    """Decide how to copy an array of shape from source_chunks to target_chunks.
+
+    The configured processing tiles are shrunk to fit the memory limit if needed,
+    and kept unless they are predicted to decode source chunks more than
+    read_amplification_threshold times each. Otherwise a tile aligned to both chunk
+    layouts is used if it fits in the memory limit, and if not, the copy is staged
+    through an intermediate array. n_tiles_in_memory is the number of tiles held
+    at once (e.g. including read-ahead)."""
+
+    # A chunk larger than the array is effectively the size of the array
+    source_chunks = [min(c, s) for c, s in zip(source_chunks, shape)]
+    max_tile_bytes = memory_limit_bytes // n_tiles_in_memory
+
+    processing_tile = shrink_tile(processing_chunks, target_chunks, shape, itemsize, max_tile_bytes)
+    amplification = predict_read_amplification(shape, processing_tile, source_chunks)
+
+    if amplification <= read_amplification_threshold:
+        return RechunkPlan(
+            mode="direct",
+            read_tile=processing_tile,
+            write_tile=processing_tile,
+            predicted_read_amplification=amplification
+        )
+
+    aligned_tile = [math.lcm(s, t) for s, t in zip(source_chunks, target_chunks)]
+    if tile_bytes(aligned_tile, shape, itemsize) <= max_tile_bytes:
+        return RechunkPlan(
+            mode="direct",
+            read_tile=aligned_tile,
+            write_tile=aligned_tile,
+            predicted_read_amplification=amplification
+        )
+
+    if tile_bytes(source_chunks, shape, itemsize) > max_tile_bytes:
+        raise ValueError(f"A single source chunk {source_chunks} does not fit in the memory limit of {memory_limit_bytes} bytes")
+
+    # Grow both tiles towards the aligned tile, so the intermediate chunks that
+    # divide both are as large as possible
+    read_tile = grow_tile(source_chunks, aligned_tile, shape, itemsize, max_tile_bytes)
+    write_tile = grow_tile(target_chunks, aligned_tile, shape, itemsize, max_tile_bytes)
+    intermediate_chunks = [math.gcd(r, w) for r, w in zip(read_tile, write_tile)]
+
+    return RechunkPlan(
+        mode="two_pass",
+        read_tile=read_tile,
+        write_tile=write_tile,
+        intermediate_chunks=intermediate_chunks,
+        predicted_read_amplification=amplification
+    )
@@ -0,0 +1,417 @@
+"""Reading members of remote zip archives with HTTP range requests.
+
+Submissions are often uploaded as large zips, with file references pointing at
+members inside them. Rather than download the whole archive, we read its central
+directory from the end of the file (a few range requests, cached per archive),
+then fetch only the byte ranges of the members we need:
+
+* Large members are split into parts fetched in parallel.
+* Small members that sit close together in the archive are fetched with one
+  request covering all of them.
+
+Members are decompressed as they are written, and checked against the CRC in the
+central directory.
+"""
+import bz2
+import zlib
+import struct
+import hashlib
+import logging
+import threading
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import requests
+from pydantic import BaseModel
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .config import settings
+from .filecache import StreamingHasher, write_entry
+
+
+logger = logging.getLogger(__name__)
+
+
+EOCD_SIGNATURE = b"PK\x05\x06"
+ZIP64_EOCD_LOCATOR_SIGNATURE = b"PK\x06\x07"
+ZIP64_EOCD_SIGNATURE = b"PK\x06\x06"
+CENTRAL_DIRECTORY_SIGNATURE = b"PK\x01\x02"
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+
+EOCD_STRUCT = struct.Struct("<4s4H2LH")
+ZIP64_EOCD_LOCATOR_STRUCT = struct.Struct("<4sLQL")
+ZIP64_EOCD_STRUCT = struct.Struct("<4sQ2H2L4Q")
+CENTRAL_DIRECTORY_STRUCT = struct.Struct("<4s6H3L5H2L")
+LOCAL_HEADER_STRUCT = struct.Struct("<4s5H3L2H")
+
+# The EOCD record is at most this far from the end (fixed part plus maximum comment)
+MAX_EOCD_SEARCH_BYTES = EOCD_STRUCT.size + 0xFFFF
+
+# Members larger than this are fetched in parallel parts of this size
+RANGE_PART_BYTES = 16 * 1024 * 1024
+# Neighbouring small members are fetched together if the gap between them is at most
+# this, and a single coalesced request covers at most RANGE_PART_BYTES
+COALESCE_GAP_BYTES = 1024 * 1024
+
+STORED = 0
+DEFLATED = 8
+BZIP2 = 12
+
+
+class ZipMember(BaseModel):
+    name: str
+    header_offset: int
+    compressed_size: int
+    file_size: int
+    compress_type: int
+    crc: int
+    span_end: int
+    """Offset at which the next member (or the central directory) starts. The
+    bytes from header_offset to here hold the local header, data and any data
+    descriptor, so the member can be fetched in one request without first
+    reading its local header."""
+
+
+class ZipDirectory(BaseModel):
+    archive_uri: str
+    archive_size: int
+    etag: Optional[str] = None
+    members: Dict[str, ZipMember]
+
+
+def create_session() -> requests.Session:
+    session = requests.Session()
+    retries = Retry(
+        total=3,
+        backoff_factor=0.3, # type: ignore
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=frozenset({'GET', 'HEAD'})
+    )
+    adapter = HTTPAdapter(max_retries=retries, pool_maxsize=settings.staging_max_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def fetch_range(session: requests.Session, uri: str, start: int, stop: int) -> bytes:
+    """Fetch bytes [start, stop) of the object at uri."""
+
+    response = session.get(uri, headers={"Range": f"bytes={start}-{stop - 1}"})
+    response.raise_for_status()
+    if response.status_code != 206:
+        raise IOError(f"{uri} does not support range requests (status {response.status_code})")
+    if len(response.content) != stop - start:
+        raise IOError(f"Range {start}-{stop} of {uri} gave {len(response.content)} bytes")
+
+    return response.content
+
+
+def parse_zip64_extra(extra: bytes, file_size: int, compressed_size: int, header_offset: int) -> Tuple[int, int, int]:
+    """Replace values saturated at 0xFFFFFFFF with those in the ZIP64 extra field."""
+
+    position = 0
+    while position + 4 <= len(extra):
+        field_id, field_size = struct.unpack_from("<2H", extra, position)
+        position += 4
+        if field_id == 0x0001:
+            values = iter(struct.unpack_from(f"<{field_size // 8}Q", extra, position))
+            if file_size == 0xFFFFFFFF:
+                file_size = next(values)
+            if compressed_size == 0xFFFFFFFF:
+                compressed_size = next(values)
+            if header_offset == 0xFFFFFFFF:
+                header_offset = next(values)
+            break
+        position += field_size
+
+    return file_size, compressed_size, header_offset
+
+
+def parse_central_directory(data: bytes, n_entries: int, cd_offset: int) -> List[ZipMember]:
+    entries = []
+    position = 0
+    for _ in range(n_entries):
+        (signature, _, _, flags, compress_type, _, _, crc, compressed_size, file_size,
+         name_length, extra_length, comment_length, _, _, _, header_offset) = CENTRAL_DIRECTORY_STRUCT.unpack_from(data, position)
+        if signature != CENTRAL_DIRECTORY_SIGNATURE:
+            raise IOError(f"Bad central directory entry at offset {cd_offset + position}")
+        position += CENTRAL_DIRECTORY_STRUCT.size
+
+        name_bytes = data[position:position + name_length]
+        # Bit 11 marks UTF-8 names, otherwise they are cp437
+        name = name_bytes.decode("utf-8" if flags & 0x800 else "cp437")
+        extra = data[position + name_length:position + name_length + extra_length]
+        position += name_length + extra_length + comment_length
+
+        file_size, compressed_size, header_offset = parse_zip64_extra(extra, file_size, compressed_size, header_offset)
+        entries.append((name, header_offset, compressed_size, file_size, compress_type, crc))
+
+    # Each member's bytes run up to the start of the next member by offset
+    offsets = sorted({entry[1] for entry in entries}) + [cd_offset]
+    next_offset = {offset: offsets[i + 1] for i, offset in enumerate(offsets[:-1])}
+
+    return [
+        ZipMember(
+            name=name,
+            header_offset=header_offset,
+            compressed_size=compressed_size,
+            file_size=file_size,
+            compress_type=compress_type,
+            crc=crc,
+            span_end=next_offset[header_offset]
+        )
+        for name, header_offset, compressed_size, file_size, compress_type, crc in entries
+    ]
+
+
+def read_zip_directory(archive_uri: str, session: Optional[requests.Session] = None) -> ZipDirectory:
+    """Read the central directory of a remote zip, with two or three range requests."""
+
+    session = session or create_session()
+    head = session.head(archive_uri, allow_redirects=True)
+    head.raise_for_status()
+    archive_size = int(head.headers["Content-Length"])
+
+    tail_start = max(0, archive_size - MAX_EOCD_SEARCH_BYTES)
+    tail = fetch_range(session, archive_uri, tail_start, archive_size)
+    eocd_position = tail.rfind(EOCD_SIGNATURE)
+    if eocd_position < 0:
+        raise IOError(f"{archive_uri} is not a zip archive (no end of central directory record)")
+    _, _, _, _, n_entries, cd_size, cd_offset, _ = EOCD_STRUCT.unpack_from(tail, eocd_position)
+
+    locator_position = eocd_position - ZIP64_EOCD_LOCATOR_STRUCT.size
+    if locator_position >= 0 and tail[locator_position:locator_position + 4] == ZIP64_EOCD_LOCATOR_SIGNATURE:
+        _, _, zip64_eocd_offset, _ = ZIP64_EOCD_LOCATOR_STRUCT.unpack_from(tail, locator_position)
+        if zip64_eocd_offset >= tail_start:
+            record = tail[zip64_eocd_offset - tail_start:]
+        else:
+            record = fetch_range(session, archive_uri, zip64_eocd_offset, zip64_eocd_offset + ZIP64_EOCD_STRUCT.size)
+        if record[:4] != ZIP64_EOCD_SIGNATURE:
+            raise IOError(f"Bad ZIP64 end of central directory record in {archive_uri}")
+        _, _, _, _, _, _, _, n_entries, cd_size, cd_offset = ZIP64_EOCD_STRUCT.unpack_from(record)
+
+    if cd_offset >= tail_start:
+        cd_data = tail[cd_offset - tail_start:cd_offset - tail_start + cd_size]
+    else:
+        cd_data = fetch_range(session, archive_uri, cd_offset, cd_offset + cd_size)
+
+    members = parse_central_directory(cd_data, n_entries, cd_offset)
+
+    return ZipDirectory(
+        archive_uri=archive_uri,
+        archive_size=archive_size,
+        etag=head.headers.get("ETag"),
+        members={member.name: member for member in members}
+    )
+
+
+_directory_lock = threading.Lock()
+_directories: Dict[str, ZipDirectory] = {}
+
+
+def directory_cache_fpath(archive_uri: str) -> Path:
+    key = hashlib.sha256(archive_uri.encode("utf-8")).hexdigest()
+
+    return settings.cache_root_dirpath/"zipdirs"/f"{key}.json"
+
+
+def get_zip_directory(archive_uri: str) -> ZipDirectory:
+    """The central directory of the archive, from memory, the local cache, or the
+    archive itself. Archives are not expected to change once submitted, so cached
+    directories are used without revalidation."""
+
+    with _directory_lock:
+        if archive_uri in _directories:
+            return _directories[archive_uri]
+
+    fpath = directory_cache_fpath(archive_uri)
+    if fpath.exists():
+        directory = ZipDirectory.model_validate_json(fpath.read_text())
+    else:
+        logger.info(f"Reading central directory of {archive_uri}")
+        directory = read_zip_directory(archive_uri)
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+        tmp_fpath = fpath.with_suffix(".tmp")
+        tmp_fpath.write_text(directory.model_dump_json())
+        tmp_fpath.rename(fpath)
+
+    with _directory_lock:
+        _directories[archive_uri] = directory
+
+    return directory
+
+
+def member_data_offset(span: bytes, member: ZipMember) -> int:
+    """Offset of the compressed data within bytes starting at the member's local header."""
+
+    signature, *_, name_length, extra_length = LOCAL_HEADER_STRUCT.unpack_from(span)
+    if signature != LOCAL_HEADER_SIGNATURE:
+        raise IOError(f"Bad local header for {member.name}")
+
+    return LOCAL_HEADER_STRUCT.size + name_length + extra_length
+
+
+def create_decompressor(member: ZipMember):
+    if member.compress_type == STORED:
+        return None
+    if member.compress_type == DEFLATED:
+        return zlib.decompressobj(-15)
+    if member.compress_type == BZIP2:
+        return bz2.BZ2Decompressor()
+
+    raise NotImplementedError(f"Compression type {member.compress_type} of {member.name} is not supported")
+
+
+def write_member(member: ZipMember, chunks, dst_fpath: Path):
+    """Decompress the member's data (given as an iterable of byte strings) to
+    dst_fpath, checking its size and CRC. Writes via a temporary file, so a file at
+    dst_fpath is always complete, and records its cache index entry."""
+
+    dst_fpath.parent.mkdir(parents=True, exist_ok=True)
+    tmp_fpath = dst_fpath.with_suffix(dst_fpath.suffix + ".tmp")
+    decompressor = create_decompressor(member)
+    hasher = StreamingHasher()
+    crc = 0
+    size = 0
+    with open(tmp_fpath, "wb") as fh:
+        for chunk in chunks:
+            data = decompressor.decompress(chunk) if decompressor else chunk
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            hasher.update(data)
+            fh.write(data)
+        if hasattr(decompressor, "flush"):
+            data = decompressor.flush()
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            hasher.update(data)
+            fh.write(data)
+
+    if size != member.file_size or crc != member.crc:
+        tmp_fpath.unlink()
+        raise IOError(f"{member.name} failed its size or CRC check")
+
+    tmp_fpath.rename(dst_fpath)
+    write_entry(dst_fpath, hasher.entry(dst_fpath.stat()))
+
+
+def iter_member_data(span: bytes, member: ZipMember, chunk_size: int = 1024 * 1024):
+    data_offset = member_data_offset(span, member)
+    data = memoryview(span)[data_offset:data_offset + member.compressed_size]
+    for position in range(0, len(data), chunk_size):
+        yield data[position:position + chunk_size]
+
+
+def fetch_large_member(session, executor, directory: ZipDirectory, member: ZipMember, dst_fpath: Path):
+    """Fetch the member's span in parallel parts to a temporary file, then
+    decompress it from there."""
+
+    start, stop = member.header_offset, member.span_end
+    parts = [(p, min(p + RANGE_PART_BYTES, stop)) for p in range(start, stop, RANGE_PART_BYTES)]
+
+    with tempfile.TemporaryFile(dir=dst_fpath.parent) as raw_fh:
+        raw_fh.truncate(stop - start)
+        raw_lock = threading.Lock()
+
+        def fetch_part(part_start, part_stop):
+            data = fetch_range(session, directory.archive_uri, part_start, part_stop)
+            with raw_lock:
+                raw_fh.seek(part_start - start)
+                raw_fh.write(data)
+
+        for future in [executor.submit(fetch_part, *part) for part in parts]:
+            future.result()
+
+        raw_fh.seek(0)
+        data_offset = member_data_offset(raw_fh.read(LOCAL_HEADER_STRUCT.size + 0xFFFF * 2), member)
+        raw_fh.seek(data_offset)
+
+        def chunks():
+            remaining = member.compressed_size
+            while remaining:
+                chunk = raw_fh.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    raise IOError(f"Truncated data for {member.name}")
+                remaining -= len(chunk)
+                yield chunk
+
+        write_member(member, chunks(), dst_fpath)
+
+
+def coalesce_members(members: List[ZipMember]) -> List[List[ZipMember]]:
+    """Group small members whose spans are close together, so each group can be
+    fetched with one request."""
+
+    groups: List[List[ZipMember]] = []
+    for member in sorted(members, key=lambda m: m.header_offset):
+        if groups:
+            group = groups[-1]
+            gap = member.header_offset - group[-1].span_end
+            if 0 <= gap <= COALESCE_GAP_BYTES and member.span_end - group[0].header_offset <= RANGE_PART_BYTES:
+                group.append(member)
+                continue
+        groups.append([member])
+
+    return groups
+
+
+def fetch_member_group(session, directory: ZipDirectory, group: List[ZipMember], dst_fpaths: Dict[str, Path]):
+    start = group[0].header_offset
+    data = fetch_range(session, directory.archive_uri, start, group[-1].span_end)
+    for member in group:
+        span = data[member.header_offset - start:member.span_end - start]
+        write_member(member, iter_member_data(span, member), dst_fpaths[member.name])
+
+
+def fetch_zip_members(archive_uri: str, dst_fpaths: Dict[str, Path], max_workers: Optional[int] = None):
+    """Fetch members of a remote zip to local paths, given as a mapping from
+    member name to path. Large members are fetched in parallel parts, small ones
+    in coalesced groups."""
+
+    directory = get_zip_directory(archive_uri)
+    missing = [name for name in dst_fpaths if name not in directory.members]
+    if missing:
+        raise KeyError(f"{archive_uri} has no members {missing[:5]}")
+
+    members = [directory.members[name] for name in dst_fpaths]
+    large = [m for m in members if m.span_end - m.header_offset > RANGE_PART_BYTES]
+    groups = coalesce_members([m for m in members if m.span_end - m.header_offset <= RANGE_PART_BYTES])
+    logger.info(
+        f"Fetching {len(members)} members of {archive_uri}: {len(large)} large, "
+        f"{len(members) - len(large)} small in {len(groups)} requests"
+    )
+
+    session = create_session()
+    max_workers = max_workers or settings.staging_max_workers
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, ThreadPoolExecutor(max_workers=max_workers) as part_executor:
+        futures = [
+            executor.submit(fetch_member_group, session, directory, group, dst_fpaths)
+            for group in groups
+        ]
+        futures += [
+            executor.submit(fetch_large_member, session, part_executor, directory, member, dst_fpaths[member.name])
+            for member in large
+        ]
+        for future in futures:
+            future.result()
+
+    session.close()
+
+
+def fetch_zip_member(archive_uri: str, member_name: str, dst_fpath: Path):
+    fetch_zip_members(archive_uri, {member_name: dst_fpath})
+
+
+def split_zip_member_uri(uri: str) -> Optional[Tuple[str, str]]:
+    """Split a URI of the form .../archive.zip/path/in/zip into the archive URI and
+    member name, or return None if it doesn't point inside a zip."""
+
+    position = uri.lower().find(".zip/")
+    if position < 0:
+        return None
+
+    return uri[:position + 4], uri[position + 5:]
@@ -0,0 +1,328 @@
+"""On-demand rendering of planes and thumbnails from OME-Zarr images over HTTP.
+
+Image metadata is cached in the service, identical requests that arrive while a
+render is in flight share its result, and rendering runs in a pool of worker
+processes (each with its own decoded-chunk cache) so the event loop stays
+responsive. Responses carry an ETag derived from the image metadata and the
+render parameters, so clients can revalidate with If-None-Match.
+
+Sources are assumed immutable apart from their metadata: chunks rewritten in place
+under unchanged metadata keep the same ETag and worker caches, until the service is
+restarted.
+"""
+import io
+import json
+import time
+import random
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple, Annotated
+
+import rich
+import typer
+import aiohttp
+import numpy as np
+from aiohttp import web
+from pydantic import BaseModel
+
+from .proxyimage import OMEZarrImage, ome_zarr_image_from_ome_zarr_uri
+from .rendering import render_proxy_image, generate_padded_thumbnail_from_proxy_image
+
+
+logger = logging.getLogger(__name__)
+
+app = typer.Typer()
+
+
+MAX_RENDER_SIZE = 2048
+
+
+class RenderRequest(BaseModel):
+    """Parameters of a single render, as parsed from the query string."""
+
+    kind: str
+    uri: str
+    size: int
+    t: Optional[int] = None
+    z: Optional[int] = None
+    channels: Optional[List[int]] = None
+    fingerprint: str = ""
+    """Of the image metadata the request was validated against, so workers don't
+    render from a version of the image they cached earlier."""
+
+    def cache_key(self) -> Tuple:
+        return (self.kind, self.uri, self.size, self.t, self.z, tuple(self.channels or ()))
+
+
+class MetadataCache:
+    """LRU cache of opened images, so validating a request and computing its ETag
+    doesn't touch the store. Entries expire after ttl_seconds, so metadata that
+    changes is picked up."""
+
+    def __init__(self, max_entries: int = 256, ttl_seconds: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, uri: str) -> Tuple[OMEZarrImage, str]:
+        """Return the image and a fingerprint of its metadata."""
+
+        with self._lock:
+            entry = self._entries.get(uri)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl_seconds:
+                self._entries.move_to_end(uri)
+                return entry[1], entry[2]
+
+        image = ome_zarr_image_from_ome_zarr_uri(uri, ignore_unit_errors=True)
+        fingerprint = hashlib.sha256(
+            json.dumps(image.zgroup.attrs.asdict(), sort_keys=True).encode()
+        ).hexdigest()
+        with self._lock:
+            self._entries[uri] = (time.monotonic(), image, fingerprint)
+            self._entries.move_to_end(uri)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return image, fingerprint
+
+
+@lru_cache(maxsize=64)
+def _worker_image(uri: str, fingerprint: str) -> OMEZarrImage:
+    """The image as opened in this worker. Keyed by the metadata fingerprint, which
+    also keys the worker's tensorstore handles and chunks for the image, so a
+    rewritten image is read afresh."""
+
+    image = ome_zarr_image_from_ome_zarr_uri(uri, ignore_unit_errors=True)
+    image.cache_token = fingerprint
+
+    return image
+
+
+def render_to_png_bytes(render_request: RenderRequest) -> bytes:
+    """Render in a worker process, returning the encoded PNG."""
+
+    image = _worker_image(render_request.uri, render_request.fingerprint)
+    if render_request.kind == "thumbnail":
+        im = generate_padded_thumbnail_from_proxy_image(
+            image, dims=(render_request.size, render_request.size)
+        )
+    else:
+        im = render_proxy_image(
+            image,
+            dims=(render_request.size, render_request.size),
+            t=render_request.t,
+            z=render_request.z,
+            channels=render_request.channels
+        )
+        im.thumbnail((render_request.size, render_request.size))
+
+    buf = io.BytesIO()
+    im.convert("RGB").save(buf, format="PNG")
+
+    return buf.getvalue()
+
+
+def parse_render_request(kind: str, query) -> RenderRequest:
+    if "uri" not in query:
+        raise web.HTTPBadRequest(text="uri is required")
+
+    try:
+        size = int(query.get("size", 512))
+        t = int(query["t"]) if "t" in query else None
+        z = int(query["z"]) if "z" in query else None
+        channels = [int(c) for c in query["channels"].split(",")] if query.get("channels") else None
+    except ValueError:
+        raise web.HTTPBadRequest(text="size, t, z and channels must be integers")
+
+    if not 0 < size <= MAX_RENDER_SIZE:
+        raise web.HTTPBadRequest(text=f"size must be between 1 and {MAX_RENDER_SIZE}")
+
+    return RenderRequest(kind=kind, uri=query["uri"], size=size, t=t, z=z, channels=channels)
+
+
+def validate_against_image(render_request: RenderRequest, image: OMEZarrImage):
+    if render_request.t is not None and not 0 <= render_request.t < image.sizeT:
+        raise web.HTTPBadRequest(text=f"t must be less than {image.sizeT}")
+    if render_request.z is not None and not 0 <= render_request.z < image.sizeZ:
+        raise web.HTTPBadRequest(text=f"z must be less than {image.sizeZ}")
+    if render_request.channels and not all(0 <= c < image.sizeC for c in render_request.channels):
+        raise web.HTTPBadRequest(text=f"channels must be less than {image.sizeC}")
+
+
+class RenderService:
+    def __init__(self, n_workers: Optional[int] = None, metadata_ttl_seconds: float = 300.0):
+        self.executor = ProcessPoolExecutor(max_workers=n_workers)
+        self.metadata_cache = MetadataCache(ttl_seconds=metadata_ttl_seconds)
+        self.in_flight: Dict[Tuple, asyncio.Future] = {}
+        self.n_renders = 0
+        self.n_coalesced = 0
+        self.n_not_modified = 0
+
+    async def get_metadata(self, uri: str) -> Tuple[OMEZarrImage, str]:
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(None, self.metadata_cache.get, uri)
+        except Exception as e:
+            logger.warning(f"Could not open {uri}: {e}")
+            raise web.HTTPNotFound(text=f"Could not open OME-Zarr image at {uri}")
+
+    async def render(self, render_request: RenderRequest) -> bytes:
+        """Render, sharing the result with any identical request already in flight."""
+
+        key = render_request.cache_key() + (render_request.fingerprint,)
+        future = self.in_flight.get(key)
+        if future is not None:
+            self.n_coalesced += 1
+            return await asyncio.shield(future)
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, render_to_png_bytes, render_request)
+        self.in_flight[key] = future
+        self.n_renders += 1
+        try:
+            return await asyncio.shield(future)
+        finally:
+            self.in_flight.pop(key, None)
+
+    async def handle(self, request: web.Request, kind: str) -> web.Response:
+        render_request = parse_render_request(kind, request.query)
+        image, fingerprint = await self.get_metadata(render_request.uri)
+        validate_against_image(render_request, image)
+        render_request.fingerprint = fingerprint
+
+        etag = '"' + hashlib.sha256(
+            (fingerprint + repr(render_request.cache_key())).encode()
+        ).hexdigest()[:32] + '"'
+        headers = {"ETag": etag, "Cache-Control": "public, max-age=3600"}
+
+        if etag in request.headers.get("If-None-Match", ""):
+            self.n_not_modified += 1
+            return web.Response(status=304, headers=headers)
+
+        png_bytes = await self.render(render_request)
+
+        return web.Response(body=png_bytes, content_type="image/png", headers=headers)
+
+    async def handle_render(self, request: web.Request) -> web.Response:
+        return await self.handle(request, "plane")
+
+    async def handle_thumbnail(self, request: web.Request) -> web.Response:
+        return await self.handle(request, "thumbnail")
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "renders": self.n_renders,
+            "coalesced": self.n_coalesced,
+            "not_modified": self.n_not_modified,
+            "in_flight": len(self.in_flight)
+        })
+
+    async def on_cleanup(self, app: web.Application):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def make_app(self) -> web.Application:
+        web_app = web.Application()
+        web_app.router.add_get("/render", self.handle_render)
+        web_app.router.add_get("/thumbnail", self.handle_thumbnail)
+        web_app.router.add_get("/stats", self.handle_stats)
+        web_app.on_cleanup.append(self.on_cleanup)
+
+        return web_app
+
+
+@app.command()
+def serve(
+    host: str = "127.0.0.1",
+    port: int = 8080,
+    n_workers: Annotated[Optional[int], typer.Option(help="Render processes, defaults to the number of CPUs")] = None,
+    metadata_ttl_seconds: float = 300.0
+):
+    logging.basicConfig(level=logging.INFO)
+    service = RenderService(n_workers=n_workers, metadata_ttl_seconds=metadata_ttl_seconds)
+    web.run_app(service.make_app(), host=host, port=port)
+
+
+async def run_loadtest(base_url: str, uris: List[str], n_requests: int, concurrency: int, size: int) -> List[float]:
+    """Issue n_requests renders of random planes of the given images, at most
+    concurrency at once, returning each request's latency in seconds."""
+
+    semaphore = asyncio.Semaphore(concurrency)
+    rng = random.Random(0)
+    latencies = []
+
+    async def one_request(session, params):
+        async with semaphore:
+            start = time.perf_counter()
+            async with session.get(f"{base_url}/render", params=params) as response:
+                await response.read()
+                response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+
+    async with aiohttp.ClientSession() as session:
+        # Fetch image sizes once, so requests pick valid planes
+        metadata_cache = MetadataCache()
+        sizes = {uri: metadata_cache.get(uri)[0].sizeZ for uri in uris}
+        requests = []
+        for _ in range(n_requests):
+            uri = rng.choice(uris)
+            requests.append({"uri": uri, "z": str(rng.randrange(sizes[uri])), "size": str(size)})
+        await asyncio.gather(*[one_request(session, params) for params in requests])
+
+    return latencies
+
+
+async def loadtest_against_local_service(uris, n_requests, concurrency, size, n_workers, port) -> Tuple[List[float], Dict]:
+    service = RenderService(n_workers=n_workers)
+    runner = web.AppRunner(service.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    try:
+        latencies = await run_loadtest(f"http://127.0.0.1:{port}", uris, n_requests, concurrency, size)
+        stats = {"renders": service.n_renders, "coalesced": service.n_coalesced}
+    finally:
+        await runner.cleanup()
+
+    return latencies, stats
+
+
+@app.command()
+def loadtest(
+    uris: Annotated[List[str], typer.Argument(help="OME-Zarr images to render from")],
+    n_requests: int = 200,
+    concurrency: int = 16,
+    size: int = 256,
+    url: Annotated[Optional[str], typer.Option(help="Service to test, by default one is started locally")] = None,
+    n_workers: Optional[int] = None,
+    port: int = 8089
+):
+    """Render random planes of the given images through the service, and report latency."""
+
+    start = time.perf_counter()
+    if url:
+        latencies = asyncio.run(run_loadtest(url.rstrip("/"), uris, n_requests, concurrency, size))
+        stats = {}
+    else:
+        latencies, stats = asyncio.run(
+            loadtest_against_local_service(uris, n_requests, concurrency, size, n_workers, port)
+        )
+    elapsed = time.perf_counter() - start
+
+    latencies_ms = 1000 * np.array(latencies)
+    rich.print(
+        f"{len(latencies)} requests in {elapsed:.1f}s ({len(latencies) / elapsed:.1f} req/s) | "
+        f"p50 {np.percentile(latencies_ms, 50):.1f} ms | p99 {np.percentile(latencies_ms, 99):.1f} ms | "
+        f"max {latencies_ms.max():.1f} ms"
+    )
+    if stats:
+        rich.print(f"{stats['renders']} renders, {stats['coalesced']} coalesced")
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,183 @@
+"""Local cache of rendered and encoded 2D images, keyed by source and parameters.
+
+The key combines a fingerprint of the source pyramid (the content of its group
+and array metadata, with the ETag or mtime of each metadata object) and a hash of
+the render and encoding parameters. Only metadata is read to compute the key, so
+a hit skips all array I/O. A pyramid rewritten together with its metadata gets
+a new key.
+
+Chunk data is not part of the key, so sources are assumed immutable: chunks
+rewritten in place under unchanged metadata (which over S3 includes re-uploading
+identical metadata, as its ETag is the content MD5) are not detected, and stale
+renders are served until the cache is purged (bia-converter purge-render-cache).
+
+Entries are files under the cache directory. The cache is bounded by total size,
+evicting the least recently used entries.
+"""
+import os
+import json
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+
+from .config import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def read_metadata_object(uri: str) -> Tuple[bytes, str]:
+    """Content of a metadata object, and its version (ETag or mtime)."""
+
+    if urlparse(uri).scheme in ("http", "https"):
+        response = requests.get(uri)
+        response.raise_for_status()
+        version = response.headers.get("ETag") or response.headers.get("Last-Modified") or ""
+        return response.content, version
+
+    fpath = Path(uri.removeprefix("file://"))
+    return fpath.read_bytes(), str(fpath.stat().st_mtime_ns)
+
+
+def source_fingerprint(ngff_uri: str) -> str:
+    """Fingerprint of an OME-Zarr pyramid from its group and array metadata."""
+
+    ngff_uri = str(ngff_uri).rstrip("/")
+    fingerprint = hashlib.sha256()
+
+    zattrs, version = read_metadata_object(f"{ngff_uri}/.zattrs")
+    fingerprint.update(zattrs + version.encode())
+
+    path_keys = [
+        dataset["path"]
+        for multiscale in json.loads(zattrs).get("multiscales", [])
+        for dataset in multiscale["datasets"]
+    ]
+    for path_key in path_keys:
+        zarray, version = read_metadata_object(f"{ngff_uri}/{path_key}/.zarray")
+        fingerprint.update(path_key.encode() + zarray + version.encode())
+
+    return fingerprint.hexdigest()
+
+
+def render_cache_key(ngff_uri: str, render_params: dict) -> str:
+    params = json.dumps(render_params, sort_keys=True, default=str)
+
+    return hashlib.sha256(f"{source_fingerprint(ngff_uri)}:{params}".encode()).hexdigest()
+
+
+class RenderCache:
+    """Size bounded LRU cache of encoded images on local disk. Recency is the
+    file mtime, updated on each hit."""
+
+    def __init__(self, dirpath: Path, max_bytes: int):
+        self.dirpath = Path(dirpath)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._n_bytes: Optional[int] = None
+
+    def fpath(self, key: str) -> Path:
+        return self.dirpath/key[:2]/f"{key}.bin"
+
+    def get(self, key: str) -> Optional[bytes]:
+        fpath = self.fpath(key)
+        try:
+            data = fpath.read_bytes()
+        except FileNotFoundError:
+            return None
+        os.utime(fpath)
+
+        return data
+
+    def put(self, key: str, data: bytes):
+        fpath = self.fpath(key)
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+        tmp_fpath = fpath.with_suffix(f".tmp{threading.get_ident()}")
+        tmp_fpath.write_bytes(data)
+
+        with self._lock:
+            # An existing entry for this key is replaced, its size no longer counts
+            try:
+                replaced_size = fpath.stat().st_size
+            except FileNotFoundError:
+                replaced_size = 0
+            tmp_fpath.rename(fpath)
+            if self._n_bytes is None:
+                self._n_bytes = sum(size for _, _, size in self.entries())
+            else:
+                self._n_bytes += len(data) - replaced_size
+            if self._n_bytes > self.max_bytes:
+                self.evict()
+
+    def purge(self) -> int:
+        """Remove all entries, returning how many were removed."""
+
+        with self._lock:
+            n_removed = 0
+            for _, fpath, _ in self.entries():
+                fpath.unlink(missing_ok=True)
+                n_removed += 1
+            self._n_bytes = 0
+
+        return n_removed
+
+    def entries(self) -> List[Tuple[float, Path, int]]:
+        """(mtime, path, size) of all entries."""
+
+        entries = []
+        for fpath in self.dirpath.glob("*/*.bin"):
+            try:
+                stat = fpath.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, fpath, stat.st_size))
+
+        return entries
+
+    def evict(self):
+        """Remove least recently used entries until the cache is within its size
+        bound. Called with the lock held."""
+
+        entries = sorted(self.entries())
+        self._n_bytes = sum(size for _, _, size in entries)
+        n_evicted = 0
+        for _, fpath, size in entries:
+            if self._n_bytes <= self.max_bytes:
+                break
+            fpath.unlink(missing_ok=True)
+            self._n_bytes -= size
+            n_evicted += 1
+        logger.info(f"Evicted {n_evicted} renders from {self.dirpath}")
+
+
+_render_cache: Optional[RenderCache] = None
+
+
+def get_render_cache() -> RenderCache:
+    global _render_cache
+    if _render_cache is None:
+        _render_cache = RenderCache(settings.cache_root_dirpath/"renders", settings.render_cache_max_bytes)
+
+    return _render_cache
+
+
+def get_or_render(ngff_uri: str, render_params: Dict, render) -> bytes:
+    """Return the cached result for the source and parameters, or call render()
+    (which returns the encoded image) and cache its result."""
+
+    cache = get_render_cache()
+    key = render_cache_key(ngff_uri, render_params)
+    data = cache.get(key)
+    if data is not None:
+        logger.info(f"Using cached render of {ngff_uri}")
+        return data
+
+    data = render()
+    cache.put(key, data)
+
+    return data
@@ -11,8 +11,7 @@ from matplotlib.colors import LinearSegmentedColormap
 from .omezarrmeta import ZMeta
 from .proxyimage import (
     ome_zarr_image_from_ome_zarr_uri,
-    get_array_with_min_dimensions,
-    reshape_to_5D
+    get_region_reader_with_min_dimensions,
 )
 
 
@@ -251,6 +250,28 @@ def select_region_from_dask_array(darray, region):
         raise Exception("Can't handle this array shape")    
 
 
+def bounding_box_slices(bb: BoundingBox2DRel, ydim: int, xdim: int):
+    """Convert a relative bounding box to y and x slices of a plane of the given size."""
+
+    ymin = int(bb.y * ydim)
+    ymax = int((bb.y + bb.ysize) * ydim)
+
+    xmin = int(bb.x * xdim)
+    xmax = int((bb.x + bb.xsize) * xdim)
+
+    return slice(ymin, ymax), slice(xmin, xmax)
+
+
+def plane_region_selection(dimension_str: str, region: PlaneRegionSelection, ydim: int, xdim: int) -> tuple:
+    """Selection of a plane region in an array with the given dimension order.
+    Dimensions not in the array are ignored."""
+
+    yslice, xslice = bounding_box_slices(region.bb, ydim, xdim)
+    selection_by_dim = {"t": region.t, "c": region.c, "z": region.z, "y": yslice, "x": xslice}
+
+    return tuple(selection_by_dim[dim] for dim in dimension_str)
+
+
 def render_multiple_2D_arrays(arrays, colormaps):
     """Given a list of 2D arrays and a list of colormaps, apply each colormap
     merge into a single 2D RGB image."""
@@ -264,34 +285,40 @@ def render_multiple_2D_arrays(arrays, colormaps):
 DEFAULT_BB = BoundingBox2DRel(x=0, y=0, xsize=1, ysize=1)
 
 
-def render_proxy_image(proxy_im, bbrel=DEFAULT_BB, dims=(512, 512), t=None, z=None, csettings=None, mode=None):
+def render_proxy_image(proxy_im, bbrel=DEFAULT_BB, dims=(512, 512), t=None, z=None, csettings=None, mode=None, channels=None):
     """In order to render a 2D plane we need to:
     
-    1. Lazy-load the image as a Dask array.
+    1. Open the smallest pyramid level big enough for the output.
     2. Select the plane (single t and z values) we'll use.
-    3. Separate channels.
+    3. Read the plane region of each channel (fetching all chunks at once).
     4. Apply a color map to each channel array.
-    5. Merge the channel arrays."""
+    5. Merge the channel arrays.
+
+    By default the first channels (up to the number of default colours) are
+    rendered, channels selects specific channel indices instead. t and z are
+    indices into the full resolution image."""
 
     ydim, xdim = dims
 
     min_ydim_needed = ydim / bbrel.ysize
     min_xdim_needed = xdim / bbrel.xsize
     
-    # darray = proxy_im.get_dask_array_with_min_dimensions((min_xdim_needed, min_ydim_needed))
-    array = get_array_with_min_dimensions(proxy_im, (min_xdim_needed, min_ydim_needed))
-
-    # import rich
-    darray = reshape_to_5D(array, proxy_im.dimensions)
-    # rich.print(darray, proxy_im.dimensions)
-    # import sys; sys.exit(0)
+    # Plane regions are small, so read them directly rather than through dask
+    reader = get_region_reader_with_min_dimensions(proxy_im, (min_xdim_needed, min_ydim_needed))
+    sizes = dict(zip(proxy_im.dimensions, reader.shape))
 
-    if not t:
+    if t is None:
         t = proxy_im.sizeT // 2
-    if not z:
-        z = darray.shape[2] // 2
-
-    channels_to_render = min(proxy_im.sizeC, len(DEFAULT_COLORS))
+    if z is None:
+        z = proxy_im.sizeZ // 2
+    if not 0 <= z < proxy_im.sizeZ:
+        raise IndexError(f"z {z} is out of range for an image with {proxy_im.sizeZ} planes")
+    # z is a full resolution plane, the level we read may be downsampled in z
+    z = z * sizes.get("z", 1) // proxy_im.sizeZ
+
+    if channels is None:
+        channels = list(range(min(proxy_im.sizeC, len(DEFAULT_COLORS))))
+    channels_to_render = len(channels)
     if not mode:
         if channels_to_render == 1:
             mode = "grayscale"
@@ -303,13 +330,13 @@ def render_proxy_image(proxy_im, bbrel=DEFAULT_BB, dims=(512, 512), t=None, z=No
     if not csettings:
         if mode == "grayscale":
             csettings = {
-                n: ChannelRenderingSettings(colormap_end=[1, 1, 1])
-                for n in range(channels_to_render)
+                c: ChannelRenderingSettings(colormap_end=[1, 1, 1])
+                for c in channels
             }            
         else:
             csettings = {
-                n: ChannelRenderingSettings(colormap_end=DEFAULT_COLORS[n])
-                for n in range(channels_to_render)
+                c: ChannelRenderingSettings(colormap_end=DEFAULT_COLORS[n % len(DEFAULT_COLORS)])
+                for n, c in enumerate(channels)
             }
     
     region_per_channel = {
@@ -319,13 +346,14 @@ def render_proxy_image(proxy_im, bbrel=DEFAULT_BB, dims=(512, 512), t=None, z=No
             c=c,
             bb=bbrel
         )
-        for c in range(channels_to_render)
+        for c in channels
     }
 
-    channel_arrays = {
-        c: select_region_from_dask_array(darray, region)
-        for c, region in region_per_channel.items()
-    }
+    selections = [
+        plane_region_selection(proxy_im.dimensions, region, sizes["y"], sizes["x"])
+        for region in region_per_channel.values()
+    ]
+    channel_arrays = dict(zip(region_per_channel.keys(), reader.read_regions(selections)))
 
     for c, channel_array in channel_arrays.items():
         if csettings[c].window_end:
@@ -348,6 +376,12 @@ def generate_padded_thumbnail_from_ngff_uri(ngff_uri, dims=(256, 256), autocontr
     # proxy_im = NGFFProxyImage(ngff_uri)
     proxy_im = ome_zarr_image_from_ome_zarr_uri(ngff_uri)
 
+    return generate_padded_thumbnail_from_proxy_image(proxy_im, dims, autocontrast)
+
+
+def generate_padded_thumbnail_from_proxy_image(proxy_im, dims=(256, 256), autocontrast=True):
+    """Generate a 2D thumbnail of the given dimensions from an opened image."""
+
     im = render_proxy_image(proxy_im)
     im.thumbnail(dims)
     im_rgb = im.convert('RGB')
@@ -0,0 +1,98 @@
+"""Shared tensorstore context for the arrays we read and write.
+
+Every ts.open in a conversion uses the same context, so opened arrays share one
+chunk cache pool and one set of I/O and copy concurrency limits, which can be
+raised for remote (HTTP/S3) sources.
+"""
+import collections
+from typing import Iterable, Iterator, Optional, Tuple
+
+import tensorstore as ts # type: ignore
+from pydantic import BaseModel, Field
+
+
+class TensorstoreContextConfig(BaseModel):
+    """Resource limits for the shared tensorstore context."""
+
+    cache_pool_bytes: int = Field(
+        default=0,
+        description="Size of the shared chunk cache pool. 0 disables caching, which suits single-pass copies"
+    )
+    file_io_concurrency: Optional[int] = Field(
+        default=None,
+        description="Concurrent local file operations, tensorstore default if unset"
+    )
+    data_copy_concurrency: Optional[int] = Field(
+        default=None,
+        description="Concurrent encode/decode/copy operations, tensorstore default (number of CPUs) if unset"
+    )
+    http_concurrency: int = Field(
+        default=64,
+        description="Concurrent HTTP requests to remote sources"
+    )
+    readahead_tiles: int = Field(
+        default=2,
+        description="Number of tiles read ahead of the one being written. Each holds a full processing tile in memory"
+    )
+
+
+def context_spec(config: TensorstoreContextConfig) -> dict:
+    spec = {
+        "cache_pool": {"total_bytes_limit": config.cache_pool_bytes},
+        "http_request_concurrency": {"limit": config.http_concurrency},
+    }
+    if config.file_io_concurrency is not None:
+        spec["file_io_concurrency"] = {"limit": config.file_io_concurrency}
+    if config.data_copy_concurrency is not None:
+        spec["data_copy_concurrency"] = {"limit": config.data_copy_concurrency}
+
+    return spec
+
+
+_context_config = TensorstoreContextConfig()
+_context: Optional[ts.Context] = None
+
+
+def configure_context(config: TensorstoreContextConfig):
+    """Replace the shared context. Arrays opened before this keep the old one."""
+
+    global _context, _context_config
+    _context_config = config
+    _context = ts.Context(context_spec(config))
+
+
+def get_context() -> ts.Context:
+    """The shared context, created with default limits on first use."""
+
+    global _context
+    if _context is None:
+        _context = ts.Context(context_spec(_context_config))
+
+    return _context
+
+
+def get_context_config() -> TensorstoreContextConfig:
+    return _context_config
+
+
+def get_readahead_tiles() -> int:
+    return _context_config.readahead_tiles
+
+
+def read_tiles_ahead(source_array, tile_slices: Iterable[Tuple[slice, ...]], n_ahead: Optional[int] = None) -> Iterator[Tuple[Tuple[slice, ...], object]]:
+    """Yield (slices, data) for each tile in order, keeping reads for the next
+    n_ahead tiles in flight while the caller processes the current one."""
+
+    if n_ahead is None:
+        n_ahead = get_readahead_tiles()
+
+    pending = collections.deque()
+    for slices in tile_slices:
+        pending.append((slices, source_array[slices].read()))
+        if len(pending) > n_ahead:
+            slices, future = pending.popleft()
+            yield slices, future.result()
+
+    while pending:
+        slices, future = pending.popleft()
+        yield slices, future.result()
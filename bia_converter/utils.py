@@ -1,10 +1,11 @@
-import os
+import time
 import logging
+import threading
 from uuid import UUID
-from typing import List, Union
-from pathlib import Path
+from typing import Iterator, List, Optional
+from contextlib import contextmanager
 
-from pydantic import TypeAdapter # type: ignore
+from pydantic import BaseModel, TypeAdapter # type: ignore
 
 from bia_integrator_api.models import ( # type: ignore
     FileReference,
@@ -17,6 +18,54 @@ from .bia_api_client import api_client
 logger = logging.getLogger(__name__)
 
 
+class StageTiming(BaseModel):
+    name: str
+    seconds: float = 0.0
+    n_bytes: Optional[int] = None
+    """Bytes processed by the stage, if known, for throughput."""
+
+
+# Timed stages are only recorded while a collector is active, e.g. in a benchmark.
+# Conversions run on worker threads, so this is per process rather than per context
+_stage_timings: Optional[List[StageTiming]] = None
+_stage_timings_lock = threading.Lock()
+
+
+@contextmanager
+def collect_stage_timings() -> Iterator[List[StageTiming]]:
+    """Record the stages timed (on any thread) while in this context, in the list
+    yielded."""
+
+    global _stage_timings
+    timings: List[StageTiming] = []
+    with _stage_timings_lock:
+        if _stage_timings is not None:
+            raise RuntimeError("Stage timings are already being collected")
+        _stage_timings = timings
+    try:
+        yield timings
+    finally:
+        with _stage_timings_lock:
+            _stage_timings = None
+
+
+@contextmanager
+def timed_stage(name: str) -> Iterator[StageTiming]:
+    """Time a stage of a conversion, recording it if a collector is active. The
+    stage can set n_bytes on the yielded record."""
+
+    timing = StageTiming(name=name)
+    start = time.perf_counter()
+    try:
+        yield timing
+    finally:
+        timing.seconds = time.perf_counter() - start
+        with _stage_timings_lock:
+            if _stage_timings is not None:
+                _stage_timings.append(timing)
+        logger.debug(f"Stage {name} took {timing.seconds:.3f}s")
+
+
 def create_s3_uri_suffix_for_image_representation(
     representation: ImageRepresentation
 ) -> str:
@@ -53,38 +102,3 @@ def attributes_by_name(model_object):
         attribute.name: attribute.value
         for attribute in model_object.attribute
     }
-
-
-def get_dir_size(path: Union[str, Path]) -> int:
-    """
-    Calculate total size of a directory tree in bytes.
-    
-    Args:
-        path: Directory path to analyze
-        
-    Returns:
-        int: Total size in bytes
-        
-    Example:
-        >>> size_bytes = get_dir_size("/path/to/dir")
-        >>> size_mb = size_bytes / (1024 * 1024)  # Convert to MB
-    """
-    root = Path(path)
-    if not root.is_dir():
-        raise NotADirectoryError(f"{path} is not a directory")
-        
-    total_size = 0
-    
-    # Use os.walk for better performance than Path.rglob
-    for dirpath, dirnames, filenames in os.walk(root):
-        # Add sizes of all files in current directory
-        for filename in filenames:
-            file_path = os.path.join(dirpath, filename)
-            # Use os.path.getsize and handle file access errors
-            try:
-                total_size += os.path.getsize(file_path)
-            except (OSError, IOError) as e:
-                # Skip files we can't access
-                continue
-            
-    return total_size
\ No newline at end of file
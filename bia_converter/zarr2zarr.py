@@ -8,11 +8,36 @@ import typer
 from pydantic import BaseModel, Field
 
 from .proxyimage import ome_zarr_image_from_ome_zarr_uri
+from .pyramid import PyramidLevel, plan_pyramid
+from .compression import CodecConfig, resolve_compressor
+from .tscontext import TensorstoreContextConfig, configure_context, get_context
+from .estimate import estimate_conversion, print_estimate
+from .rechunk import plan_rechunk
 from .omezarrgen import (
+    LevelWriteSummary,
+    ensure_uri,
+    merge_write_summaries,
+    record_array_metadata,
     rechunk_and_save_array,
     create_ome_zarr_metadata,
+    update_sparsity_attributes,
+    write_array_to_disk_chunked,
     downsample_array_and_write_to_dirpath
 )
+from .partition import (
+    PartitionManifest,
+    WorkerMarker,
+    check_alignment,
+    choose_partition_level,
+    partition_blocks,
+    blocks_for_worker,
+    region_at_level,
+    marker_fpath,
+    write_manifest,
+    read_manifest,
+    write_marker,
+    read_markers
+)
 
 
 app = typer.Typer()
@@ -24,6 +49,33 @@ def calculate_downsampling_steps(shape):
     return max(0, steps)
 
 
+def pyramid_levels_from_config(shape, config) -> List[PyramidLevel]:
+    """Get the pyramid levels for an array of the given (t, c, z, y, x) shape.
+
+    If fixed downsample factors are configured, these are applied at every level,
+    otherwise the levels are planned from the shape, scales and target chunks."""
+
+    if config.downsample_factors is None:
+        return plan_pyramid(
+            list(shape),
+            config.coordinate_scales,
+            config.target_chunks,
+            max_levels=config.n_pyramid_levels
+        )
+
+    n_levels = config.n_pyramid_levels or 1 + calculate_downsampling_steps(shape)
+    levels = []
+    level_shape = list(shape)
+    level_scale = list(config.coordinate_scales)
+    for n in range(n_levels):
+        factors = [1] * len(shape) if n == 0 else config.downsample_factors
+        level_shape = [math.ceil(s / f) for s, f in zip(level_shape, factors)]
+        level_scale = [s * f for s, f in zip(level_scale, factors)]
+        levels.append(PyramidLevel(path=str(n), shape=level_shape, factors=factors, scale=level_scale))
+
+    return levels
+
+
 @app.command()
 def zarr_group_info(zarr_uri):
 
@@ -45,9 +97,9 @@ class ZarrConversionConfig(BaseModel):
         default=[1, 1, 64, 64, 64],
         description="Array chunk layout for output zarr"
     )
-    downsample_factors: List[int] = Field(
-        default=[1, 1, 2, 2, 2],
-        description="Factor by which each successive pyramid layer will be downsampled"
+    downsample_factors: Optional[List[int]] = Field(
+        default=None,
+        description="Factor by which each successive pyramid layer will be downsampled. If unset, per-level factors are planned from the array shape, coordinate scales and target chunks"
     )
     transpose_axes: List[int] = Field(
         default=[0, 1, 2, 3, 4],
@@ -73,6 +125,30 @@ class ZarrConversionConfig(BaseModel):
         default=[1, 1, 128, 128, 128],
         description="Sharding size to use for Zarr v3"
     )
+    compression: CodecConfig = Field(
+        default_factory=CodecConfig,
+        description="Compression codec for output chunks, or 'auto' to benchmark candidates on the source"
+    )
+    processing_chunks: List[int] = Field(
+        default=[512, 512, 512, 512, 512],
+        description="Shape of the tiles read and written at once. Should be a multiple of target_chunks"
+    )
+    rechunk_memory_limit_bytes: int = Field(
+        default=2 * 1024 ** 3,
+        description="Memory available for tiles in each worker when rechunking the base level"
+    )
+    n_workers: Optional[int] = Field(
+        default=None,
+        description="Processes converting (t, c) sub-volumes of the base level in parallel. Defaults to the number of CPUs"
+    )
+    read_amplification_threshold: float = Field(
+        default=2.0,
+        description="Switch to source-aligned (and if needed, two-pass) rechunking when the processing tiles would decode each source chunk more than this many times"
+    )
+    tensorstore: TensorstoreContextConfig = Field(
+        default_factory=TensorstoreContextConfig,
+        description="Cache, concurrency and read-ahead settings shared by all arrays opened in the conversion"
+    )
 
 def coordinate_scales_from_ome_zarr_uri(ome_zarr_uri: str):
     im = ome_zarr_image_from_ome_zarr_uri(ome_zarr_uri)
@@ -99,7 +175,8 @@ def n_pyramid_levels_from_ome_zarr_uri(ome_zarr_uri: str):
 def zarr2zarr(
     ome_zarr_uri: str, 
     output_base_dirpath: Path,
-    conversion_config: Annotated[Optional[str], typer.Argument()] = "{}"
+    conversion_config: Annotated[Optional[str], typer.Argument()] = "{}",
+    dry_run: Annotated[bool, typer.Option("--dry-run", help="Estimate the cost of the conversion without writing anything")] = False
 ):
 
     config = ZarrConversionConfig.model_validate_json(conversion_config)
@@ -109,6 +186,7 @@ def zarr2zarr(
         config.n_pyramid_levels = n_pyramid_levels_from_ome_zarr_uri(ome_zarr_uri)
 
     rich.print(config)
+    configure_context(config.tensorstore)
 
     output_array_keys = [str(i) for i in range(config.n_pyramid_levels)]
 
@@ -116,8 +194,48 @@ def zarr2zarr(
     # FIXME - path key for base of incoming pyramid is not always '0', just usually
     input_array_uri = ome_zarr_uri + '/0'
     output_dirpath = output_base_dirpath / '0'
+
+    import tensorstore as ts
+    source = ts.open({
+        'driver': 'zarr',
+        'kvstore': ensure_uri(input_array_uri)
+    }, context=get_context()).result()
+    # target_chunks describe the output, so samples are read from the transposed source
+    transposed = source.transpose(config.transpose_axes)
+    if dry_run:
+        compressor = resolve_compressor(config.compression, transposed, config.target_chunks)
+        # Only the base level is currently regenerated by this command
+        pyramid_levels = pyramid_levels_from_config(transposed.shape, config)[:1]
+        estimate = estimate_conversion(
+            transposed, pyramid_levels, config.target_chunks, config.processing_chunks, compressor
+        )
+        print_estimate(estimate)
+        rich.print(plan_rechunk(
+            list(transposed.shape),
+            list(transposed.chunk_layout.read_chunk.shape),
+            config.target_chunks,
+            config.processing_chunks,
+            transposed.dtype.numpy_dtype.itemsize,
+            config.rechunk_memory_limit_bytes,
+            config.read_amplification_threshold,
+            n_tiles_in_memory=1 + config.tensorstore.readahead_tiles
+        ))
+        return
+
     if not output_dirpath.exists():
-        rechunk_and_save_array(input_array_uri, output_dirpath, config.target_chunks, config.transpose_axes)
+        # Only resolved when writing, 'auto' reads samples of the source
+        compressor = resolve_compressor(config.compression, transposed, config.target_chunks)
+        rechunk_and_save_array(
+            input_array_uri,
+            output_dirpath,
+            config.target_chunks,
+            config.transpose_axes,
+            compressor,
+            config.processing_chunks,
+            config.rechunk_memory_limit_bytes,
+            config.read_amplification_threshold,
+            config.n_workers
+        )
 
     # # Regenerate the rest of the period by downsampling
     # for level in range(config.n_pyramid_levels - 1):
@@ -138,20 +256,110 @@ def zarr2zarr(
     # group.attrs.update(ome_zarr_metadata.model_dump(exclude_unset=True)) # type: ignore
 
 
+def write_pyramid_metadata(output_base_dirpath: Path, coordinate_scales, pyramid_levels, write_summaries):
+    """Turn the written arrays into an OME-Zarr, recording what was written."""
+
+    ome_zarr_metadata = create_ome_zarr_metadata(
+        str(output_base_dirpath),
+        "test_name",
+        coordinate_scales,
+        pyramid_levels=pyramid_levels
+    )
+    group = zarr.open_group(output_base_dirpath)
+    group.attrs.update(ome_zarr_metadata.model_dump(exclude_unset=True)) # type: ignore
+    update_sparsity_attributes(output_base_dirpath, write_summaries)
+    for path, summary in write_summaries.items():
+        rich.print(f"Level {path}: wrote {summary.n_objects_written} objects, {summary.n_bytes_written} bytes")
+
+
+def write_pyramid_partition(
+        source_array,
+        output_base_dirpath: Path,
+        config: "ZarrConversionConfig",
+        pyramid_levels: List[PyramidLevel],
+        compressor,
+        num_workers: int,
+        worker_index: int
+    ):
+    """Write this worker's share of the pyramid levels down to the partition level,
+    then record that it has finished."""
+
+    alignment = config.shard_size if config.zarr_version == 3 else config.target_chunks
+    check_alignment(config.processing_chunks, alignment)
+
+    partition_level = choose_partition_level(pyramid_levels, config.processing_chunks, num_workers)
+    write_manifest(output_base_dirpath, PartitionManifest(
+        num_workers=num_workers,
+        partition_level=partition_level,
+        pyramid_levels=pyramid_levels,
+        target_chunks=config.target_chunks,
+        processing_chunks=config.processing_chunks,
+        compressor=compressor,
+        coordinate_scales=config.coordinate_scales
+    ))
+
+    if marker_fpath(output_base_dirpath, worker_index, num_workers).exists():
+        rich.print(f"Worker {worker_index} of {num_workers} has already finished")
+        return
+
+    blocks = blocks_for_worker(
+        partition_blocks(pyramid_levels, config.processing_chunks, partition_level), num_workers, worker_index
+    )
+    rich.print(f"Worker {worker_index} of {num_workers}: {len(blocks)} blocks, levels 0 to {partition_level}")
+
+    summaries = {level.path: LevelWriteSummary() for level in pyramid_levels[:partition_level + 1]}
+    for n, block in enumerate(blocks):
+        rich.print(f"Block [{n + 1}/{len(blocks)}] at {tuple(sl.start for sl in block)}")
+        block_summaries = {
+            '0': write_array_to_disk_chunked(
+                source_array, output_base_dirpath / '0', config.target_chunks, compressor,
+                config.processing_chunks, region=block
+            )
+        }
+        for level_index in range(1, partition_level + 1):
+            previous_level, level = pyramid_levels[level_index - 1], pyramid_levels[level_index]
+            block_summaries[level.path] = downsample_array_and_write_to_dirpath(
+                str(output_base_dirpath / previous_level.path),
+                output_base_dirpath / level.path,
+                level.factors,
+                config.target_chunks,
+                compressor=compressor,
+                processing_chunk_size=config.processing_chunks,
+                source_summary=block_summaries[previous_level.path],
+                region=region_at_level(block, pyramid_levels, level_index)
+            )
+        for path, summary in block_summaries.items():
+            merge_write_summaries(summaries[path], summary)
+
+    write_marker(output_base_dirpath, WorkerMarker(
+        worker_index=worker_index,
+        num_workers=num_workers,
+        n_blocks=len(blocks),
+        summaries=summaries
+    ))
+    rich.print(f"Worker {worker_index} of {num_workers} finished, run finalize once all workers have")
+
+
 @app.command()
 def n52zarr(
     n5_uri: str, 
     output_base_dirpath: Path,
-    conversion_config: Annotated[Optional[str], typer.Argument()] = "{}"
+    conversion_config: Annotated[Optional[str], typer.Argument()] = "{}",
+    dry_run: Annotated[bool, typer.Option("--dry-run", help="Estimate the cost of the conversion without writing anything")] = False,
+    num_workers: Annotated[int, typer.Option(help="Split the conversion across this many independent workers")] = 1,
+    worker_index: Annotated[int, typer.Option(help="Which of the workers this is, from 0")] = 0
 ):
     # n5_uri = "https://s3.embl.de/platybrowser/rawdata/sbem-6dpf-1-whole-raw.n5/setup0/timepoint0/s0"
 
     import tensorstore as ts
 
+    config = ZarrConversionConfig.model_validate_json(conversion_config)
+    configure_context(config.tensorstore)
+
     dataset = ts.open({
         'driver': 'n5',
         'kvstore': n5_uri
-    }).result()
+    }, context=get_context()).result()
 
     # TODO - this is hacky, assumes 3 dimensions always z, y, x
     if len(dataset.shape) == 3:
@@ -159,40 +367,98 @@ def n52zarr(
     else:
         output_array = dataset
 
-    from .omezarrgen import write_array_to_disk_chunked
-
-    config = ZarrConversionConfig.model_validate_json(conversion_config)
     if not config.coordinate_scales:
         config.coordinate_scales = [1.0, 1.0, 1.0, 1.0, 1.0]
-    if not config.n_pyramid_levels:
-        config.n_pyramid_levels = 1 + calculate_downsampling_steps(dataset.shape)
+
+    pyramid_levels = pyramid_levels_from_config(output_array.shape, config)
+    config.n_pyramid_levels = len(pyramid_levels)
 
     rich.print(config)
+    for level in pyramid_levels:
+        rich.print(f"Level {level.path}: shape {level.shape}, factors {level.factors}, scale {level.scale}")
+
+    # Only resolved if anything will be written, 'auto' reads samples of the source
+    compressor = None
+    if dry_run or num_workers > 1 or not all((output_base_dirpath / level.path).exists() for level in pyramid_levels):
+        compressor = resolve_compressor(config.compression, output_array, config.target_chunks)
+
+    if dry_run:
+        estimate = estimate_conversion(
+            output_array, pyramid_levels, config.target_chunks, config.processing_chunks, compressor
+        )
+        print_estimate(estimate)
+        return
+
+    if num_workers > 1:
+        write_pyramid_partition(
+            output_array, output_base_dirpath, config, pyramid_levels, compressor, num_workers, worker_index
+        )
+        return
+
+    # Summaries of what we wrote for each level, only available for levels written in this run
+    write_summaries = {}
 
     output_dirpath = output_base_dirpath / '0'
     if not output_dirpath.exists():
-        write_array_to_disk_chunked(output_array, output_dirpath, config.target_chunks)
+        write_summaries['0'] = write_array_to_disk_chunked(
+            output_array, output_dirpath, config.target_chunks, compressor, config.processing_chunks
+        )
     else:
         rich.print(f"{output_dirpath} exists, will not overwrite")
 
     # Regenerate the rest of the period by downsampling
-    output_array_keys = [str(i) for i in range(config.n_pyramid_levels)]
-    for level in range(config.n_pyramid_levels - 1):
-        input_array_dirpath = output_base_dirpath / output_array_keys[level] 
-        output_array_dirpath = output_base_dirpath / output_array_keys[level+1]
+    for previous_level, level in zip(pyramid_levels, pyramid_levels[1:]):
+        input_array_dirpath = output_base_dirpath / previous_level.path
+        output_array_dirpath = output_base_dirpath / level.path
         if not output_array_dirpath.exists():
             rich.print(f"Downsampling from {input_array_dirpath} to {output_array_dirpath}")
-            downsample_array_and_write_to_dirpath(
+            write_summaries[level.path] = downsample_array_and_write_to_dirpath(
                 str(input_array_dirpath),
                 output_array_dirpath,
-                config.downsample_factors,
-                config.target_chunks
+                level.factors,
+                config.target_chunks,
+                compressor=compressor,
+                processing_chunk_size=config.processing_chunks,
+                source_summary=write_summaries.get(previous_level.path)
             )
 
     # Create and write the OME-Zarr metadata    
-    ome_zarr_metadata = create_ome_zarr_metadata(str(output_base_dirpath), "test_name", config.coordinate_scales, config.downsample_factors)
-    group = zarr.open_group(output_base_dirpath)
-    group.attrs.update(ome_zarr_metadata.model_dump(exclude_unset=True)) # type: ignore
+    write_pyramid_metadata(output_base_dirpath, config.coordinate_scales, pyramid_levels, write_summaries)
+
+
+@app.command()
+def finalize(output_base_dirpath: Path):
+    """Complete a conversion split across workers with --num-workers: check all
+    workers have finished, build the remaining coarse levels and write the
+    OME-Zarr metadata."""
+
+    manifest = read_manifest(output_base_dirpath)
+    markers = read_markers(output_base_dirpath, manifest)
+    pyramid_levels = manifest.pyramid_levels
+    partition_level = manifest.partition_level
+
+    write_summaries = {}
+    for level in pyramid_levels[:partition_level + 1]:
+        summary = LevelWriteSummary()
+        record_array_metadata(summary, output_base_dirpath / level.path)
+        for marker in markers.values():
+            merge_write_summaries(summary, marker.summaries[level.path])
+        write_summaries[level.path] = summary
+
+    for previous_level, level in zip(pyramid_levels[partition_level:], pyramid_levels[partition_level + 1:]):
+        output_array_dirpath = output_base_dirpath / level.path
+        if not output_array_dirpath.exists():
+            rich.print(f"Downsampling from {output_base_dirpath / previous_level.path} to {output_array_dirpath}")
+            write_summaries[level.path] = downsample_array_and_write_to_dirpath(
+                str(output_base_dirpath / previous_level.path),
+                output_array_dirpath,
+                level.factors,
+                manifest.target_chunks,
+                compressor=manifest.compressor,
+                processing_chunk_size=manifest.processing_chunks
+            )
+
+    write_pyramid_metadata(output_base_dirpath, manifest.coordinate_scales, pyramid_levels, write_summaries)
 
 
 if __name__ == "__main__":
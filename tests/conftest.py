@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+import zarr
+
+
+@pytest.fixture
+def z_downsampled_uri(tmp_path):
+    """Three level pyramid, downsampled by 2 in x, y and z at each level, so the
+    levels have 8, 4 and 2 planes. Each plane has its own random content."""
+
+    uri = str(tmp_path/"image.zarr")
+    group = zarr.open_group(uri, mode="w")
+    rng = np.random.default_rng(0)
+    datasets = []
+    for level in range(3):
+        factor = 2**level
+        shape = (1, 1, 8 // factor, 64 // factor, 64 // factor)
+        group.create_dataset(str(level), data=rng.integers(0, 4096, shape, dtype="uint16"), chunks=(1, 1, 1, 16, 16))
+        datasets.append({
+            "path": str(level),
+            "coordinateTransformations": [{"type": "scale", "scale": [1.0, 1.0, float(factor), float(factor), float(factor)]}]
+        })
+    group.attrs["multiscales"] = [{
+        "version": "0.4",
+        "axes": [
+            {"name": "t", "type": "time"},
+            {"name": "c", "type": "channel"},
+            {"name": "z", "type": "space", "unit": "micrometer"},
+            {"name": "y", "type": "space", "unit": "micrometer"},
+            {"name": "x", "type": "space", "unit": "micrometer"},
+        ],
+        "datasets": datasets,
+    }]
+
+    return uri
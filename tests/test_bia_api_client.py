@@ -0,0 +1,125 @@
+import asyncio
+import importlib
+import uuid
+
+import pytest
+from aiohttp import web
+from pydantic import BaseModel
+
+from bia_converter.benchmark import FakeBIAAPI, ServiceThread
+
+pytest.importorskip("bia_integrator_api")
+
+
+class ImageRepresentation(BaseModel):
+    uuid: str
+    image_format: str = ".ome.zarr"
+
+
+class StubAPI(FakeBIAAPI):
+    """FakeBIAAPI that can fail POSTs for chosen UUIDs, and tracks how many requests
+    it is handling at once."""
+
+    def __init__(self):
+        super().__init__(latency_seconds=0.02)
+        self.fail_after_write = set()
+        self.fail_before_write = set()
+        self.reject = set()
+        self.n_posts = {}
+        self.n_in_flight = 0
+        self.max_in_flight = 0
+
+    async def tracked(self, handler, request):
+        self.n_in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.n_in_flight)
+        try:
+            await asyncio.sleep(0.01)
+            return await handler(request)
+        finally:
+            self.n_in_flight -= 1
+
+    async def get_object(self, request):
+        return await self.tracked(super().get_object, request)
+
+    async def post_object(self, request):
+        return await self.tracked(self._post_object, request)
+
+    async def _post_object(self, request):
+        obj = await request.json()
+        obj_uuid = obj["uuid"]
+        self.n_posts[obj_uuid] = self.n_posts.get(obj_uuid, 0) + 1
+        if obj_uuid in self.reject:
+            return web.json_response({"detail": "invalid"}, status=422)
+        if obj_uuid in self.fail_before_write and self.n_posts[obj_uuid] == 1:
+            return web.json_response({"detail": "unavailable"}, status=503)
+        self.add(request.match_info["model"], obj)
+        if obj_uuid in self.fail_after_write:
+            return web.json_response({"detail": "error after commit"}, status=500)
+
+        return web.json_response(obj, status=201)
+
+
+@pytest.fixture(scope="module")
+def api_client_module():
+    # The module logs in when imported, so point it at a stub first
+    service_thread = ServiceThread()
+    base_url = service_thread.start_app(FakeBIAAPI().app)
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv("API_BASE_URL", base_url)
+        module = importlib.import_module("bia_converter.bia_api_client")
+    yield module
+    service_thread.stop()
+
+
+@pytest.fixture
+def stub_api():
+    service_thread = ServiceThread()
+    api = StubAPI()
+    api.base_url = service_thread.start_app(api.app)
+    yield api
+    service_thread.stop()
+
+
+def new_object() -> ImageRepresentation:
+    return ImageRepresentation(uuid=str(uuid.uuid4()))
+
+
+def store(api_client_module, stub_api, objects, **kwargs):
+    return api_client_module.store_objects_in_api_idempotent(
+        objects, base_url=stub_api.base_url, access_token="test", **kwargs
+    )
+
+
+def test_existing_and_missing_objects(api_client_module, stub_api):
+    existing, missing = new_object(), new_object()
+    stub_api.add("image_representation", existing.model_dump())
+
+    outcomes = store(api_client_module, stub_api, [existing, missing])
+
+    assert [outcome.status for outcome in outcomes] == ["exists", "created"]
+    assert stub_api.n_posts == {missing.uuid: 1}
+    assert missing.uuid in stub_api.objects["image_representation"]
+
+
+def test_failed_posts_are_checked_before_retrying(api_client_module, stub_api):
+    written, not_written, rejected = new_object(), new_object(), new_object()
+    stub_api.fail_after_write.add(written.uuid)
+    stub_api.fail_before_write.add(not_written.uuid)
+    stub_api.reject.add(rejected.uuid)
+
+    outcomes = store(api_client_module, stub_api, [written, not_written, rejected])
+
+    assert [outcome.status for outcome in outcomes] == ["created", "created", "failed"]
+    # Stored despite the error, so not posted again
+    assert stub_api.n_posts[written.uuid] == 1
+    assert stub_api.n_posts[not_written.uuid] == 2
+    # Client errors are not retried
+    assert stub_api.n_posts[rejected.uuid] == 1
+    assert "422" in outcomes[2].error
+
+
+def test_concurrency_bound(api_client_module, stub_api):
+    outcomes = store(api_client_module, stub_api, [new_object() for _ in range(24)], max_concurrency=4)
+
+    assert all(outcome.status == "created" for outcome in outcomes)
+    assert 1 < stub_api.max_in_flight <= 4
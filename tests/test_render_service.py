@@ -0,0 +1,59 @@
+import asyncio
+import socket
+
+from aiohttp.test_utils import TestClient, TestServer
+from typer.testing import CliRunner
+
+from bia_converter.render_service import RenderService, app
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_handlers(z_downsampled_uri):
+    async def run():
+        service = RenderService(n_workers=1)
+        async with TestClient(TestServer(service.make_app())) as client:
+            response = await client.get("/render", params={"uri": z_downsampled_uri, "z": "5", "size": "32"})
+            assert response.status == 200
+            assert (await response.read()).startswith(PNG_SIGNATURE)
+            etag = response.headers["ETag"]
+
+            response = await client.get(
+                "/render",
+                params={"uri": z_downsampled_uri, "z": "5", "size": "32"},
+                headers={"If-None-Match": etag}
+            )
+            assert response.status == 304
+
+            response = await client.get("/thumbnail", params={"uri": z_downsampled_uri, "size": "32"})
+            assert response.status == 200
+            assert (await response.read()).startswith(PNG_SIGNATURE)
+
+            response = await client.get("/render", params={"uri": z_downsampled_uri, "z": "8"})
+            assert response.status == 400
+            response = await client.get("/render", params={"size": "32"})
+            assert response.status == 400
+
+            stats = await (await client.get("/stats")).json()
+            assert stats["renders"] == 2
+            assert stats["not_modified"] == 1
+
+    asyncio.run(run())
+
+
+def test_loadtest_command(z_downsampled_uri):
+    result = CliRunner().invoke(app, [
+        "loadtest", z_downsampled_uri,
+        "--n-requests", "8", "--concurrency", "4", "--size", "32",
+        "--n-workers", "1", "--port", str(free_port())
+    ])
+
+    assert result.exit_code == 0, result.output
+    assert "8 requests" in result.output
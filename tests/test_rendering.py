@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from bia_converter.proxyimage import ome_zarr_image_from_ome_zarr_uri
+from bia_converter.rendering import render_proxy_image
+
+
+@pytest.fixture
+def z_downsampled_image(z_downsampled_uri):
+    return ome_zarr_image_from_ome_zarr_uri(z_downsampled_uri)
+
+
+def test_z_maps_into_downsampled_level(z_downsampled_image):
+    # A 16x16 render reads the smallest level, where full resolution planes 4-7
+    # are plane 1 and 0-3 are plane 0
+    render_5 = np.asarray(render_proxy_image(z_downsampled_image, dims=(16, 16), z=5))
+    render_4 = np.asarray(render_proxy_image(z_downsampled_image, dims=(16, 16), z=4))
+    render_3 = np.asarray(render_proxy_image(z_downsampled_image, dims=(16, 16), z=3))
+
+    assert np.array_equal(render_5, render_4)
+    assert not np.array_equal(render_5, render_3)
+
+
+def test_z_out_of_range(z_downsampled_image):
+    with pytest.raises(IndexError):
+        render_proxy_image(z_downsampled_image, dims=(16, 16), z=8)